@@ -44,6 +44,7 @@ Indexes:
 
 * Numeric range fetches, searches, and ordering
 * Full-word text search (find me entries with col X having words A and B)
+* Relevance-ranked (BM25) text search
 * Prefix matching (can be used for prefix-based autocomplete)
 * Suffix matching (can be used for suffix-based autocomplete)
 * Pattern matching on string-based columns
@@ -173,10 +174,11 @@ from .exceptions import (ORMError, UniqueKeyViolation, InvalidOperation,
     DataRaceError, EntityDeletedError)
 from .index import GeneralIndex, GeoIndex, Pattern, Prefix, Suffix
 from .model import _ModelMetaclass, Model
-from .query import NOT_NULL, Query
-from .util import (ClassProperty, _connect, session,
+from .query import NOT_NULL, Q, Query
+from .util import (ClassProperty, _connect, session, batch,
     _prefix_score, _script_load, _encode_unique_constraint,
-    FULL_TEXT, CASE_INSENSITIVE, SIMPLE, SIMPLE_CI, IDENTITY, IDENTITY_CI)
+    FULL_TEXT, FULL_TEXT_SCORED, CASE_INSENSITIVE, SIMPLE, SIMPLE_CI, IDENTITY,
+    IDENTITY_CI)
 
 VERSION = '0.39.5'
 
@@ -194,7 +196,8 @@ SKIP_ON_DELETE
 ColumnError, DataRaceError, EntityDeletedError, InvalidColumnValue,
 InvalidOperation, MissingColumn, ORMError, QueryError, RestrictError,
 UniqueKeyViolation
-Pattern, Suffix, GeneralIndex, Prefix, Model, _ModelMetaclass, Query, NOT_NULL
+Pattern, Suffix, GeneralIndex, Prefix, Model, _ModelMetaclass, Q, Query, NOT_NULL
 IDENTITY, IDENTITY_CI, SIMPLE, SIMPLE_CI, CASE_INSENSITIVE, FULL_TEXT
+FULL_TEXT_SCORED
 ClassProperty
-session, _connect, _encode_unique_constraint, _prefix_score, _script_load
+batch, session, _connect, _encode_unique_constraint, _prefix_score, _script_load
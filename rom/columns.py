@@ -20,7 +20,7 @@ from .exceptions import (ORMError, InvalidOperation, ColumnError,
     MissingColumn, InvalidColumnValue, RestrictError)
 from .util import (_numeric_keygen, _string_keygen, _many_to_one_keygen,
     _boolean_keygen, dt2ts, ts2dt, t2ts, ts2t, session, _connect,
-    STRING_INDEX_KEYGENS_STR)
+    STRING_INDEX_KEYGENS_STR, STRING_SORT_KEYGENS, STRING_SORT_KEYGENS_STR)
 
 
 NULL = object()
@@ -182,6 +182,29 @@ class Column(object):
           returned data will be reversed (you need to make sure this makes
           conceptual sense with your data) before being stored or used. See
           ``Query.endswith()`` for details.
+        * *ngram* - implies *prefix*, and also keeps a trigram index of the
+          prefix-indexed strings, so ``Query.like()`` patterns without a
+          literal prefix (and ``Query.contains()``) only check the entities
+          that contain every trigram of the pattern, instead of scanning the
+          whole prefix index.
+        * *positions* - can be enabled on columns with ``index=True`` and
+          ``keygen=FULL_TEXT`` (or ``FULL_TEXT_SCORED``), and keeps the
+          positions of the words in each entity, which are used to check
+          ``Query.phrase()`` and ``Query.near_words()`` matches in Redis.
+        * *lex_order* - can be enabled on columns with ``index=True`` and one
+          of the sortable keygens (``SIMPLE``, ``SIMPLE_CI``), implies
+          *prefix*, and makes ``Query.order_by()`` order by the full string
+          (instead of the first 7 bytes) once the namespace uses the
+          lexicographic prefix index (see ``util.migrate_prefix_index()``).
+        * *bitmap* - can be enabled on ``Boolean`` and string columns with
+          ``index=True``, and keeps one bitmap per indexed value (with a bit
+          set for the id of each entity that has the value) instead of a SET.
+          This uses much less memory for low-cardinality columns, and makes
+          counting and combining their filters cheap. Filters on these
+          columns can't be combined with geo filters. When enabled on a model
+          with existing entities, the column keeps its SETs, which queries
+          use until ``rom.util.refresh_indices()`` has written the bitmaps
+          for every entity.
 
     .. warning:: Enabling prefix or suffix matching on a column only makes
        sense for columns defining a non-numeric *keygen* function.
@@ -235,15 +258,23 @@ class Column(object):
     '''
     _allowed = ()
 
-    __slots__ = '_required _default _init _unique _index _model _attr _keygen _prefix _suffix'.split()
+    __slots__ = '_required _default _init _unique _index _model _attr _keygen _prefix _suffix _ngram _positions _lex_order _bitmap'.split()
 
-    def __init__(self, required=False, default=NULL, unique=False, index=False, keygen=None, prefix=False, suffix=False, keygen2=None):
+    def __init__(self, required=False, default=NULL, unique=False, index=False, keygen=None, prefix=False, suffix=False, keygen2=None,
+                 ngram=False, positions=False, lex_order=False, bitmap=False):
+        # pattern matches are verified against the words in the prefix index,
+        # and full-length ordering uses the values in the prefix index
+        prefix = prefix or ngram or lex_order
         self._required = required
         self._default = default
         self._unique = unique
         self._index = index
         self._prefix = prefix
         self._suffix = suffix
+        self._ngram = ngram
+        self._positions = positions
+        self._lex_order = lex_order
+        self._bitmap = bitmap
         self._init = False
         self._model = None
         self._attr = None
@@ -252,11 +283,19 @@ class Column(object):
         if (keygen or keygen2) and not (index or prefix or suffix):
             raise ColumnError("Explicit keygen provided, but no index type spcified (index, prefix, and suffix all False)")
 
+        if positions and not (index and getattr(keygen, '__name__', None) in ('FULL_TEXT', 'FULL_TEXT_SCORED')):
+            raise ColumnError("Positional indexes require index=True and keygen=FULL_TEXT or FULL_TEXT_SCORED")
+
+        if lex_order and not (index and keygen in STRING_SORT_KEYGENS):
+            raise ColumnError("Lexicographic ordering requires index=True and one of the keygens: %s"%STRING_SORT_KEYGENS_STR)
+
         if not self._allowed and not hasattr(self, '_fmodel') and not hasattr(self, '_ftable'):
             raise ColumnError("Missing valid class-level _allowed attribute on %r"%(type(self),))
 
         allowed = (self._allowed,) if isinstance(self._allowed, type) else self._allowed
         is_integer = all(issubclass(x, six.integer_types) for x in allowed)
+        if bitmap and not (index and (bool in allowed or not is_numeric(allowed))):
+            raise ColumnError("Bitmap indexes require index=True on a Boolean or string column")
         if unique:
             if not (is_string or is_integer):
                 raise ColumnError("Unique columns can only be strings or integers")
@@ -847,12 +886,12 @@ class OneToMany(Column):
             col = OneToMany('OtherModelName')
             ocol = OneToMany('ModelName')
     '''
-    __slots__ = '_model _attr _ftable _required _unique _index _prefix _suffix _keygen _column'.split()
+    __slots__ = '_model _attr _ftable _required _unique _index _prefix _suffix _ngram _positions _lex_order _bitmap _keygen _column'.split()
     def __init__(self, ftable, column=None):
         if column in ON_DELETE or column is NO_ACTION_DEFAULT:
             raise ColumnError("OneToMany lost its on_delete argument - pass it to the ManyToOne instead")
         self._ftable = ftable
-        self._required = self._unique = self._index = self._prefix = self._suffix = False
+        self._required = self._unique = self._index = self._prefix = self._suffix = self._ngram = self._positions = self._lex_order = self._bitmap = False
         self._model = self._attr = self._keygen = None
         self._column = column
 
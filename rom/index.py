@@ -8,15 +8,21 @@ Released under the LGPL license version 2.1 and version 3 (you can choose
 which you'd like to be bound under).
 '''
 
+from bisect import bisect_left, bisect_right
 from collections import namedtuple
+from decimal import Decimal
+from hashlib import sha1
 import json
+import math
 import re
+import threading
+import time
 import uuid
 
 import six
 
 from .exceptions import QueryError
-from .util import _prefix_score, _script_load, _to_score
+from .util import Lock, _prefix_score, _redis_version, _script_load, _to_score
 
 _skip = None
 _skip = set(globals()) - set(['__doc__'])
@@ -24,7 +30,16 @@ _skip = set(globals()) - set(['__doc__'])
 Prefix = namedtuple('Prefix', 'attr prefix')
 Suffix = namedtuple('Suffix', 'attr suffix')
 Pattern = namedtuple('Pattern', 'attr pattern')
-Geofilter = namedtuple('Geo', 'name lon lat radius measure count')
+Ngram = namedtuple('Ngram', 'attr pattern grams')
+Geofilter = namedtuple('Geo', 'name lon lat radius measure count width height order')
+# bounding box dimensions are only used in place of the radius, and order is
+# 1 or -1 to order the results by (ascending or descending) distance
+Geofilter.__new__.__defaults__ = (None, None, 0)
+Expression = namedtuple('Expression', 'op filters')
+Search = namedtuple('Search', 'attr terms mode')
+Phrase = namedtuple('Phrase', 'attr words within')
+Composite = namedtuple('Composite', 'attrs values min max')
+InList = namedtuple('InList', 'attr values')
 
 GeoIndex = namedtuple('GeoIndex', 'name callback')
 
@@ -56,6 +71,48 @@ def _find_prefix(pat):
         x.append(i)
     return ''.join(x[:7])
 
+def _literal_prefix(pat):
+    # The full literal prefix of a pattern, for lexicographic prefix indexes
+    if isinstance(pat, six.binary_type):
+        pat = pat.decode('utf-8')
+    return re.split(r'[?*+!]', pat, 1)[0]
+
+def _lex_range(prefix):
+    # ZRANGEBYLEX endpoints for all members starting with the prefix
+    if not prefix:
+        return '-', '+'
+    if not isinstance(prefix, six.binary_type):
+        prefix = prefix.encode('utf-8')
+    return b'[' + prefix, b'(' + prefix + b'\xff'
+
+def _trigrams(word):
+    # The 3 character substrings of a word, for trigram indexes
+    if isinstance(word, six.binary_type):
+        try:
+            word = word.decode('utf-8')
+        except UnicodeDecodeError:
+            word = word.decode('latin-1')
+    return set(word[i:i+3] for i in range(len(word) - 2))
+
+def _pattern_trigrams(pat):
+    # The trigrams that every match of a pattern contains
+    if isinstance(pat, six.binary_type):
+        try:
+            pat = pat.decode('utf-8')
+        except UnicodeDecodeError:
+            return set()
+    out = set()
+    for run in re.split(r'[?*+!]', pat):
+        out.update(_trigrams(run))
+    return out
+
+def _composite_value(score):
+    # numeric equality values of the leading columns of a composite index
+    return repr(float(score))
+
+def _composite_key(attrs, values):
+    return '%s:%s'%('+'.join(attrs), ':'.join(values))
+
 MAX_PREFIX_SCORE = _prefix_score(7*'\xff', True)
 def _start_end(prefix):
     return _prefix_score(prefix), (_prefix_score(prefix, True) if prefix else MAX_PREFIX_SCORE)
@@ -90,54 +147,365 @@ class GeneralIndex(object):
     Prefix, suffix, and pattern matching change this operation. Given a key
     generated of ``hello`` on a column ``c`` on a model with primary key
     ``MyModel:1``, the member ``hello\\01`` with score 0 will be added to a
-    ZSET with the key name ``MyModel:c:pre`` for the prefix/pattern index.
+    ZSET with the key name ``MyModel:c:pre:lex`` for the prefix/pattern index.
     On a suffix index, the member ``olleh\\01`` with score 0 will be added to
-    a ZSET with the key name ``MyModel:c:suf``.
+    a ZSET with the key name ``MyModel:c:suf:lex``.
 
-    Prefix and suffix matches are excuted in Lua with a variant of the
-    autocomplete method described in Redis in Action. These methods ensure a
-    runtime proportional to the number of matched entries.
+    Prefix and suffix matches find the range of matching members with
+    ZLEXCOUNT, so queries don't write to the index, and the runtime is
+    proportional to the number of matched entries for prefixes of any length.
+    Indexes written by rom versions before 0.40.0 (``MyModel:c:pre`` and
+    ``MyModel:c:suf``, scored by the first 7 bytes of each member) are used
+    until they are copied over with ``util.migrate_prefix_index()``.
 
     Pattern matching also uses a Lua script to scan over data in the prefix
     index, exploiting prefixes in patterns if they exist.
 
+    Queries without geo filters are executed with a single Lua script that
+    estimates the size of every filter, intersects them from smallest to
+    largest, orders, limits, and (optionally) fetches the entity data, all in
+    one round trip.
+
+    String order indexes only hold the first 7 bytes of each value. Columns
+    with ``lex_order=True`` are ordered by their full values from the
+    lexicographic prefix index instead: small limits walk the prefix index in
+    order, checking each entity against the filters, and other queries order
+    by the 7-byte scores, only comparing full values for entities whose
+    scores tie around the requested page.
+
+    Composite indexes on columns ``(a, b)`` hold one ZSET per value of ``a``,
+    like ``MyModel:a+b:<value>:idx``, scored by ``b``. Queries with an
+    equality filter on ``a`` and a range filter on ``b`` read the range from
+    that ZSET instead of intersecting the indexes of ``a`` and ``b``.
+
+    Columns with ``bitmap=True`` keep a bitmap per value instead of a SET,
+    like ``MyModel:c:hello:bm``, with the bit at each entity's id set. All of
+    the bitmap filters of a query are combined with BITOP, and only turned
+    into ids after the combination (or counted with BITCOUNT).
+
     '''
-    def __init__(self, namespace):
+    def __init__(self, namespace, lex_order=(), composite=(), bitmap=()):
         self.namespace = namespace
-
-    def _prepare(self, conn, filters):
+        self.lex_order = frozenset(lex_order)
+        self.composite = list(composite)
+        self.bitmap = frozenset(bitmap)
+        # composite and bitmap indexes are only queried once built
+        self.built_indexes = frozenset(['+'.join(attrs) for attrs in self.composite]) | self.bitmap
+        self._built = frozenset()
+        self._stats = {}
+        self._stats_checked = 0
+
+    def stats(self, conn):
+        '''
+        Returns the index statistics written by
+        ``rom.util.update_index_stats()``, re-reading them from Redis at most
+        once every ``rom.index.STATS_REFRESH`` seconds.
+        '''
+        if time.time() - self._stats_checked > STATS_REFRESH:
+            stats = {}
+            for k, v in conn.hgetall('%s::stats'%self.namespace).items():
+                stats[k.decode() if six.PY3 else k] = json.loads(v.decode() if six.PY3 else v)
+            self._stats = stats
+            self._stats_checked = time.time()
+        return self._stats
+
+    def built(self, conn):
+        '''
+        Returns the names of the composite (``'col1+col2'``) and bitmap
+        (``'col'``) indexes that were written for every entity, because they
+        were declared before the first entity was saved, or were backfilled
+        with ``rom.util.refresh_indices()``. Until then, queries use the
+        per-column indexes instead. Re-reads ``<namespace>::built`` from
+        Redis while any declared index isn't built.
+        '''
+        if not self.built_indexes <= self._built:
+            built = conn.hkeys('%s::built'%self.namespace)
+            self._built = frozenset(k.decode() if six.PY3 else k for k in built)
+        return self._built
+
+    def _composite(self, filters, built=()):
+        # Replaces equality filters on the leading columns of a (built)
+        # composite index and a range filter on its last column with one
+        # Composite filter over the composite index.
+        filters = list(filters)
+        for attrs in self.composite:
+            if '+'.join(attrs) not in built:
+                continue
+            lead = {}
+            last = None
+            for i, fltr in enumerate(filters):
+                if isinstance(fltr, six.string_types):
+                    attr, sep, value = fltr.partition(':')
+                    if sep and attr in attrs[:-1] and attr not in lead:
+                        lead[attr] = i, value
+                elif type(fltr) is tuple and len(fltr) == 3:
+                    attr, mi, ma = fltr
+                    if attr == attrs[-1] and last is None:
+                        last = i
+                    elif attr in attrs[:-1] and attr not in lead and mi == ma and \
+                            isinstance(mi, six.integer_types + (float, Decimal)):
+                        lead[attr] = i, _composite_value(mi)
+            if last is None or len(lead) < len(attrs) - 1:
+                continue
+            _, mi, ma = filters[last]
+            comp = Composite(attrs, tuple(lead[attr][1] for attr in attrs[:-1]), mi, ma)
+            used = set(i for i, _ in lead.values())
+            filters = [comp if i == last else fltr for i, fltr in enumerate(filters) if i not in used]
+        return filters
+
+    def _compile(self, filters, stats=None, composite=True, built=()):
+        # Turns filters into the JSON-friendly form understood by the query
+        # script along with any estimates available from statistics, or
+        # returns None if the query script can't handle the filters. Only
+        # the *built* composite and bitmap indexes are used.
+        ns = self.namespace
+        out = []
+        estimates = []
+        sources = []
+        bitmap = self.bitmap & frozenset(built)
+        if composite and self.composite:
+            filters = self._composite(filters, built)
+        for fltr in filters:
+            if isinstance(fltr, list) and not fltr:
+                continue
+            estimates.append(stats and _stats_estimate(fltr, stats) or False)
+            sources.append(fltr)
+            if isinstance(fltr, (Prefix, Suffix, Pattern, Ngram)) and isinstance(fltr[1], six.binary_type):
+                # the script gets utf-8 from cjson, so only pass utf-8
+                try:
+                    fltr = fltr._replace(**{fltr._fields[1]: fltr[1].decode('utf-8')})
+                except UnicodeDecodeError:
+                    return None
+            if isinstance(fltr, six.string_types) and _filter_attr(fltr) in bitmap:
+                out.append(['bits', [['%s:%s:bm'%(ns, fltr)]]])
+            elif isinstance(fltr, six.string_types):
+                out.append(['set', '%s:%s:idx'%(ns, fltr)])
+            elif isinstance(fltr, list) and _filter_attr(fltr) in bitmap:
+                out.append(['bits', [['%s:%s:bm'%(ns, fi) for fi in fltr]]])
+            elif isinstance(fltr, Prefix):
+                out.append(['prefix', '%s:%s:pre'%(ns, fltr.attr)] +
+                    list(_start_end(fltr.prefix)) + [fltr.prefix, False,
+                    '%s:%s:pre:lex'%(ns, fltr.attr), fltr.prefix])
+            elif isinstance(fltr, Suffix):
+                out.append(['prefix', '%s:%s:suf'%(ns, fltr.attr)] +
+                    list(_start_end(fltr.suffix)) + [fltr.suffix, False,
+                    '%s:%s:suf:lex'%(ns, fltr.attr), fltr.suffix])
+            elif isinstance(fltr, Pattern):
+                out.append(['prefix', '%s:%s:pre'%(ns, fltr.attr)] +
+                    list(_start_end(_find_prefix(fltr.pattern))) +
+                    ['^' + _pattern_to_lua_pattern(fltr.pattern), True,
+                    '%s:%s:pre:lex'%(ns, fltr.attr), _literal_prefix(fltr.pattern)])
+            elif isinstance(fltr, Ngram):
+                out.append(['ngram', ['%s:%s~3:%s:idx'%(ns, fltr.attr, gram) for gram in fltr.grams],
+                    '^' + _pattern_to_lua_pattern(fltr.pattern), fltr.attr])
+            elif isinstance(fltr, list):
+                out.append(['union', ['%s:%s:idx'%(ns, fi) for fi in fltr]])
+            elif isinstance(fltr, Geofilter):
+                return None
+            elif isinstance(fltr, Phrase):
+                out.append(['phrase', ['%s:%s:%s:idx'%(ns, fltr.attr, word) for word in sorted(set(fltr.words))],
+                    '%s:%s:pos'%(ns, fltr.attr), list(fltr.words), fltr.within or False])
+            elif isinstance(fltr, Search):
+                out.append(['text', ['%s:%s:%s:idx'%(ns, fltr.attr, term) for term in fltr.terms],
+                    '%s:%s:idx'%(ns, fltr.attr), fltr.mode])
+            elif isinstance(fltr, InList):
+                out.append(['in', '%s:%s:idx'%(ns, fltr.attr), list(fltr.values)])
+            elif isinstance(fltr, Composite):
+                out.append(['range', '%s:%s:idx'%(ns, _composite_key(fltr.attrs, fltr.values)),
+                    _score_arg(fltr.min, '-inf'), _score_arg(fltr.max, 'inf'),
+                    fltr.min is not None and _to_score(fltr.min, True),
+                    fltr.max is not None and _to_score(fltr.max, True)])
+            elif isinstance(fltr, Expression):
+                inner = self._compile(fltr.filters, composite=fltr.op == 'and', built=built)
+                if inner is None:
+                    return None
+                if fltr.op == 'not':
+                    out.append(['not', inner[0][0]])
+                else:
+                    if fltr.op == 'or' and any(f[0] == 'not' for f in inner[0]):
+                        raise QueryError("Cannot negate a filter inside an 'or' expression")
+                    out.append([fltr.op, inner[0]])
+            elif isinstance(fltr, tuple):
+                if len(fltr) != 3:
+                    raise QueryError("Cannot filter range of data without 2 endpoints (%s given)"%(len(fltr)-1,))
+                attr, mi, ma = fltr
+                out.append(['range', '%s:%s:idx'%(ns, attr),
+                    _score_arg(mi, '-inf'), _score_arg(ma, 'inf'),
+                    mi is not None and _to_score(mi, True),
+                    ma is not None and _to_score(ma, True)])
+            else:
+                raise QueryError("Don't know how to handle a filter of: %r"%(fltr,))
+        bits = [i for i, f in enumerate(out) if f[0] == 'bits']
+        for i in bits:
+            # set index statistics don't apply to bitmaps
+            estimates[i] = False
+        if composite and len(bits) > 1:
+            # bitmap filters that are and-ed together are combined into one
+            first = bits[0]
+            out[first] = ['bits', [group for i in bits for group in out[i][1]]]
+            sources[first] = Expression('and', tuple(sources[i] for i in bits))
+            for i in reversed(bits[1:]):
+                del out[i], estimates[i], sources[i]
+        if out and all(f[0] == 'not' for f in out):
+            raise QueryError("Negated filters need another filter to be subtracted from")
+        return out, estimates, sources
+
+    def _execute(self, conn, compiled, order_by, mode, offset=None, count=None, timeout=None, hints=None, cache=None,
+                 cursor=None, page=False, by=None):
         temp_id = "%s:%s"%(self.namespace, uuid.uuid4())
+        order = False
+        if order_by:
+            attr = order_by.lstrip('-')
+            order = ['%s:%s:idx'%(self.namespace, attr),
+                -1 if order_by.startswith('-') else 1]
+            if attr in self.lex_order:
+                if (cursor or page) and mode in ('ids', 'data'):
+                    raise QueryError("Cannot page through results with a cursor when ordering by full string values")
+                order += ['%s:%s:pre:lex'%(self.namespace, attr), attr]
+        offset = offset if offset is not None else 0
+        end = (offset + count - 1) if count and count > 0 else -1
+        compiled, estimates, sources = compiled
+        if cursor and mode in ('ids', 'data'):
+            if not order:
+                raise QueryError("Cannot use a cursor without an order_by clause")
+            # results are ordered by (order * score, id), so only the part of
+            # the order index at or past the cursor score can match
+            after, score, id = cursor
+            cursor = [repr(float(score)), id, 1 if after else -1]
+            if compiled and not cache:
+                bounds = [cursor[0], 'inf'] if after else ['-inf', cursor[0]]
+                if order[1] < 0:
+                    bounds = [_negate(b) for b in reversed(bounds)]
+                compiled = compiled + [['range', order[0]] + bounds +
+                    [False if b.endswith('inf') else '(' + b for b in bounds]]
+                estimates = estimates + [False]
+                sources = sources + [tuple([order_by.lstrip('-')] + bounds)]
+        else:
+            cursor = None
+        hints = hints or {}
+        subrange = hints.get('subrange')
+        walk = hints.get('walk')
+        probe = hints.get('probe')
+        spec = {
+            'filters': compiled,
+            'estimates': estimates,
+            'hint': [i + 1 for i in _hinted(sources, hints.get('order'))],
+            'subrange': 0 if subrange is None else (1 if subrange else -1),
+            'walk': 0 if walk is None else (1 if walk else -1),
+            'topk': TOP_K_LIMIT,
+            'fast_set': FAST_SET_LIMIT,
+            'probe': 0 if probe is None else (1 if probe else -1),
+            'probe_ratio': PROBE_RATIO,
+            'bm25': [BM25_K1, BM25_B],
+            'rangestore': _range_store(conn),
+            'order': order,
+            'by': bool(by and not order) and '%s:%s:idx'%(self.namespace, by),
+            'mode': mode,
+            'start': offset,
+            'stop': end,
+            'ttl': timeout or 0,
+            'cache': False,
+            'cursor': cursor or False,
+            'page': bool(page) and mode in ('ids', 'data'),
+        }
+        keys = [self.namespace, temp_id, temp_id + ':t']
+        if cache and mode in ('ids', 'data', 'count', 'key'):
+            # results are cached without limits, so all pages share them
+            key = [sorted(compiled, key=json.dumps) if order_by else compiled, order]
+            ckey = '%s::qc:%s'%(self.namespace, sha1(json.dumps(key).encode('utf-8')).hexdigest())
+            keys += [ckey, ckey + ':m']
+            attrs = set()
+            for f in sources:
+                attrs.update(_filter_attrs(f))
+            if order_by:
+                attrs.add(order_by.lstrip('-'))
+            spec['cache'] = {
+                'ttl': max(int(cache['ttl']), 1),
+                'stale': max(int(cache.get('stale') or 0), 0),
+                'refresh': False,
+                'versions': sorted(attrs),
+            }
+        result = _query_lua(conn, keys, [json.dumps(spec)])
+        if spec['cache']:
+            status, result = result
+            if status in (b'stale', 'stale'):
+                _revalidate(conn, keys, spec)
+        if mode in ('plan', 'analyze'):
+            plan = json.loads(result.decode() if six.PY3 else result)
+            plan['script'] = True
+            plan['steps'] = plan['steps'] or []
+            for step in plan['steps']:
+                step['filter'] = sources[step['filter'] - 1]
+            return plan
+        if mode == 'key':
+            return temp_id
+        scores = None
+        if spec['page']:
+            result, scores = result
+            scores = [float(s) for s in scores]
+        if mode == 'data':
+            result = list(zip(result[::2], result[1::2]))
+        if spec['page']:
+            return result, scores
+        return result
+
+    def _lex(self, conn, filters):
+        # whether prefix/suffix/pattern filters use the lexicographic indexes
+        return any(isinstance(f, (Prefix, Suffix, Pattern, Ngram)) for f in filters) and \
+            bool(conn.exists('%s::lex'%self.namespace))
+
+    def _estimate_pipelined(self, pipe, filters, hints, lex=False, bitmap=()):
+        # reorder filters based on the size of the underlying set/zset
+        lex = ':lex' if lex else ''
+        for fltr in filters:
+            if isinstance(fltr, (six.string_types, list)) and _filter_attr(fltr) in bitmap:
+                raise QueryError("Cannot combine bitmap index filters with geo filters or non-utf-8 patterns")
+            if isinstance(fltr, six.string_types):
+                estimate_work_lua(pipe, '%s:%s:idx'%(self.namespace, fltr), None)
+            elif isinstance(fltr, Prefix):
+                estimate_work_lua(pipe, '%s:%s:pre%s'%(self.namespace, fltr.attr, lex), fltr.prefix)
+            elif isinstance(fltr, Suffix):
+                estimate_work_lua(pipe, '%s:%s:suf%s'%(self.namespace, fltr.attr, lex), fltr.suffix)
+            elif isinstance(fltr, (Pattern, Ngram)):
+                estimate_work_lua(pipe, '%s:%s:pre%s'%(self.namespace, fltr.attr, lex),
+                    _literal_prefix(fltr.pattern) if lex else _find_prefix(fltr.pattern))
+            elif isinstance(fltr, list):
+                estimate_work_lua(pipe, '%s:%s:idx'%(self.namespace, fltr[0]), None)
+            elif isinstance(fltr, Geofilter):
+                estimate_work_lua(pipe, '%s:%s:geo'%(self.namespace, fltr.name), fltr.count)
+            elif isinstance(fltr, (Expression, Search, Phrase, InList)):
+                raise QueryError("Cannot combine filter expressions, text searches, or in-list filters with geo filters or non-utf-8 patterns")
+            elif isinstance(fltr, tuple):
+                estimate_work_lua(pipe, '%s:%s:idx'%(self.namespace, fltr[0]), fltr[1:3])
+            else:
+                raise QueryError("Don't know how to handle a filter of: %r"%(fltr,))
+        sizes = list(enumerate(pipe.execute()))
+        sizes.sort(key=lambda x:abs(x[1]))
+        if hints and hints.get('order'):
+            rank = dict((j, r) for r, j in enumerate(_hinted(filters, hints['order'])))
+            sizes.sort(key=lambda x: rank.get(x[0], len(rank)))
+        return sizes
+
+    def _prepare(self, conn, filters, hints=None, distance=False):
+        # With *distance*, the distances of an ordered geo filter are kept in
+        # the <temp_id>:dist key for _prepare_ordered()
+        temp_id = "%s:%s"%(self.namespace, uuid.uuid4())
+        lex = self._lex(conn, filters)
         pipe = conn.pipeline(True)
         sfilters = filters
         sizes = [(None, 0)]
         if filters:
-            # reorder filters based on the size of the underlying set/zset
-            for fltr in filters:
-                if isinstance(fltr, six.string_types):
-                    estimate_work_lua(pipe, '%s:%s:idx'%(self.namespace, fltr), None)
-                elif isinstance(fltr, Prefix):
-                    estimate_work_lua(pipe, '%s:%s:pre'%(self.namespace, fltr.attr), fltr.prefix)
-                elif isinstance(fltr, Suffix):
-                    estimate_work_lua(pipe, '%s:%s:suf'%(self.namespace, fltr.attr), fltr.suffix)
-                elif isinstance(fltr, Pattern):
-                    estimate_work_lua(pipe, '%s:%s:pre'%(self.namespace, fltr.attr), _find_prefix(fltr.pattern))
-                elif isinstance(fltr, list):
-                    estimate_work_lua(pipe, '%s:%s:idx'%(self.namespace, fltr[0]), None)
-                elif isinstance(fltr, Geofilter):
-                    estimate_work_lua(pipe, '%s:%s:geo'%(self.namespace, fltr.name), fltr.count)
-                elif isinstance(fltr, tuple):
-                    estimate_work_lua(pipe, '%s:%s:idx'%(self.namespace, fltr[0]), fltr[1:3])
-                else:
-                    raise QueryError("Don't know how to handle a filter of: %r"%(fltr,))
-            sizes = list(enumerate(pipe.execute()))
-            sizes.sort(key=lambda x:abs(x[1]))
+            sizes = self._estimate_pipelined(pipe, filters, hints, lex, self.bitmap & self.built(conn))
             sfilters = [filters[x[0]] for x in sizes]
+        lex = ':lex' if lex else ''
 
         # the first "intersection" is actually a union to get us started, unless
         # we can explicitly create a sub-range in Lua for a fast start to
         # intersection
         intersect = pipe.zunionstore
         first = True
+        rangestore = _range_store(conn)
+        geosearch = _geo_search(conn)
         for ii, fltr in enumerate(sfilters):
             if isinstance(fltr, list):
                 # or string string/tag search
@@ -156,45 +524,59 @@ class GeneralIndex(object):
                 # simple string/tag search
                 intersect(temp_id, {temp_id:0, '%s:%s:idx'%(self.namespace, fltr):0})
             elif isinstance(fltr, Prefix):
-                redis_prefix_lua(pipe, temp_id, '%s:%s:pre'%(self.namespace, fltr.attr), fltr.prefix, first)
+                redis_prefix_lua(pipe, temp_id, '%s:%s:pre%s'%(self.namespace, fltr.attr, lex), fltr.prefix, first)
             elif isinstance(fltr, Suffix):
-                redis_prefix_lua(pipe, temp_id, '%s:%s:suf'%(self.namespace, fltr.attr), fltr.suffix, first)
-            elif isinstance(fltr, Pattern):
+                redis_prefix_lua(pipe, temp_id, '%s:%s:suf%s'%(self.namespace, fltr.attr, lex), fltr.suffix, first)
+            elif isinstance(fltr, (Pattern, Ngram)):
+                # trigram indexes are only used by the query script
                 redis_prefix_lua(pipe, temp_id,
-                    '%s:%s:pre'%(self.namespace, fltr.attr),
-                    _find_prefix(fltr.pattern),
+                    '%s:%s:pre%s'%(self.namespace, fltr.attr, lex),
+                    _literal_prefix(fltr.pattern) if lex else _find_prefix(fltr.pattern),
                     first, '^' + _pattern_to_lua_pattern(fltr.pattern),
                 )
             elif isinstance(fltr, Geofilter):
-                # Prep the georadius command
-                args = [
-                    'georadius', '%s:%s:geo'%(self.namespace, fltr.name),
-                    repr(fltr.lon), repr(fltr.lat), fltr.radius, fltr.measure
-                ]
-                if fltr.count and fltr.count >= 0:
-                    args.append('COUNT')
-                    args.append(fltr.count)
-                args.append('STOREDIST')
                 first = intersect == pipe.zunionstore
-                args.append(temp_id if first else str(uuid.uuid4()))
+                keep = distance and fltr.order
+                dest = temp_id + ':dist' if keep else (temp_id if first else str(uuid.uuid4()))
+                key = '%s:%s:geo'%(self.namespace, fltr.name)
+                count = ['ASC', 'COUNT', fltr.count] if fltr.count and fltr.count >= 0 else []
+                if geosearch:
+                    # GEOSEARCHSTORE replaces the deprecated GEORADIUS STORE*
+                    # options, and can also search inside of a bounding box
+                    args = ['GEOSEARCHSTORE', dest, key, 'FROMLONLAT', repr(fltr.lon), repr(fltr.lat)]
+                    if fltr.width is not None:
+                        args += ['BYBOX', fltr.width, fltr.height, fltr.measure]
+                    else:
+                        args += ['BYRADIUS', fltr.radius, fltr.measure]
+                    args += count + ['STOREDIST']
+                elif fltr.width is not None:
+                    raise QueryError("Geo bounding box filters require Redis 6.2+")
+                else:
+                    args = ['georadius', key, repr(fltr.lon), repr(fltr.lat), fltr.radius, fltr.measure]
+                    args += count + ['STOREDIST', dest]
 
                 pipe.pipeline_execute_command(*args)
-                if not first:
-                    intersect(temp_id, {temp_id: 0, args[-1]: 1})
-                    pipe.delete(args[-1])
+                if dest != temp_id:
+                    intersect(temp_id, {temp_id: 0, dest: 1})
+                if not (keep or first):
+                    pipe.delete(dest)
 
             elif isinstance(fltr, tuple):
                 # zset range search
                 if len(fltr) != 3:
                     raise QueryError("Cannot filter range of data without 2 endpoints (%s given)"%(len(fltr)-1,))
                 fltr, mi, ma = fltr
-                if not ii and sizes[0][1] < 0:
+                subrange = (hints or {}).get('subrange')
+                if not ii and ((rangestore or sizes[0][1] < 0) if subrange is None else subrange):
                     # We've got a special case where we want to explicitly extract
                     # a subrange instead of starting from a larger index, because
                     # it turns out that this is going to be faster :P
-                    lua_subrange(pipe, [temp_id, '%s:%s:idx'%(self.namespace, fltr)],
-                        ['-inf' if mi is None else _to_score(mi), 'inf' if ma is None else _to_score(ma)]
-                    )
+                    bounds = ['-inf' if mi is None else _to_score(mi), 'inf' if ma is None else _to_score(ma)]
+                    if rangestore:
+                        pipe.pipeline_execute_command('ZRANGESTORE', temp_id,
+                            '%s:%s:idx'%(self.namespace, fltr), bounds[0], bounds[1], 'BYSCORE')
+                    else:
+                        lua_subrange(pipe, [temp_id, '%s:%s:idx'%(self.namespace, fltr)], bounds)
 
                 else:
                     intersect(temp_id, {temp_id:0, '%s:%s:idx'%(self.namespace, fltr):1})
@@ -206,7 +588,8 @@ class GeneralIndex(object):
             intersect = pipe.zinterstore
         return pipe, intersect, temp_id
 
-    def search(self, conn, filters, order_by, offset=None, count=None, timeout=None):
+    def search(self, conn, filters, order_by, offset=None, count=None, timeout=None, data=False, hints=None, cache=None,
+               single_flight=None, cursor=None, page=False):
         '''
         Search for model ids that match the provided filters.
 
@@ -239,6 +622,24 @@ class GeneralIndex(object):
                 6. ``Pattern('column', 'pattern')`` - will match patterns over
                    words in a text search on the column
 
+                7. ``Ngram('column', 'pattern', trigrams)`` - like
+                   ``Pattern``, but only checks the entities in the trigram
+                   indexes of all of the trigrams (for ``ngram=True`` columns)
+
+                8. ``Search('column', words, 'any' or 'all')`` - will match
+                   any or all of the words in a ``FULL_TEXT_SCORED`` column,
+                   and results are ordered by relevance without ``order_by``
+
+                9. ``Phrase('column', words, within)`` - will match the words
+                   in order, or with ``within=n``, 2 words at most n words
+                   apart (for ``positions=True`` columns)
+
+                10. ``InList('column', scores)`` - will match any of the
+                    provided values of a numeric column
+
+            .. note:: Plain and list string filters on ``bitmap=True``
+              columns match the same entities, using the bitmap indexes
+
             * *order_by* - A string that names the numeric column by which to
               sort the results by. Prefixing with '-' will return results in
               descending order
@@ -254,40 +655,1755 @@ class GeneralIndex(object):
 
             * *offset* - A numeric starting offset for results
             * *count* - The maximum number of results to return from the query
+            * *data* - If true, return a list of ``(id, flattened_hash)``
+              pairs with the data for each matched entity instead of ids
+            * *hints* - An optional dictionary of planner hints, see
+              ``Query.hint()``
+            * *cache* - An optional dictionary of result cache settings, see
+              ``Query.cache()``
+            * *single_flight* - If provided, the number of seconds for which
+              concurrent callers running the same query will share results,
+              see ``Query.single_flight()``
+            * *cursor* - An optional ``(after, score, id)`` tuple, only
+              returning results ordered after (or before, if *after* is false)
+              the result with the provided order score and id
+            * *page* - If true, return a ``(results, scores)`` tuple, with the
+              order score of each result (the distance of each result for geo
+              filters with an ``order``)
         '''
-        # prepare the filters
-        pipe, intersect, temp_id = self._prepare(conn, filters)
+        compiled = self._compile(filters, self.stats(conn), True, self.built(conn))
+        if compiled is not None:
+            if single_flight and not cache:
+                cache = {'ttl': single_flight, 'stale': 0}
+            mode = 'key' if timeout is not None else ('data' if data else 'ids')
+            return self._execute(conn, compiled, order_by, mode, offset, count, timeout, hints, cache,
+                cursor, page, _unordered_by(filters))
+        elif cursor:
+            raise QueryError("Cannot page through results with a cursor when using geo filters")
+
+        offset = offset if offset is not None else 0
+        end = (offset + count - 1) if count and count > 0 else -1
+        ids = None
+        key = single_flight and self._single_flight(conn, filters, order_by, hints, single_flight)
+        if key and timeout is not None:
+            # the shared results are copied, as callers can expire or delete
+            # the returned key
+            temp_id = "%s:%s"%(self.namespace, uuid.uuid4())
+            if self._read_shared(conn, key, lambda pipe: (
+                    pipe.zunionstore(temp_id, [key]), pipe.expire(temp_id, timeout))):
+                return temp_id
+        elif key:
+            ids = self._read_shared(conn, key, lambda pipe: pipe.zrange(key, offset, end, withscores=page))
+            ids = ids and ids[0]
+        if ids is None:
+            # another caller didn't share results with us
+            # prepare the filters
+            pipe, intersect, temp_id = self._prepare_ordered(conn, filters, order_by, hints)
+
+            # handle returning the temporary result key
+            if timeout is not None:
+                pipe.expire(temp_id, timeout)
+                pipe.execute()
+                return temp_id
+
+            pipe.zrange(temp_id, offset, end, withscores=page)
+            pipe.delete(temp_id)
+            ids = pipe.execute()[-2]
+
+        if page:
+            scores = [score for id, score in ids]
+            ids = [id for id, score in ids]
+        if data:
+            pipe = conn.pipeline(False)
+            for id in ids:
+                pipe.hgetall('%s:%s'%(self.namespace, id.decode() if six.PY3 else id))
+            ids = [(id, [x for kv in d.items() for x in kv]) for id, d in zip(ids, pipe.execute())]
+        return (ids, scores) if page else ids
+
+    def _prepare_ordered(self, conn, filters, order_by, hints):
+        pipe, intersect, temp_id = self._prepare(conn, filters, hints, distance=not order_by)
 
         # handle ordering
         if order_by:
             reverse = order_by and order_by.startswith('-')
             order_clause = '%s:%s:idx'%(self.namespace, order_by.lstrip('-'))
             intersect(temp_id, {temp_id:0, order_clause: -1 if reverse else 1})
+            return pipe, intersect, temp_id
+        for fltr in filters:
+            if isinstance(fltr, Geofilter) and fltr.order:
+                # the distances were lost in any intersections after the
+                # geo search, so add them back
+                intersect(temp_id, {temp_id:0, temp_id + ':dist': fltr.order})
+                pipe.delete(temp_id + ':dist')
+                return pipe, intersect, temp_id
+        # the same unordered result order as the query script
+        by = _unordered_by(filters)
+        weights = {temp_id: 0}
+        if by:
+            weights['%s:%s:idx'%(self.namespace, by)] = 1
+        intersect(temp_id, weights)
+        return pipe, intersect, temp_id
 
-        # handle returning the temporary result key
-        if timeout is not None:
-            pipe.expire(temp_id, timeout)
-            pipe.execute()
-            return temp_id
-
-        offset = offset if offset is not None else 0
-        end = (offset + count - 1) if count and count > 0 else -1
-        pipe.zrange(temp_id, offset, end)
-        pipe.delete(temp_id)
-        return pipe.execute()[-2]
+    def _single_flight(self, conn, filters, order_by, hints, wait):
+        # Calculates the results of a query into a key shared by everyone
+        # running the same query at the same time, or waits for another caller
+        # to do so. Returns None if we gave up waiting.
+        digest = sha1(repr((filters, order_by)).encode('utf-8')).hexdigest()
+        key = '%s::sf:%s'%(self.namespace, digest)
+        done = key + ':done'
+        wait = max(int(math.ceil(wait)), 1)
+        if conn.exists(done):
+            return key
+        lock = Lock(conn, key, wait, wait)
+        if lock._acquire():
+            try:
+                # another caller may have finished between our check and the lock
+                if conn.exists(done):
+                    return key
+                pipe, intersect, temp_id = self._prepare_ordered(conn, filters, order_by, hints)
+                pipe.zunionstore(key, [temp_id])
+                pipe.delete(temp_id)
+                # the results outlive the marker, so they can be read by anyone
+                # who saw the marker (see _read_shared())
+                pipe.expire(key, 2 * wait)
+                pipe.setex(done, wait, 1)
+                pipe.execute()
+            finally:
+                lock.release()
+            return key
+
+        end = time.time() + wait
+        while time.time() < end:
+            time.sleep(.005)
+            if conn.exists(done):
+                return key
+        return None
+
+    def _read_shared(self, conn, key, read):
+        # Runs the commands added by read() against the single-flight results
+        # in key, returning their results, or None if the results have expired
+        # (an empty result doesn't have a key, so the marker is checked).
+        pipe = conn.pipeline(True)
+        pipe.exists(key + ':done')
+        read(pipe)
+        result = pipe.execute()
+        return result[1:] if result[0] else None
 
-    def count(self, conn, filters):
+    def count(self, conn, filters, hints=None, cache=None, single_flight=None):
         '''
         Returns the count of the items that match the provided filters.
 
         For the meaning of what the ``filters`` argument means, see the
         ``.search()`` method docs.
         '''
-        pipe, intersect, temp_id = self._prepare(conn, filters)
+        compiled = self._compile(filters, self.stats(conn), True, self.built(conn))
+        if compiled is not None:
+            if single_flight and not cache:
+                cache = {'ttl': single_flight, 'stale': 0}
+            return self._execute(conn, compiled, None, 'count', hints=hints, cache=cache, by=_unordered_by(filters))
+
+        key = single_flight and self._single_flight(conn, filters, None, hints, single_flight)
+        count = key and self._read_shared(conn, key, lambda pipe: pipe.zcard(key))
+        if count:
+            return count[0]
+        pipe, intersect, temp_id = self._prepare(conn, filters, hints)
         pipe.zcard(temp_id)
         pipe.delete(temp_id)
         return pipe.execute()[-2]
 
+    def explain(self, conn, filters, order_by, hints=None, analyze=False, offset=None, count=None):
+        '''
+        Returns a dictionary describing how a search with the provided
+        filters, order, and hints would be executed. See ``Query.explain()``.
+        '''
+        start = time.time()
+        compiled = self._compile(filters, self.stats(conn), True, self.built(conn))
+        if compiled is not None:
+            plan = self._execute(conn, compiled, order_by,
+                'analyze' if analyze else 'plan', offset, count, hints=hints, by=_unordered_by(filters))
+        else:
+            plan = self._explain_pipelined(conn, filters, order_by, hints, analyze)
+        plan['order_by'] = order_by
+        if analyze:
+            plan['time'] = time.time() - start
+        return plan
+
+    def _explain_pipelined(self, conn, filters, order_by, hints, analyze):
+        # Geo filters are executed by _prepare(), so re-create its plan
+        sizes = self._estimate_pipelined(conn.pipeline(True), filters, hints, self._lex(conn, filters),
+            self.bitmap & self.built(conn))
+        subrange = (hints or {}).get('subrange')
+        steps = []
+        for i, (j, size) in enumerate(sizes):
+            fltr = filters[j]
+            is_range = isinstance(fltr, tuple) and not isinstance(fltr, (Prefix, Suffix, Pattern, Ngram, Geofilter))
+            steps.append({
+                'filter': fltr,
+                'estimate': abs(size),
+                'stats': False,
+                'subrange': is_range and not i and (size < 0 if subrange is None else bool(subrange)),
+                'commands': 3 if is_range or isinstance(fltr, (list, Geofilter)) else 1,
+                'probe': False,
+            })
+        plan = {
+            'script': False,
+            'steps': steps,
+            'commands': sum(s['commands'] for s in steps) + 3,
+            'temp_keys': 1 + any(isinstance(f, (list, Geofilter, Prefix, Suffix, Pattern, Ngram)) for f in filters),
+            'empty': any(not s for j, s in sizes),
+            'walk': False,
+        }
+        if analyze:
+            self.count(conn, filters, hints)
+        return plan
+
+    def complete(self, conn, attr, prefix, limit=10, weight=None, columns=None):
+        '''
+        Returns the ids of up to ``limit`` entities with a word starting with
+        ``prefix`` in the prefix index of ``attr``, ordered by the matched
+        word, or by the numeric index ``weight`` (highest first). When
+        ``columns`` are provided, the raw data for those columns is returned
+        along with the ids. See ``Model.complete()``.
+        '''
+        if isinstance(prefix, six.binary_type):
+            prefix = prefix.decode('utf-8')
+        start, end = _start_end(prefix)
+        spec = {
+            'attr': attr,
+            'prefix': prefix,
+            'start_score': start,
+            'end_score': end,
+            'limit': max(int(limit), 0),
+            'weight': weight or False,
+            'budget': COMPLETE_BUDGET,
+            'columns': list(columns) if columns else False,
+        }
+        ids, rows = _complete_lua(conn, [self.namespace], [json.dumps(spec)])
+        if columns:
+            # missing columns come back as false from cjson
+            rows = json.loads(rows.decode() if six.PY3 else rows) if ids else []
+            return ids, [[None if v is False else v for v in row] for row in rows]
+        return ids
+
+STATS_REFRESH = 60.0
+
+TOP_K_LIMIT = 1000
+
+# the largest set index read (and sorted) in the query script for an
+# unordered single set filter, larger sets use temporary keys
+FAST_SET_LIMIT = 1000
+
+PROBE_RATIO = 20
+
+COMPLETE_BUDGET = 1000
+
+BM25_K1 = 1.2
+BM25_B = .75
+
+# None to use ZRANGESTORE for range filters when Redis supports it (6.2+)
+RANGE_STORE = None
+
+def _range_store(conn):
+    if RANGE_STORE is not None:
+        return RANGE_STORE
+    return _redis_version(conn) >= (6, 2)
+
+def _geo_search(conn):
+    return _redis_version(conn) >= (6, 2)
+
+def _negate(score):
+    # negates a score argument, keeping 'inf' and friends intact
+    return score[1:] if score.startswith('-') else '-' + score
+
+def _stats_estimate(fltr, stats):
+    # Estimates the number of items matched by a filter from the statistics
+    # written by update_index_stats(), returns False if unknown.
+    if isinstance(fltr, six.string_types):
+        attr, sep, term = fltr.partition(':')
+        st = stats.get(attr)
+        if not st:
+            return False
+        if not sep:
+            return st.get('card', False)
+        if 'terms' not in st:
+            return False
+        return max(st['terms'].get(term, st['other']), 1)
+    elif isinstance(fltr, list):
+        ests = [_stats_estimate(f, stats) for f in fltr]
+        return False if False in ests else sum(ests)
+    elif isinstance(fltr, tuple) and not isinstance(fltr, (Prefix, Suffix, Pattern, Ngram, Geofilter, Expression, Search, Phrase, Composite, InList)):
+        st = stats.get(fltr[0])
+        if not st or 'bounds' not in st:
+            return False
+        lo, lox = _parse_bound(fltr[1], float('-inf'))
+        hi, hix = _parse_bound(fltr[2], float('inf'))
+        bounds = st['bounds']
+        below = _histogram_fraction(bounds, lo, not lox)
+        upto = _histogram_fraction(bounds, hi, hix)
+        return max(int(round(st['card'] * max(upto - below, 0))), 1)
+    return False
+
+def _histogram_fraction(bounds, x, exclusive):
+    # Fraction of the items in an equi-depth histogram that are < x (or <= x
+    # when not exclusive), interpolating linearly inside buckets.
+    if exclusive:
+        j = bisect_left(bounds, x) - 1
+    else:
+        j = bisect_right(bounds, x) - 1
+    k = len(bounds) - 1
+    if j < 0:
+        return 0.0
+    if j >= k:
+        return 1.0
+    return (j + (x - bounds[j]) / float(bounds[j+1] - bounds[j])) / k
+
+_revalidating = set()
+_revalidating_lock = threading.Lock()
+
+def _revalidate(conn, keys, spec):
+    # Recalculates stale cached query results in the background, at most once
+    # at a time per cached query in this process.
+    ckey = keys[3]
+    with _revalidating_lock:
+        if ckey in _revalidating:
+            return
+        _revalidating.add(ckey)
+    spec = dict(spec, mode='count', cache=dict(spec['cache'], refresh=True))
+    temp_id = "%s:%s"%(keys[0], uuid.uuid4())
+    def run():
+        try:
+            _query_lua(conn, [keys[0], temp_id, temp_id + ':t'] + keys[3:], [json.dumps(spec)])
+        finally:
+            with _revalidating_lock:
+                _revalidating.discard(ckey)
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+
+def _unordered_by(filters):
+    # Without an explicit order, results are ordered by the last filter if it
+    # is a numeric range, otherwise by id (as strings)
+    filters = [f for f in filters if not (isinstance(f, list) and not f)]
+    if filters and isinstance(filters[-1], tuple) and not hasattr(filters[-1], '_fields'):
+        return filters[-1][0]
+    return None
+
+def _filter_attr(fltr):
+    if isinstance(fltr, six.string_types):
+        return fltr.partition(':')[0]
+    elif isinstance(fltr, list):
+        return _filter_attr(fltr[0])
+    elif isinstance(fltr, Geofilter):
+        return fltr.name
+    elif isinstance(fltr, (Prefix, Suffix, Pattern, Ngram, Search, Phrase, InList)):
+        return fltr.attr
+    elif isinstance(fltr, Composite):
+        return fltr.attrs[-1]
+    elif isinstance(fltr, Expression):
+        return None
+    return fltr[0]
+
+def _filter_attrs(fltr):
+    # All columns a filter (or filter expression) uses
+    if isinstance(fltr, Expression):
+        out = set()
+        for f in fltr.filters:
+            out.update(_filter_attrs(f))
+        return out
+    elif isinstance(fltr, Composite):
+        return set(fltr.attrs)
+    return set([_filter_attr(fltr)])
+
+def _hinted(filters, order):
+    # Returns the positions of the filters in the hinted order
+    out = []
+    for name in order or ():
+        for i, fltr in enumerate(filters):
+            if i not in out and _filter_attr(fltr) == name:
+                out.append(i)
+    return out
+
+def _score_arg(v, default):
+    # Score endpoint for ZCOUNT/ZRANGEBYSCORE, keeping any '(' prefix
+    if v is None:
+        return default
+    if isinstance(v, six.binary_type):
+        v = v.decode('latin-1')
+    return repr(v) if isinstance(v, float) else str(v)
+
+_query_lua = _script_load('''
+-- KEYS - {namespace, temp_key, temp_key2[, cache_key, cache_meta_key]}
+-- ARGV - {json query spec}
+local namespace = KEYS[1]
+local temp = KEYS[2]
+local temp2 = KEYS[3]
+local spec = cjson.decode(ARGV[1])
+local mode = spec.mode
+local CHUNK = 1000
+local WALK_CHUNK = 100
+
+-- check for cached results that are still valid
+local cache = spec.cache
+local ckey, cmeta, versions, now
+local cache_status = false
+if cache then
+    ckey, cmeta = KEYS[4], KEYS[5]
+    if redis.replicate_commands then
+        -- TIME is non-deterministic, only replicate the writes
+        redis.replicate_commands()
+    end
+    now = tonumber(redis.call('TIME')[1])
+    local current = redis.call('HMGET', namespace .. '::iver', unpack(cache.versions))
+    for i, v in ipairs(current) do
+        current[i] = v or '0'
+    end
+    versions = table.concat(current, ':')
+
+    local meta = redis.call('GET', cmeta)
+    if meta and not cache.refresh then
+        local sep = string.find(meta, '|', 1, true)
+        local age = now - tonumber(string.sub(meta, sep + 1))
+        if string.sub(meta, 1, sep - 1) == versions and age <= cache.ttl then
+            cache_status = 'hit'
+        elseif cache.stale > 0 and age <= cache.ttl + cache.stale then
+            cache_status = 'stale'
+        end
+    end
+end
+
+-- prefix indexes are kept for ZRANGEBYLEX once migrated
+local lex = redis.call('EXISTS', namespace .. '::lex') == 1
+local function lex_range(prefix)
+    if #prefix == 0 then
+        return '-', '+'
+    end
+    return '[' .. prefix, '(' .. prefix .. '\\255'
+end
+-- spec.order is {order_key, direction[, lex_key, attr]}, the lex key is
+-- only used for full-length string ordering once the prefix index exists
+local lex_order = lex and spec.order and spec.order[3] or false
+
+local function size(key)
+    local typ = redis.pcall('TYPE', key).ok
+    if typ == 'set' then
+        return tonumber(redis.call('SCARD', key))
+    elseif typ == 'zset' then
+        return tonumber(redis.call('ZCARD', key))
+    end
+    return 0
+end
+
+-- scratch keys for filter expressions
+local scratched = 0
+local function scratch()
+    scratched = scratched + 1
+    return temp .. ':e' .. scratched
+end
+
+-- Returns the bitmap of the entities matching a bits filter (any bitmap of
+-- every group), and the scratch keys to delete after using it.
+local function bitmap(f)
+    local ands, temps = {}, {}
+    for _, keys in ipairs(f[2]) do
+        if #keys == 1 then
+            table.insert(ands, keys[1])
+        else
+            local key = scratch()
+            redis.call('BITOP', 'OR', key, unpack(keys))
+            table.insert(ands, key)
+            table.insert(temps, key)
+        end
+    end
+    if #ands == 1 then
+        return ands[1], temps
+    end
+    local key = scratch()
+    redis.call('BITOP', 'AND', key, unpack(ands))
+    table.insert(temps, key)
+    return key, temps
+end
+
+local function drop(temps)
+    if #temps > 0 then
+        redis.call('DEL', unpack(temps))
+    end
+end
+
+-- adds the ids of the set bits of a bitmap to dest
+local function bitmap_ids(dest, key)
+    local length = tonumber(redis.call('STRLEN', key))
+    local args = {}
+    for offset = 0, length - 1, CHUNK do
+        local chunk = redis.call('GETRANGE', key, offset, offset + CHUNK - 1)
+        for i = 1, #chunk do
+            local byte = string.byte(chunk, i)
+            if byte ~= 0 then
+                -- SETBIT offsets start at the most significant bit
+                for j = 0, 7 do
+                    if bit.band(byte, bit.rshift(128, j)) ~= 0 then
+                        table.insert(args, 0)
+                        table.insert(args, string.format('%d', (offset + i - 1) * 8 + j))
+                    end
+                end
+                if #args >= 2 * CHUNK then
+                    redis.call('ZADD', dest, unpack(args))
+                    args = {}
+                end
+            end
+        end
+    end
+    if #args > 0 then
+        redis.call('ZADD', dest, unpack(args))
+    end
+end
+
+-- filters are one of:
+-- {'set', key}
+-- {'union', {key, ...}}
+-- {'range', key, min, max, remove_below, remove_above}
+-- {'prefix', key, start_score, end_score, prefix_or_pattern, is_pattern, lex_key, prefix}
+-- {'ngram', {trigram_key, ...}, pattern, attr}
+-- {'phrase', {word_key, ...}, positions_key, {word, ...}, within or false}
+-- {'text', {term_key, ...}, lengths_key, 'any' or 'all'} (after the others)
+-- {'in', key, {score, ...}}
+-- {'bits', {{bitmap_key, ...}, ...}} (in any bitmap of every group)
+-- {'or', {filter, ...}}
+-- {'and', {filter, ...}}
+-- {'not', filter} (never first)
+local function estimate(f)
+    local kind = f[1]
+    if kind == 'set' then
+        return size(f[2])
+    elseif kind == 'union' then
+        local total = 0
+        for _, key in ipairs(f[2]) do
+            total = total + size(key)
+        end
+        return total
+    elseif kind == 'ngram' or kind == 'phrase' then
+        -- candidates are in every trigram/word index
+        local smallest = math.huge
+        for _, key in ipairs(f[2]) do
+            smallest = math.min(smallest, size(key))
+        end
+        return smallest
+    elseif kind == 'text' then
+        local total, smallest = 0, math.huge
+        for _, key in ipairs(f[2]) do
+            local est = size(key)
+            total = total + est
+            smallest = math.min(smallest, est)
+        end
+        return f[4] == 'all' and smallest or total
+    elseif kind == 'or' then
+        local total = 0
+        for _, c in ipairs(f[2]) do
+            total = total + estimate(c)
+        end
+        return total
+    elseif kind == 'and' then
+        local smallest = nil
+        for _, c in ipairs(f[2]) do
+            if c[1] ~= 'not' then
+                local est = estimate(c)
+                smallest = smallest and math.min(smallest, est) or est
+            end
+        end
+        return smallest
+    elseif kind == 'not' then
+        return estimate(f[2])
+    elseif kind == 'range' then
+        return tonumber(redis.call('ZCOUNT', f[2], f[3], f[4]))
+    elseif kind == 'bits' then
+        local key, temps = bitmap(f)
+        local count = tonumber(redis.call('BITCOUNT', key))
+        drop(temps)
+        return count
+    elseif kind == 'in' then
+        -- scores are distinct, so this is exact
+        local total = 0
+        for _, score in ipairs(f[3]) do
+            total = total + tonumber(redis.call('ZCOUNT', f[2], score, score))
+        end
+        return total
+    elseif lex then
+        local min, max = lex_range(f[8])
+        return tonumber(redis.call('ZLEXCOUNT', f[7], min, max))
+    end
+    return tonumber(redis.call('ZCOUNT', f[2], f[3], '(' .. f[4]))
+end
+
+-- copies the items of a range filter into dest, with scores
+local function copy_range(dest, f)
+    if spec.rangestore then
+        -- Redis 6.2+
+        redis.call('ZRANGESTORE', dest, f[2], f[3], f[4], 'BYSCORE')
+        return
+    end
+    local count = tonumber(redis.call('ZCOUNT', f[2], f[3], f[4]))
+    local start = 0
+    if f[5] then
+        start = tonumber(redis.call('ZCOUNT', f[2], '-inf', f[5]))
+    end
+    local last = start + count
+    for i = start, last - 1, CHUNK do
+        local members = redis.call('ZRANGE', f[2], i, math.min(i + CHUNK, last) - 1, 'WITHSCORES')
+        for j = 1, #members, 2 do
+            members[j], members[j+1] = members[j+1], members[j]
+        end
+        if #members > 0 then
+            redis.call('ZADD', dest, unpack(members))
+        end
+    end
+end
+
+-- adds the ids with any of the scores of an in-list filter to dest
+local function copy_points(dest, f)
+    for _, score in ipairs(f[3]) do
+        local ids = redis.call('ZRANGEBYSCORE', f[2], score, score)
+        for i = 1, #ids, CHUNK do
+            local args = {}
+            for j = i, math.min(i + CHUNK - 1, #ids) do
+                table.insert(args, 0)
+                table.insert(args, ids[j])
+            end
+            redis.call('ZADD', dest, unpack(args))
+        end
+    end
+end
+
+-- adds the ids matching a prefix/suffix/pattern filter to dest
+local function scan_prefix(dest, f)
+    local key, match, is_pattern = f[2], f[5], f[6]
+    local psize = #match
+    local first, last
+    if lex then
+        -- every member of the range has the (full) prefix
+        key = f[7]
+        local min, max = lex_range(f[8])
+        first = #f[8] > 0 and tonumber(redis.call('ZLEXCOUNT', key, '-', '(' .. f[8])) or 0
+        last = first + tonumber(redis.call('ZLEXCOUNT', key, min, max))
+    else
+        first = tonumber(redis.call('ZCOUNT', key, '-inf', '(' .. f[3]))
+        last = first + tonumber(redis.call('ZCOUNT', key, f[3], '(' .. f[4]))
+    end
+    for i = first, last - 1, CHUNK do
+        local ids = {}
+        for _, v in ipairs(redis.call('ZRANGE', key, i, math.min(i + CHUNK, last) - 1)) do
+            local ok
+            if is_pattern then
+                ok = string.match(v, match)
+            else
+                ok = string.sub(v, 1, psize) == match
+            end
+            if ok then
+                local e = #v
+                while string.sub(v, e, e) ~= '\\0' do
+                    e = e - 1
+                end
+                table.insert(ids, 0)
+                table.insert(ids, string.sub(v, e + 1))
+            end
+        end
+        if #ids > 0 then
+            redis.call('ZADD', dest, unpack(ids))
+        end
+    end
+end
+
+-- arguments for ZUNIONSTORE/ZINTERSTORE of keys into dest, without scores
+local function union_args(dest, keys)
+    local args = {dest, #keys}
+    for _, key in ipairs(keys) do
+        table.insert(args, key)
+    end
+    table.insert(args, 'WEIGHTS')
+    for _ in ipairs(keys) do
+        table.insert(args, 0)
+    end
+    return args
+end
+
+-- whether any of an entity's words in the prefix index match an ngram
+-- filter's pattern
+local function ngram_match(f, id)
+    local idata = redis.call('HGET', namespace .. '::', id)
+    if not idata then
+        return false
+    end
+    for _, data in ipairs(cjson.decode(idata)[3] or {}) do
+        if data[1] == f[4] and string.match(data[2] .. '\0' .. id, f[3]) then
+            return true
+        end
+    end
+    return false
+end
+
+-- whether the words of a phrase filter are in order (or for 2 words, within
+-- the given distance of each other) in an entity's positional index data
+local function phrase_match(f, id)
+    local data = redis.call('HGET', f[3], id)
+    if not data then
+        return false
+    end
+    local positions = cjson.decode(data)
+    local words, within = f[4], f[5]
+    local at = {}
+    for i, word in ipairs(words) do
+        at[i] = {}
+        for _, p in ipairs(positions[word] or {}) do
+            at[i][p] = true
+        end
+    end
+    for _, p in ipairs(positions[words[1]] or {}) do
+        if within then
+            for d = 1, within do
+                if at[2][p - d] or at[2][p + d] then
+                    return true
+                end
+            end
+        else
+            local ok = true
+            for i = 2, #words do
+                if not at[i][p + i - 1] then
+                    ok = false
+                    break
+                end
+            end
+            if ok then
+                return true
+            end
+        end
+    end
+    return false
+end
+
+-- checks a candidate of an ngram or phrase filter
+local function verify(f, id)
+    if f[1] == 'phrase' then
+        return phrase_match(f, id)
+    end
+    return ngram_match(f, id)
+end
+
+-- removes the ids that fail the test from key
+local function keep(key, test)
+    local remove = {}
+    for _, id in ipairs(redis.call('ZRANGE', key, 0, -1)) do
+        if not test(id) then
+            table.insert(remove, id)
+        end
+    end
+    for i = 1, #remove, CHUNK do
+        redis.call('ZREM', key, unpack(remove, i, math.min(i + CHUNK - 1, #remove)))
+    end
+end
+
+-- intersects the trigram/word indexes (and key, if given) into dest, then
+-- verifies the candidates
+local function scan_verified(dest, f, key)
+    local keys = f[2]
+    if key then
+        keys = {key, unpack(f[2])}
+    end
+    redis.call('ZINTERSTORE', unpack(union_args(dest, keys)))
+    keep(dest, function(id) return verify(f, id) end)
+end
+
+-- Range filters leave their scores in the result, every other filter clears
+-- them. scored_by tracks which filter the current scores came from.
+local scored_by = 0
+-- whether the current scores are (summed) text search scores
+local ranked = false
+-- whether to pull a sub-range for a range filter applied first
+local function use_subrange(f, est)
+    if spec.subrange == 1 then
+        return true
+    elseif spec.subrange == -1 then
+        return false
+    elseif spec.rangestore then
+        -- only reads the range, never slower than copying the whole index
+        return true
+    end
+    return est * 2 < size(f[2])
+end
+
+-- Stores the BM25 scores of the documents matching a text search in dest,
+-- only scoring the documents in key (when provided). Term indexes hold term
+-- frequencies, and the lengths index the number of words in each document.
+-- The median length stands in for the average length.
+local function rank(dest, f, key)
+    local lengths = f[3]
+    local n = tonumber(redis.call('ZCARD', lengths))
+    redis.call('DEL', dest)
+    if n == 0 then
+        return
+    end
+    local k1, b = spec.bm25[1], spec.bm25[2]
+    local mid = math.floor(n / 2)
+    local avg = math.max(tonumber(redis.call('ZRANGE', lengths, mid, mid, 'WITHSCORES')[2]), 1)
+    -- term frequencies and lengths are read together as tf * scale + length
+    local scale = tonumber(redis.call('ZREVRANGE', lengths, 0, 0, 'WITHSCORES')[2]) + 1
+    local candidates = key
+    if f[4] == 'all' then
+        candidates = scratch()
+        local keys = {unpack(f[2])}
+        if key then
+            table.insert(keys, key)
+        end
+        redis.call('ZINTERSTORE', unpack(union_args(candidates, keys)))
+    end
+
+    local scored, weights = {}, {}
+    for _, term in ipairs(f[2]) do
+        local df = size(term)
+        if df > 0 then
+            local both = scratch()
+            if candidates then
+                redis.call('ZINTERSTORE', both, 3, term, lengths, candidates, 'WEIGHTS', scale, 1, 0)
+            else
+                redis.call('ZINTERSTORE', both, 2, term, lengths, 'WEIGHTS', scale, 1)
+            end
+            local out = scratch()
+            local last = tonumber(redis.call('ZCARD', both))
+            for i = 0, last - 1, CHUNK do
+                local items = redis.call('ZRANGE', both, i, i + CHUNK - 1, 'WITHSCORES')
+                local args = {}
+                for j = 1, #items, 2 do
+                    local v = tonumber(items[j+1])
+                    local len = v % scale
+                    local tf = (v - len) / scale
+                    table.insert(args, tf * (k1 + 1) / (tf + k1 * (1 - b + b * len / avg)))
+                    table.insert(args, items[j])
+                end
+                redis.call('ZADD', out, unpack(args))
+            end
+            redis.call('DEL', both)
+            if last > 0 then
+                table.insert(scored, out)
+                table.insert(weights, math.log(1 + (n - df + 0.5) / (df + 0.5)))
+            end
+        end
+    end
+    if candidates and candidates ~= key then
+        redis.call('DEL', candidates)
+    end
+    if #scored > 0 then
+        local args = union_args(dest, scored)
+        for i, weight in ipairs(weights) do
+            args[#scored + 3 + i] = weight
+        end
+        redis.call('ZUNIONSTORE', unpack(args))
+        redis.call('DEL', unpack(scored))
+    end
+end
+
+-- stores the ids matching a filter (or filter expression) in dest, with
+-- scores of 0, smallest filters first inside each expression
+local store
+
+-- removes the ids matching a filter from dest
+local function subtract(dest, f)
+    local key = f[2]
+    if f[1] ~= 'set' then
+        key = scratch()
+        store(key, f)
+    end
+    local ok = redis.pcall('ZDIFFSTORE', dest, 2, dest, key)
+    if type(ok) == 'table' and ok.err then
+        -- ZDIFFSTORE needs Redis 6.2+, remove the common ids instead
+        local common = scratch()
+        redis.call('ZINTERSTORE', common, 2, dest, key, 'WEIGHTS', 0, 0)
+        local ids = redis.call('ZRANGE', common, 0, -1)
+        for i = 1, #ids, CHUNK do
+            redis.call('ZREM', dest, unpack(ids, i, math.min(i + CHUNK - 1, #ids)))
+        end
+        redis.call('DEL', common)
+    end
+    if key ~= f[2] then
+        redis.call('DEL', key)
+    end
+end
+
+store = function(dest, f)
+    local kind = f[1]
+    if kind == 'set' then
+        redis.call('ZUNIONSTORE', dest, 1, f[2], 'WEIGHTS', 0)
+    elseif kind == 'union' then
+        redis.call('ZUNIONSTORE', unpack(union_args(dest, f[2])))
+    elseif kind == 'range' then
+        redis.call('DEL', dest)
+        copy_range(dest, f)
+        redis.call('ZUNIONSTORE', dest, 1, dest, 'WEIGHTS', 0)
+    elseif kind == 'prefix' then
+        redis.call('DEL', dest)
+        scan_prefix(dest, f)
+    elseif kind == 'in' then
+        redis.call('DEL', dest)
+        copy_points(dest, f)
+    elseif kind == 'bits' then
+        redis.call('DEL', dest)
+        local key, temps = bitmap(f)
+        bitmap_ids(dest, key)
+        drop(temps)
+    elseif kind == 'ngram' or kind == 'phrase' then
+        scan_verified(dest, f)
+    elseif kind == 'or' then
+        -- plain indexes are unioned directly
+        local keys, temps = {}, {}
+        for _, c in ipairs(f[2]) do
+            if c[1] == 'set' then
+                table.insert(keys, c[2])
+            elseif c[1] == 'union' then
+                for _, key in ipairs(c[2]) do
+                    table.insert(keys, key)
+                end
+            else
+                local key = scratch()
+                store(key, c)
+                table.insert(keys, key)
+                table.insert(temps, key)
+            end
+        end
+        redis.call('ZUNIONSTORE', unpack(union_args(dest, keys)))
+        if #temps > 0 then
+            redis.call('DEL', unpack(temps))
+        end
+    elseif kind == 'and' then
+        local children = {}
+        for i, c in ipairs(f[2]) do
+            children[i] = {c[1] == 'not' and math.huge or estimate(c), i, c}
+        end
+        table.sort(children, function(a, b)
+            return a[1] < b[1] or (a[1] == b[1] and a[2] < b[2])
+        end)
+        for i, child in ipairs(children) do
+            local c = child[3]
+            if i == 1 then
+                store(dest, c)
+            elseif c[1] == 'not' then
+                subtract(dest, c[2])
+            elseif c[1] == 'set' then
+                redis.call('ZINTERSTORE', dest, 2, dest, c[2], 'WEIGHTS', 0, 0)
+            else
+                local key = scratch()
+                store(key, c)
+                redis.call('ZINTERSTORE', dest, 2, dest, key, 'WEIGHTS', 0, 0)
+                redis.call('DEL', key)
+            end
+            if tonumber(redis.call('ZCARD', dest)) == 0 then
+                return
+            end
+        end
+    end
+end
+
+local function apply(f, est, first, i)
+    local kind = f[1]
+    scored_by = kind == 'range' and i or 0
+    if kind == 'set' then
+        if first then
+            redis.call('ZUNIONSTORE', temp, 1, f[2], 'WEIGHTS', 0)
+        else
+            redis.call('ZINTERSTORE', temp, 2, temp, f[2], 'WEIGHTS', 0, 0)
+        end
+    elseif kind == 'union' then
+        if first then
+            redis.call('ZUNIONSTORE', unpack(union_args(temp, f[2])))
+        else
+            redis.call('ZUNIONSTORE', unpack(union_args(temp2, f[2])))
+            redis.call('ZINTERSTORE', temp, 2, temp, temp2, 'WEIGHTS', 0, 0)
+            redis.call('DEL', temp2)
+        end
+    elseif kind == 'range' then
+        if first and use_subrange(f, est) then
+            -- cheaper to pull the sub-range than to copy the whole index
+            copy_range(temp, f)
+            return
+        elseif first then
+            redis.call('ZUNIONSTORE', temp, 1, f[2])
+        else
+            redis.call('ZINTERSTORE', temp, 2, temp, f[2], 'WEIGHTS', 0, 1)
+        end
+        if f[5] then
+            redis.call('ZREMRANGEBYSCORE', temp, '-inf', f[5])
+        end
+        if f[6] then
+            redis.call('ZREMRANGEBYSCORE', temp, f[6], 'inf')
+        end
+    elseif kind == 'not' then
+        subtract(temp, f[2])
+    elseif kind == 'ngram' or kind == 'phrase' then
+        scan_verified(temp, f, not first and temp)
+    elseif kind == 'text' then
+        if first then
+            rank(temp, f)
+        else
+            -- scores from earlier text searches are summed
+            rank(temp2, f, temp)
+            redis.call('ZINTERSTORE', temp, 2, temp, temp2, 'WEIGHTS', ranked and 1 or 0, 1)
+            redis.call('DEL', temp2)
+        end
+        ranked = true
+    elseif kind == 'or' or kind == 'and' or kind == 'in' or kind == 'bits' then
+        if first then
+            store(temp, f)
+        else
+            store(temp2, f)
+            redis.call('ZINTERSTORE', temp, 2, temp, temp2, 'WEIGHTS', 0, 0)
+            redis.call('DEL', temp2)
+        end
+    elseif first then
+        scan_prefix(temp, f)
+    else
+        scan_prefix(temp2, f)
+        redis.call('ZINTERSTORE', temp, 2, temp, temp2, 'WEIGHTS', 0, 0)
+        redis.call('DEL', temp2)
+    end
+end
+
+-- the full value of the ordered column for an entity, from the index data
+local function order_value(id)
+    local idata = redis.call('HGET', namespace .. '::', id)
+    if idata then
+        for _, data in ipairs(cjson.decode(idata)[3] or {}) do
+            if data[1] == spec.order[4] then
+                return data[2]
+            end
+        end
+    end
+    return ''
+end
+
+-- sorts {id, score, ...} items by score, then by full value (in the order
+-- direction), then by id, only reading the values of tied scores
+local function lex_sort(items)
+    local ties, rows = {}, {}
+    for i = 2, #items, 2 do
+        ties[items[i]] = (ties[items[i]] or 0) + 1
+    end
+    for i = 1, #items, 2 do
+        local score = items[i+1]
+        table.insert(rows, {items[i], tonumber(score), ties[score] > 1 and order_value(items[i]) or ''})
+    end
+    local desc = spec.order[2] == -1
+    table.sort(rows, function(a, b)
+        if a[2] ~= b[2] then
+            return a[2] < b[2]
+        elseif a[3] ~= b[3] then
+            return (a[3] < b[3]) ~= desc
+        end
+        return a[1] < b[1]
+    end)
+    return rows
+end
+
+-- rescores the items of key by their position in full value order
+local function relex(key)
+    local rows = lex_sort(redis.call('ZRANGE', key, 0, -1, 'WITHSCORES'))
+    for i = 1, #rows, CHUNK do
+        local args = {}
+        for j = i, math.min(i + CHUNK - 1, #rows) do
+            table.insert(args, j - 1)
+            table.insert(args, rows[j][1])
+        end
+        redis.call('ZADD', key, unpack(args))
+    end
+end
+
+-- returns ids, or ids and entity data, depending on the mode
+local function results(ids)
+    if mode == 'data' then
+        local out = {}
+        for _, id in ipairs(ids) do
+            table.insert(out, id)
+            table.insert(out, redis.call('HGETALL', namespace .. ':' .. id))
+        end
+        return out
+    end
+    return ids
+end
+
+-- scores are passed around as strings to keep their precision
+local function negate(score)
+    if string.sub(score, 1, 1) == '-' then
+        return string.sub(score, 2)
+    end
+    return '-' .. score
+end
+
+-- returns the start and stop positions of the requested page of a result
+-- ZSET, after any cursor, or nil if there is nothing before a 'before' cursor
+local function page_bounds(key)
+    local start, stop = spec.start, spec.stop
+    local c = spec.cursor
+    if not c then
+        return start, stop
+    end
+    -- count the items ordered before the cursor, which may be gone
+    local n
+    local score = redis.call('ZSCORE', key, c[2])
+    if score and tonumber(score) == tonumber(c[1]) then
+        n = tonumber(redis.call('ZRANK', key, c[2]))
+        if c[3] == 1 then
+            n = n + 1
+        end
+    else
+        n = tonumber(redis.call('ZCOUNT', key, '-inf', '(' .. c[1]))
+        for _, id in ipairs(redis.call('ZRANGEBYSCORE', key, c[1], c[1])) do
+            if id < c[2] then
+                n = n + 1
+            end
+        end
+    end
+    if c[3] == 1 then
+        return n + start, stop < 0 and -1 or n + stop
+    end
+    -- the page ends just before the cursor
+    local last = n - 1 - start
+    if last < 0 then
+        return nil
+    elseif stop < 0 then
+        return 0, last
+    end
+    return math.max(0, last - (stop - start)), last
+end
+
+-- returns results, along with their scores for paging
+local function paged(ids, scores)
+    if spec.page then
+        return {results(ids), scores}
+    end
+    return results(ids)
+end
+
+-- returns the requested results from a finished result ZSET
+local function finish(key)
+    if mode == 'key' then
+        if key ~= temp then
+            -- callers can expire or delete the key, so they get their own copy
+            -- of shared (cached) results
+            redis.call('ZUNIONSTORE', temp, 1, key)
+        end
+        redis.call('EXPIRE', temp, spec.ttl)
+        return 1
+    elseif mode == 'count' then
+        return redis.call('ZCARD', key)
+    end
+    if lex_order and key == temp then
+        -- only the scores tied with the ends of the page need full values
+        local ends = redis.call('ZRANGE', key, spec.start, spec.stop, 'WITHSCORES')
+        if #ends == 0 then
+            return results({})
+        end
+        local before = tonumber(redis.call('ZCOUNT', key, '-inf', '(' .. ends[2]))
+        local rows = lex_sort(redis.call('ZRANGEBYSCORE', key, ends[2], ends[#ends], 'WITHSCORES'))
+        local ids = {}
+        local last = spec.stop < 0 and #rows or math.min(#rows, spec.stop - before + 1)
+        for i = spec.start - before + 1, last do
+            table.insert(ids, rows[i][1])
+        end
+        return results(ids)
+    end
+    local start, stop = page_bounds(key)
+    if not start then
+        return paged({}, {})
+    elseif not spec.page then
+        return results(redis.call('ZRANGE', key, start, stop))
+    end
+    local ids, scores = {}, {}
+    local items = redis.call('ZRANGE', key, start, stop, 'WITHSCORES')
+    for i = 1, #items, 2 do
+        table.insert(ids, items[i])
+        table.insert(scores, items[i+1])
+    end
+    return paged(ids, scores)
+end
+
+-- cached results are kept in a ZSET, along with a string holding the index
+-- versions and time the results were calculated at
+local function store_cache()
+    if redis.call('EXISTS', temp) == 1 then
+        redis.call('RENAME', temp, ckey)
+        redis.call('EXPIRE', ckey, cache.ttl + cache.stale)
+    else
+        redis.call('DEL', ckey)
+    end
+    redis.call('SET', cmeta, versions .. '|' .. now, 'EX', cache.ttl + cache.stale)
+end
+
+local function empty()
+    redis.call('DEL', temp)
+    if cache then
+        store_cache()
+        return {'miss', finish(ckey)}
+    elseif mode == 'count' then
+        return 0
+    end
+    return paged({}, {})
+end
+
+if cache_status then
+    return {cache_status, finish(ckey)}
+end
+
+-- Queries over a single index (and counts) can be answered directly from the
+-- index, without temporary keys. Returns nil when there is no fast path.
+local function fast_path()
+    local filters = spec.filters
+    if cache or #filters > 1 or spec.start < 0 or (mode ~= 'ids' and mode ~= 'data' and mode ~= 'count') then
+        return nil
+    end
+    local count = spec.stop < 0 and -1 or (spec.stop - spec.start + 1)
+    local f = filters[1]
+    if not f then
+        -- only ordering
+        if mode ~= 'count' and spec.order and spec.order[2] == 1 and not lex_order then
+            return finish(spec.order[1])
+        end
+    elseif spec.page then
+        return nil
+    elseif f[1] == 'set' then
+        if mode == 'count' then
+            return size(f[2])
+        elseif spec.order or spec.by then
+            return nil
+        end
+        local typ = redis.pcall('TYPE', f[2]).ok
+        if typ == 'none' then
+            return {}
+        elseif typ ~= 'set' or tonumber(redis.call('SCARD', f[2])) > spec.fast_set then
+            -- sorting large sets here would block Redis for too long
+            return nil
+        end
+        -- same as the id (string) order of an intersection
+        local ids = redis.call('SMEMBERS', f[2])
+        table.sort(ids)
+        local last = count < 0 and #ids or math.min(#ids, spec.start + count)
+        local page = {}
+        for i = spec.start + 1, last do
+            table.insert(page, ids[i])
+        end
+        return results(page)
+    elseif (f[1] == 'in' or f[1] == 'bits') and mode == 'count' then
+        return estimate(f)
+    elseif f[1] == 'range' then
+        if mode == 'count' then
+            return redis.call('ZCOUNT', f[2], f[3], f[4])
+        elseif spec.order and (spec.order[1] ~= f[2] or spec.order[2] ~= 1) then
+            return nil
+        elseif not spec.order and spec.by ~= f[2] then
+            return nil
+        end
+        return results(redis.call('ZRANGEBYSCORE', f[2], f[3], f[4], 'LIMIT', spec.start, count))
+    end
+    return nil
+end
+
+local fast = fast_path()
+if fast then
+    return fast
+end
+
+-- roughly how many commands applying a filter takes
+local function commands(f, est, first)
+    local kind = f[1]
+    local chunks = math.ceil(est / CHUNK)
+    if kind == 'set' then
+        return 2
+    elseif kind == 'union' then
+        return first and 2 or 4
+    elseif kind == 'range' then
+        if first and use_subrange(f, est) then
+            return spec.rangestore and 1 or 3 + 2 * chunks
+        end
+        return 2 + (f[5] and 1 or 0) + (f[6] and 1 or 0)
+    elseif kind == 'ngram' or kind == 'phrase' then
+        -- one check per candidate
+        return 2 + est
+    elseif kind == 'text' then
+        return 6 + #f[2] * (4 + chunks)
+    elseif kind == 'or' or kind == 'and' then
+        return 3 * #f[2] + (first and 0 or 2)
+    elseif kind == 'in' then
+        return 1 + #f[3] + chunks + (first and 0 or 2)
+    elseif kind == 'bits' then
+        return 2 + #f[2] + chunks + (first and 0 or 2)
+    elseif kind == 'not' then
+        return 3
+    end
+    return 3 + 2 * chunks + (first and 0 or 2)
+end
+
+-- estimate the work for each filter (unless we have estimates from index
+-- statistics), bailing out if anything is empty
+local plan = {}
+local is_empty = false
+for i, f in ipairs(spec.filters) do
+    local est = spec.estimates[i]
+    local from_stats = est and true or false
+    if not est then
+        est = estimate(f)
+        is_empty = is_empty or (est == 0 and f[1] ~= 'not')
+    end
+    plan[i] = {est, i, f, from_stats}
+end
+
+-- hinted filters go first, in the hinted order, the rest smallest first
+local hinted = {}
+for r, i in ipairs(spec.hint or {}) do
+    hinted[i] = r
+end
+table.sort(plan, function(a, b)
+    -- negations are subtracted from the rest, so they go last, after text
+    -- searches (which only score what the other filters matched)
+    local na, nb = a[3][1] == 'not', b[3][1] == 'not'
+    if na ~= nb then
+        return nb
+    end
+    local ta, tb = a[3][1] == 'text', b[3][1] == 'text'
+    if ta ~= tb then
+        return tb
+    end
+    local ha, hb = hinted[a[2]], hinted[b[2]]
+    if ha or hb then
+        return (ha or math.huge) < (hb or math.huge)
+    end
+    return a[1] < b[1] or (a[1] == b[1] and a[2] < b[2])
+end)
+
+-- Ordered queries with small limits can walk the order index in order,
+-- checking each item against the filters, and stop after finding enough.
+local function score_num(v)
+    if v == 'inf' or v == '+inf' then
+        return math.huge
+    elseif v == '-inf' then
+        return -math.huge
+    end
+    return tonumber(v)
+end
+
+local function bound(v)
+    if string.sub(v, 1, 1) == '(' then
+        return score_num(string.sub(v, 2)), true
+    end
+    return score_num(v), false
+end
+
+local function member_test(f)
+    local kind = f[1]
+    if kind == 'set' or kind == 'union' then
+        local keys = kind == 'set' and {f[2]} or f[2]
+        local tests = {}
+        for i, key in ipairs(keys) do
+            if redis.pcall('TYPE', key).ok == 'set' then
+                tests[i] = function(id) return redis.call('SISMEMBER', key, id) == 1 end
+            else
+                tests[i] = function(id) return redis.call('ZSCORE', key, id) ~= false end
+            end
+        end
+        return function(id)
+            for _, test in ipairs(tests) do
+                if test(id) then
+                    return true
+                end
+            end
+            return false
+        end
+    elseif kind == 'range' then
+        local lo, lox = bound(f[3])
+        local hi, hix = bound(f[4])
+        return function(id)
+            local score = redis.call('ZSCORE', f[2], id)
+            if not score then
+                return false
+            end
+            score = score_num(score)
+            return (score > lo or (score == lo and not lox)) and
+                (score < hi or (score == hi and not hix))
+        end
+    elseif kind == 'bits' then
+        return function(id)
+            for _, keys in ipairs(f[2]) do
+                local found = false
+                for _, key in ipairs(keys) do
+                    if redis.call('GETBIT', key, id) == 1 then
+                        found = true
+                        break
+                    end
+                end
+                if not found then
+                    return false
+                end
+            end
+            return true
+        end
+    elseif kind == 'in' then
+        local scores = {}
+        for _, score in ipairs(f[3]) do
+            scores[tonumber(score)] = true
+        end
+        return function(id)
+            local score = redis.call('ZSCORE', f[2], id)
+            return score ~= false and scores[tonumber(score)] == true
+        end
+    elseif kind == 'ngram' or kind == 'phrase' then
+        local tests = {}
+        for i, key in ipairs(f[2]) do
+            tests[i] = member_test({'set', key})
+        end
+        return function(id)
+            for _, test in ipairs(tests) do
+                if not test(id) then
+                    return false
+                end
+            end
+            return verify(f, id)
+        end
+    elseif kind == 'not' then
+        local test = member_test(f[2])
+        return function(id) return not test(id) end
+    elseif kind == 'or' or kind == 'and' then
+        local tests = {}
+        for i, c in ipairs(f[2]) do
+            tests[i] = member_test(c)
+        end
+        local any = kind == 'or'
+        return function(id)
+            for _, test in ipairs(tests) do
+                if test(id) == any then
+                    return any
+                end
+            end
+            return not any
+        end
+    end
+end
+
+-- whether member_test() can check a filter
+local function walkable(f)
+    if f[1] == 'prefix' or f[1] == 'text' then
+        return false
+    elseif f[1] == 'not' then
+        return walkable(f[2])
+    elseif f[1] == 'or' or f[1] == 'and' then
+        for _, c in ipairs(f[2]) do
+            if not walkable(c) then
+                return false
+            end
+        end
+    end
+    return true
+end
+
+-- returns how many items of the order index we are willing to check, or nil
+-- if we shouldn't walk the order index
+local function walk_budget()
+    if cache or not spec.order or spec.stop < 0 or (#plan == 0 and not lex_order) or spec.walk == -1 then
+        return nil
+    elseif spec.cursor and spec.cursor[3] ~= 1 then
+        return nil
+    end
+    local k = spec.stop + 1
+    if k > spec.topk then
+        return nil
+    elseif #plan == 0 then
+        return math.huge
+    end
+    for _, p in ipairs(plan) do
+        if not walkable(p[3]) then
+            return nil
+        end
+    end
+    if spec.walk == 1 then
+        return math.huge
+    end
+    -- assuming independence, we expect to check total / smallest items per
+    -- match, vs. intersecting everything and ordering the result
+    local total = tonumber(redis.call('ZCARD', spec.order[1]))
+    local smallest = math.huge
+    for _, p in ipairs(plan) do
+        if p[3][1] ~= 'not' then
+            smallest = math.min(smallest, math.max(p[1], 1))
+        end
+    end
+    local expected = k * total / smallest
+    if expected * #plan > smallest * (#plan + 1) then
+        return nil
+    end
+    return 2 * expected + WALK_CHUNK
+end
+
+local function walk(budget)
+    local k = spec.stop + 1
+    local tests = {}
+    for i, p in ipairs(plan) do
+        tests[i] = member_test(p[3])
+    end
+    local dir = spec.order[2]
+    local c = spec.cursor
+    local found, scores = {}, {}
+    -- Items with the same score are checked in id order, which is the order
+    -- of an intersection (for either direction).
+    local group, group_score = {}, nil
+    local function flush()
+        table.sort(group)
+        local score = dir == 1 and group_score or (group_score and negate(group_score))
+        local skip = c and tonumber(score) == tonumber(c[1])
+        for _, id in ipairs(group) do
+            if #found >= k then
+                break
+            end
+            local ok = not (skip and id <= c[2])
+            for _, test in ipairs(tests) do
+                if not test(id) then
+                    ok = false
+                    break
+                end
+            end
+            if ok then
+                table.insert(found, id)
+                table.insert(scores, score)
+            end
+        end
+        group = {}
+    end
+
+    local cmd = dir == 1 and 'ZRANGE' or 'ZREVRANGE'
+    local pos = 0
+    if c and dir == 1 then
+        pos = tonumber(redis.call('ZCOUNT', spec.order[1], '-inf', '(' .. c[1]))
+    elseif c then
+        pos = tonumber(redis.call('ZCOUNT', spec.order[1], '(' .. negate(c[1]), 'inf'))
+    end
+    local walked = 0
+    while true do
+        local chunk = redis.call(cmd, spec.order[1], pos, pos + WALK_CHUNK - 1, 'WITHSCORES')
+        for j = 1, #chunk, 2 do
+            if chunk[j+1] ~= group_score then
+                flush()
+                if #found >= k then
+                    return found, scores
+                end
+                group_score = chunk[j+1]
+            end
+            table.insert(group, chunk[j])
+        end
+        pos = pos + WALK_CHUNK
+        walked = walked + WALK_CHUNK
+        if #chunk < 2 * WALK_CHUNK then
+            break
+        elseif walked >= budget then
+            -- too many non-matching items, intersect instead
+            return nil
+        end
+    end
+    flush()
+    return found, scores
+end
+
+-- Walks the lexicographic prefix index in full value order instead of the
+-- order index, with ids of equal values checked in id order.
+local function lex_walk(budget)
+    local k = spec.stop + 1
+    local tests = {}
+    for i, p in ipairs(plan) do
+        tests[i] = member_test(p[3])
+    end
+    local found = {}
+    local group, group_value = {}, nil
+    local function flush()
+        table.sort(group)
+        for _, id in ipairs(group) do
+            if #found >= k then
+                break
+            end
+            local ok = true
+            for _, test in ipairs(tests) do
+                if not test(id) then
+                    ok = false
+                    break
+                end
+            end
+            if ok then
+                table.insert(found, id)
+            end
+        end
+        group = {}
+    end
+
+    local cmd = spec.order[2] == 1 and 'ZRANGE' or 'ZREVRANGE'
+    local pos = 0
+    while true do
+        local chunk = redis.call(cmd, lex_order, pos, pos + WALK_CHUNK - 1)
+        for _, v in ipairs(chunk) do
+            local e = #v
+            while string.sub(v, e, e) ~= '\\0' do
+                e = e - 1
+            end
+            local value = string.sub(v, 1, e - 1)
+            if value ~= group_value then
+                flush()
+                if #found >= k then
+                    return found, {}
+                end
+                group_value = value
+            end
+            table.insert(group, string.sub(v, e + 1))
+        end
+        pos = pos + WALK_CHUNK
+        if #chunk < WALK_CHUNK then
+            break
+        elseif pos >= budget then
+            return nil
+        end
+    end
+    flush()
+    return found, {}
+end
+
+-- When the results so far are much smaller than a filter that would need
+-- to be copied into a temporary key (unions, expressions), check each result
+-- against the filter instead.
+local PROBED = {union = true, ['in'] = true, bits = true, ['or'] = true, ['and'] = true, ['not'] = true}
+local function use_probe(f, est, current)
+    if spec.probe == -1 or not PROBED[f[1]] or not walkable(f) then
+        return false
+    elseif spec.probe == 1 then
+        return true
+    end
+    return current * spec.probe_ratio < est
+end
+
+local function probe(f)
+    keep(temp, member_test(f))
+end
+
+-- applies the i'th filter of the plan, returns whether it was probed
+local function run_step(p, i)
+    if i > 1 and use_probe(p[3], p[1], tonumber(redis.call('ZCARD', temp))) then
+        probe(p[3])
+        return true
+    end
+    apply(p[3], p[1], i == 1, p[2])
+    return false
+end
+
+if mode == 'plan' or mode == 'analyze' then
+    local steps = {}
+    local total = 3
+    local temps = 1
+    local current = math.huge
+    for i, p in ipairs(plan) do
+        local f = p[3]
+        local step = {filter = p[2], kind = f[1], index = f[2], estimate = p[1],
+            stats = p[4], commands = commands(f, p[1], i == 1),
+            subrange = i == 1 and f[1] == 'range' and use_subrange(f, p[1]),
+            probe = i > 1 and use_probe(f, p[1], current)}
+        if step.probe then
+            step.commands = 2 + math.ceil(current / CHUNK)
+        elseif i > 1 and (f[1] == 'union' or f[1] == 'prefix' or f[1] == 'text') then
+            temps = 2
+        end
+        if f[1] ~= 'not' then
+            current = math.min(current, p[1])
+        end
+        total = total + step.commands
+        steps[i] = step
+    end
+    if spec.order then
+        total = total + 1
+    end
+    local out = {steps = steps, commands = total, temp_keys = temps, empty = is_empty,
+        walk = walk_budget() ~= nil}
+    if mode == 'analyze' and not is_empty then
+        if redis.replicate_commands then
+            -- TIME is non-deterministic, only replicate the writes
+            redis.replicate_commands()
+        end
+        redis.call('DEL', temp)
+        local now = redis.call('TIME')
+        for i, p in ipairs(plan) do
+            steps[i].probe = run_step(p, i)
+            local after = redis.call('TIME')
+            steps[i].size = tonumber(redis.call('ZCARD', temp))
+            steps[i].usec = (after[1] - now[1]) * 1000000 + (after[2] - now[2])
+            now = after
+            if steps[i].size == 0 then
+                break
+            end
+        end
+        redis.call('DEL', temp)
+    end
+    return cjson.encode(out)
+end
+
+if is_empty then
+    return empty()
+end
+
+local budget = (mode == 'ids' or mode == 'data') and walk_budget()
+if budget then
+    local found, scores
+    if lex_order then
+        found, scores = lex_walk(budget)
+    else
+        found, scores = walk(budget)
+    end
+    if found then
+        local ids, page_scores = {}, {}
+        for i = spec.start + 1, #found do
+            table.insert(ids, found[i])
+            table.insert(page_scores, scores[i])
+        end
+        return paged(ids, page_scores)
+    end
+end
+
+redis.call('DEL', temp)
+for i, p in ipairs(plan) do
+    run_step(p, i)
+    if tonumber(redis.call('ZCARD', temp)) == 0 then
+        return empty()
+    end
+end
+
+if ranked and not spec.order and (mode ~= 'count' or cache) then
+    -- text search results are ordered by relevance, best first
+    redis.call('ZUNIONSTORE', temp, 1, temp, 'WEIGHTS', -1)
+elseif not spec.order and (mode ~= 'count' or cache) then
+    -- without explicit ordering, results are ordered by the last filter of the
+    -- query if it was a numeric range (spec.by), otherwise by id (as strings)
+    if (scored_by > 0 and spec.filters[scored_by][2]) ~= spec.by then
+        if spec.by then
+            redis.call('ZINTERSTORE', temp, 2, temp, spec.by, 'WEIGHTS', 0, 1)
+        else
+            redis.call('ZUNIONSTORE', temp, 1, temp, 'WEIGHTS', 0)
+        end
+    end
+elseif spec.order then
+    if #plan > 0 then
+        redis.call('ZINTERSTORE', temp, 2, temp, spec.order[1], 'WEIGHTS', 0, spec.order[2])
+    else
+        redis.call('ZUNIONSTORE', temp, 1, spec.order[1], 'WEIGHTS', spec.order[2])
+    end
+    if lex_order and (cache or mode == 'key') then
+        -- finish() only reorders pages of temp
+        relex(temp)
+    end
+end
+
+if cache then
+    store_cache()
+    return {'miss', finish(ckey)}
+elseif mode == 'key' then
+    return finish(temp)
+end
+local result = finish(temp)
+redis.call('DEL', temp)
+return result
+''')
+
 _redis_prefix_lua = _script_load('''
 -- first unpack most of our passed variables
 local dest = KEYS[1]
@@ -377,12 +2493,204 @@ def redis_prefix_lua(conn, dest, index, prefix, is_first, pattern=None):
     Performs the actual prefix, suffix, and pattern match operations. 
     '''
     tkey = '%s:%s'%(index.partition(':')[0], uuid.uuid4())
+    if index.endswith(':lex'):
+        start, end = _lex_range(prefix)
+        return _redis_lex_prefix_lua(conn,
+            [dest, tkey, index],
+            [start, end, pattern or '', int(bool(is_first))]
+        )
     start, end = _start_end(prefix)
     return _redis_prefix_lua(conn,
         [dest, tkey, index],
         [start, end, pattern or prefix, int(pattern is not None), int(bool(is_first))]
     )
 
+_redis_lex_prefix_lua = _script_load('''
+local dest = KEYS[1]
+local tkey = KEYS[2]
+local idx = KEYS[3]
+local pattern = ARGV[3]
+local is_first = tonumber(ARGV[4])
+
+-- every member in the range has the prefix, patterns still need checking
+local first = 0
+if ARGV[1] ~= '-' then
+    first = tonumber(redis.call('ZLEXCOUNT', idx, '-', '(' .. string.sub(ARGV[1], 2)))
+end
+local last = first + tonumber(redis.call('ZLEXCOUNT', idx, ARGV[1], ARGV[2]))
+local matched = 0
+for i = first, last - 1, 100 do
+    for _, v in ipairs(redis.call('ZRANGE', idx, i, math.min(i + 100, last) - 1)) do
+        if #pattern == 0 or string.match(v, pattern) then
+            local endv = #v
+            while string.sub(v, endv, endv) ~= '\\0' do
+                endv = endv - 1
+            end
+            matched = matched + redis.call('ZADD', tkey, 0, string.sub(v, endv + 1))
+        end
+    end
+end
+
+if is_first > 0 then
+    if matched > 0 then
+        redis.call('RENAME', tkey, dest)
+    end
+else
+    matched = redis.call('ZINTERSTORE', dest, 2, tkey, dest, 'WEIGHTS', 1, 0)
+    redis.call('DEL', tkey)
+end
+return matched
+''')
+
+_complete_lua = _script_load('''
+-- KEYS - {namespace}
+-- ARGV - {json {attr, prefix, start_score, end_score, limit, weight, budget, columns}}
+local namespace = KEYS[1]
+local args = cjson.decode(ARGV[1])
+local prefix, limit, budget = args.prefix, args.limit, args.budget
+local CHUNK = math.max(math.min(budget, 100), 1)
+
+local key = namespace .. ':' .. args.attr .. ':pre'
+local lex = redis.call('EXISTS', namespace .. '::lex') == 1
+local min, max = '-', '+'
+if lex then
+    key = key .. ':lex'
+    if #prefix > 0 then
+        min, max = '[' .. prefix, '(' .. prefix .. '\\255'
+    end
+end
+
+-- ids of (up to) CHUNK prefix index members from offset, in word order, and
+-- whether there may be more
+local function matches(offset)
+    local members
+    if lex then
+        members = redis.call('ZRANGEBYLEX', key, min, max, 'LIMIT', offset, CHUNK)
+    else
+        members = redis.call('ZRANGEBYSCORE', key, args.start_score, '(' .. args.end_score, 'LIMIT', offset, CHUNK)
+    end
+    local ids = {}
+    for _, v in ipairs(members) do
+        if string.sub(v, 1, #prefix) == prefix then
+            local e = #v
+            while string.sub(v, e, e) ~= '\\0' do
+                e = e - 1
+            end
+            table.insert(ids, string.sub(v, e + 1))
+        end
+    end
+    return ids, #members == CHUNK
+end
+
+local found, seen = {}, {}
+local function add(id)
+    if not seen[id] then
+        seen[id] = true
+        table.insert(found, id)
+    end
+end
+
+-- adds matching ids in word order until there are enough of them (when
+-- provided), returns false if more than max_members members would be read
+local function scan(enough, max_members)
+    local offset = 0
+    while true do
+        local ids, more = matches(offset)
+        for _, id in ipairs(ids) do
+            add(id)
+            if enough and #found >= enough then
+                return true
+            end
+        end
+        offset = offset + CHUNK
+        if not more then
+            return true
+        elseif max_members and offset >= max_members then
+            return false
+        end
+    end
+end
+
+-- whether an entity has an indexed word with the prefix
+local function has_prefix(id)
+    local idata = redis.call('HGET', namespace .. '::', id)
+    if not idata then
+        return false
+    end
+    for _, data in ipairs(cjson.decode(idata)[3] or {}) do
+        if data[1] == args.attr and string.sub(data[2], 1, #prefix) == prefix then
+            return true
+        end
+    end
+    return false
+end
+
+if limit > 0 and not args.weight then
+    scan(limit)
+elseif limit > 0 then
+    local wkey = namespace .. ':' .. args.weight .. ':idx'
+    local ranked = scan(nil, budget)
+    if not ranked then
+        -- Too many matches to rank them all, so walk the weights from the
+        -- highest down, checking each entity for the prefix. Matches are
+        -- common, so this should stop early.
+        found, seen = {}, {}
+        local pos = 0
+        while #found < limit do
+            local ids = redis.call('ZREVRANGE', wkey, pos, pos + CHUNK - 1)
+            for _, id in ipairs(ids) do
+                if has_prefix(id) then
+                    add(id)
+                    if #found >= limit then
+                        break
+                    end
+                end
+            end
+            pos = pos + CHUNK
+            if #ids < CHUNK then
+                -- the rest of the matches don't have weights
+                scan(limit)
+                break
+            elseif pos >= budget and #found < limit then
+                -- the best matches have low weights, rank them all
+                found, seen = {}, {}
+                scan()
+                ranked = true
+                break
+            end
+        end
+    end
+    if ranked then
+        -- highest weight first, entities without weights last, ties in
+        -- word order
+        local order = {}
+        for i, id in ipairs(found) do
+            order[id] = {tonumber(redis.call('ZSCORE', wkey, id)) or -math.huge, i}
+        end
+        table.sort(found, function(a, b)
+            local wa, wb = order[a], order[b]
+            if wa[1] ~= wb[1] then
+                return wa[1] > wb[1]
+            end
+            return wa[2] < wb[2]
+        end)
+    end
+end
+
+local ids = {}
+for i = 1, math.min(limit, #found) do
+    ids[i] = found[i]
+end
+if args.columns and #ids > 0 then
+    local rows = {}
+    for i, id in ipairs(ids) do
+        rows[i] = redis.call('HMGET', namespace .. ':' .. id, unpack(args.columns))
+    end
+    return {ids, cjson.encode(rows)}
+end
+return {ids, false}
+''')
+
 lua_subrange = _script_load('''
 -- KEYS - {dest_key, source_key}
 -- ARGV - {start_value, end_value}
@@ -390,18 +2698,13 @@ lua_subrange = _script_load('''
 local idx = KEYS[2]
 
 local start_member = redis.call('ZRANGEBYSCORE', idx, ARGV[1], 'inf', 'limit', 0, 1)
-local start_index = 0
-if #start_member == 1 then
-    start_index = tonumber(redis.call('ZRANK', idx, start_member[1]))
-end
-
 local end_member = redis.call('ZREVRANGEBYSCORE', idx, ARGV[2], '-inf', 'limit', 0, 1)
-local end_index
-if #end_member == 1 then
-    end_index = tonumber(redis.call('ZRANK', idx, end_member[1]))
-else
-    end_index = tonumber(redis.call('ZCARD', idx))
+if #start_member == 0 or #end_member == 0 then
+    -- nothing in the range
+    return 0
 end
+local start_index = tonumber(redis.call('ZRANK', idx, start_member[1]))
+local end_index = tonumber(redis.call('ZRANK', idx, end_member[1]))
 
 for i=start_index, end_index, 100 do
     local members = redis.call('ZRANGE', idx, i, math.min(i+99, end_index), 'withscores')
@@ -423,6 +2726,8 @@ local idx = KEYS[1]
 local typ = redis.pcall('TYPE', idx).ok
 if typ == 'set' then
     return tonumber(redis.call('scard', idx))
+elseif typ == 'zset' and string.sub(idx, -4) == ':lex' then
+    return tonumber(redis.call('zlexcount', idx, ARGV[1], ARGV[2]))
 elseif typ == 'zset' then
     local size = tonumber(redis.call('zcard', idx))
 
@@ -481,8 +2786,278 @@ def estimate_work_lua(conn, index, prefix):
         return _estimate_work_lua(conn, [index], args, force_eval=True)
     elif index.endswith(':geo'):
         return _estimate_work_lua(conn, [index], filter(None, [prefix]), force_eval=True)
+    elif index.endswith(':lex'):
+        return _estimate_work_lua(conn, [index], list(_lex_range(prefix)), force_eval=True)
 
     start, end = _start_end(prefix)
     return _estimate_work_lua(conn, [index], [start, '(' + end], force_eval=True)
 
+REPLICA_REFRESH = 1.0
+
+# how many versions of changes are kept for replicas, replicas that are
+# further behind reload everything
+REPLICA_CHANGES = 10000
+
+def _parse_bound(v, default):
+    # Turns a Redis-style score endpoint ('5', '(5', '-inf', None, 5) into
+    # a (float, exclusive) pair.
+    if v is None:
+        return default, False
+    if isinstance(v, six.binary_type):
+        v = v.decode('latin-1')
+    if not isinstance(v, six.string_types):
+        return float(v), False
+    exclusive = v.startswith('(')
+    return float(v.lstrip('(')), exclusive
+
+def _in_range(score, mi, ma):
+    if score is None:
+        return False
+    lo, lox = mi
+    hi, hix = ma
+    if score < lo or (lox and score == lo):
+        return False
+    if score > hi or (hix and score == hi):
+        return False
+    return True
+
+class LocalIndex(object):
+    '''
+    This class holds an in-process copy of every entity of a model that was
+    defined with ``replicated = True``, along with the index data that was
+    written for each entity. Filtering, ordering, and counting for simple
+    queries can then be answered locally without talking to Redis.
+
+    .. warning:: You probably don't want to be calling this directly. Instead,
+      ``Model.get()``, ``Model.get_by()``, and ``Model.query`` will use the
+      replica automatically for replicated models.
+
+    Every write of a replicated entity increments the model-level counter
+    ``<namespace>::version`` and records the entity id with that version in
+    the ZSET ``<namespace>::changes``. When the replica is older than the
+    refresh interval (``REPLICA_REFRESH`` seconds by default, or the number
+    passed as ``replicated = <seconds>`` on the model), a single Lua call
+    fetches the data for entities changed since the last version seen.
+    Changes older than the last ``REPLICA_CHANGES`` versions are trimmed, and
+    replicas that are further behind than that reload every entity.
+
+    Only plain string/tag filters, lists of string/tag filters, and numeric
+    range filters are evaluated locally. Queries using prefix, suffix,
+    pattern, or geo filters are passed through to Redis.
+    '''
+    def __init__(self, model, interval=REPLICA_REFRESH):
+        self.model = model
+        self.interval = interval
+        self.changes = REPLICA_CHANGES
+        self.lock = threading.RLock()
+        self._reset()
+
+    def _reset(self):
+        self.version = -1
+        self.checked = 0
+        self.rows = {}
+        self.keys = {}
+        self.scores = {}
+        self.unique = dict((attr, {}) for attr in self.model._unique)
+
+    def stale(self):
+        '''
+        Forces the next read to check Redis for changes.
+        '''
+        self.checked = 0
+
+    def refresh(self, conn, force=False):
+        '''
+        Fetches any entities changed since the last refresh, if the refresh
+        interval has passed (or ``force=True``).
+        '''
+        now = time.time()
+        if not force and now - self.checked < self.interval:
+            return
+        with self.lock:
+            result = _replica_sync_lua(conn, [self.model._namespace], [self.version])
+            version = int(result[0])
+            if version < self.version:
+                # the counter went away (FLUSHDB or similar), or the changes
+                # since our version were trimmed (-1), reload everything
+                self._reset()
+                return self.refresh(conn, True)
+            items = iter(result[1:])
+            for id, data, index in zip(items, items, items):
+                id = int(id)
+                if data:
+                    self._load(id, data, index)
+                else:
+                    self._drop(id)
+            self.version = version
+            self.checked = now
+
+    def _load(self, id, data, index):
+        data = iter(data)
+        data = dict(zip(data, data))
+        if six.PY3:
+            data = dict((k.decode(), v.decode()) for k, v in data.items())
+            index = index.decode()
+        self._drop(id)
+        keys, scores = json.loads(index)
+        self.rows[id] = data
+        self.keys[id] = set(keys or ())
+        self.scores[id] = dict((k, float(v)) for k, v in (scores or {}).items())
+        for attr, values in self.unique.items():
+            if data.get(attr) is not None:
+                values[data[attr]] = id
+
+    def _drop(self, id):
+        data = self.rows.pop(id, None)
+        self.keys.pop(id, None)
+        self.scores.pop(id, None)
+        if data:
+            for attr, values in self.unique.items():
+                if values.get(data.get(attr)) == id:
+                    del values[data[attr]]
+
+    def get(self, conn, ids):
+        '''
+        Returns the raw data for the provided ids, ``None`` for missing ids.
+        '''
+        self.refresh(conn)
+        with self.lock:
+            return [self.rows.get(int(id)) for id in ids]
+
+    def get_unique(self, conn, attr, values):
+        '''
+        Returns the ids for entities with the provided unique column values.
+        '''
+        self.refresh(conn)
+        out = []
+        with self.lock:
+            known = self.unique[attr]
+            for value in values:
+                if isinstance(value, six.binary_type):
+                    value = value.decode('utf-8')
+                if value in known:
+                    out.append(known[value])
+        return out
+
+    def _matcher(self, fltr):
+        if isinstance(fltr, six.string_types) and ':' not in fltr:
+            # a bare column name (counts add the order column) matches the
+            # entities with a score for the column, like its index in Redis
+            return lambda id: fltr in self.scores[id]
+        elif isinstance(fltr, six.string_types):
+            return lambda id: fltr in self.keys[id]
+        elif isinstance(fltr, list):
+            fltr = set(fltr)
+            return lambda id: not fltr.isdisjoint(self.keys[id])
+        elif isinstance(fltr, Expression):
+            matchers = [self._matcher(f) for f in fltr.filters]
+            if None in matchers:
+                return None
+            if fltr.op == 'not':
+                return lambda id: not matchers[0](id)
+            elif fltr.op == 'or':
+                return lambda id: any(m(id) for m in matchers)
+            return lambda id: all(m(id) for m in matchers)
+        elif isinstance(fltr, InList):
+            attr = fltr.attr
+            values = set(float(v) for v in fltr.values)
+            return lambda id: self.scores[id].get(attr) in values
+        elif isinstance(fltr, tuple) and not hasattr(fltr, '_fields'):
+            if len(fltr) != 3:
+                raise QueryError("Cannot filter range of data without 2 endpoints (%s given)"%(len(fltr)-1,))
+            attr = fltr[0]
+            mi = _parse_bound(fltr[1], float('-inf'))
+            ma = _parse_bound(fltr[2], float('inf'))
+            return lambda id: _in_range(self.scores[id].get(attr), mi, ma)
+        # prefix, suffix, pattern, and geo filters are left to Redis
+        return None
+
+    def _search(self, filters, order_by):
+        matchers = [self._matcher(fltr) for fltr in filters]
+        if None in matchers:
+            return None
+        if order_by and order_by.lstrip('-') in self.model._lex_order:
+            # full values aren't replicated
+            return None
+        ids = [id for id in self.rows if all(m(id) for m in matchers)]
+        if order_by:
+            attr = order_by.lstrip('-')
+            sign = -1 if order_by.startswith('-') else 1
+            ids = [id for id in ids if attr in self.scores[id]]
+            ids.sort(key=lambda id: (sign * self.scores[id][attr], str(id)))
+        else:
+            attr = _unordered_by(filters)
+            if attr:
+                ids.sort(key=lambda id: (self.scores[id][attr], str(id)))
+            else:
+                ids.sort(key=str)
+        return ids
+
+    def search(self, conn, filters, order_by, offset=None, count=None):
+        '''
+        Returns the list of ids matching the provided filters, or ``None`` if
+        the filters can't be evaluated locally. See ``GeneralIndex.search()``
+        for argument semantics.
+        '''
+        self.refresh(conn)
+        with self.lock:
+            ids = self._search(filters, order_by)
+        if ids is None:
+            return None
+        offset = max(offset or 0, 0)
+        if count is not None and count > 0:
+            return ids[offset:offset+count]
+        return ids[offset:]
+
+    def count(self, conn, filters):
+        '''
+        Returns the number of entities matching the provided filters, or
+        ``None`` if the filters can't be evaluated locally.
+        '''
+        self.refresh(conn)
+        with self.lock:
+            matchers = [self._matcher(fltr) for fltr in filters]
+            if None in matchers:
+                return None
+            return sum(1 for id in self.rows if all(m(id) for m in matchers))
+
+_replica_sync_lua = _script_load('''
+-- KEYS - {namespace}
+-- ARGV - {last_version}
+local namespace = KEYS[1]
+local last = tonumber(ARGV[1])
+local version = tonumber(redis.call('GET', namespace .. '::version') or '0')
+local ids
+if last < 0 or version < last then
+    ids = redis.call('HKEYS', namespace .. '::')
+elseif version == last then
+    return {version}
+elseif last < tonumber(redis.call('GET', namespace .. '::changes:min') or '0') then
+    -- changes we haven't seen were trimmed
+    return {-1}
+else
+    ids = redis.call('ZRANGEBYSCORE', namespace .. '::changes', '(' .. last, 'inf')
+end
+
+local out = {version}
+for _, id in ipairs(ids) do
+    local index = {{}, {}}
+    local idata = redis.call('HGET', namespace .. '::', id)
+    if idata then
+        idata = cjson.decode(idata)
+        index[1] = idata[1] or {}
+        for _, key in ipairs(idata[7] or {}) do
+            table.insert(index[1], key)
+        end
+        for _, key in ipairs(idata[2] or {}) do
+            index[2][key] = redis.call('ZSCORE', namespace .. ':' .. key .. ':idx', id)
+        end
+    end
+    out[#out + 1] = id
+    out[#out + 1] = redis.call('HGETALL', namespace .. ':' .. id)
+    out[#out + 1] = cjson.encode(index)
+end
+return out
+''')
+
 __all__ = [k for k, v in globals().items() if getattr(v, '__doc__', None) and k not in _skip]
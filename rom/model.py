@@ -10,6 +10,8 @@ which you'd like to be bound under).
 '''
 
 from collections import defaultdict
+from hashlib import sha1
+from itertools import chain, product
 import json
 import warnings
 
@@ -17,15 +19,17 @@ from redis import client
 import six
 
 from .columns import (Column, Text, PrimaryKey, ManyToOne, OneToOne, OneToMany,
-    MODELS, MODELS_REFERENCED, _on_delete, SKIP_ON_DELETE)
+    MODELS, MODELS_REFERENCED, _on_delete, SKIP_ON_DELETE, is_numeric)
 from .exceptions import (ORMError, UniqueKeyViolation, InvalidOperation,
     QueryError, ColumnError, InvalidColumnValue, DataRaceError,
     EntityDeletedError)
-from .index import GeneralIndex, GeoIndex
-from .query import Query, NUMERIC_TYPES
-from .util import (ClassProperty, _connect, session,
+from .index import (GeneralIndex, GeoIndex, LocalIndex, REPLICA_REFRESH, _trigrams,
+    _composite_key, _composite_value)
+from .query import Query, NUMERIC_TYPES, _dict_data_factory, _select_generator
+from .util import (ClassProperty, _connect, session, _full_text_words,
     _prefix_score, _script_load, _encode_unique_constraint,
-    STRING_SORT_KEYGENS)
+    STRING_SORT_KEYGENS, Batch, current_batch, NegativeCache,
+    NEGATIVE_CACHE_TTL)
 
 _skip = None
 _skip = set(globals()) - set(['__doc__'])
@@ -46,6 +50,10 @@ class _ModelMetaclass(type):
         dict['_cunique'] = cunique = set()
         dict['_prefix'] = prefix = set()
         dict['_suffix'] = suffix = set()
+        dict['_ngram'] = ngram = set()
+        dict['_positions'] = positional = set()
+        dict['_lex_order'] = lex_order = set()
+        dict['_bitmap'] = bitmap = set()
         dict['_geo'] = geo = {}
 
         dict['_columns'] = columns = {}
@@ -65,7 +73,10 @@ class _ModelMetaclass(type):
             dict['id'] = PrimaryKey()
 
         composite_unique = []
+        composite_index = []
         many_to_one = defaultdict(list)
+        replicated = False
+        negative = False
 
         # validate all of our columns to ensure that they fulfill our
         # expectations
@@ -80,6 +91,14 @@ class _ModelMetaclass(type):
                     prefix.add(attr)
                 if col._suffix:
                     suffix.add(attr)
+                if col._ngram:
+                    ngram.add(attr)
+                if col._positions:
+                    positional.add(attr)
+                if col._lex_order:
+                    lex_order.add(attr)
+                if col._bitmap:
+                    bitmap.add(attr)
                 if col._unique:
                     unique.add(attr)
 
@@ -108,6 +127,19 @@ class _ModelMetaclass(type):
             if attr == 'unique_together':
                 composite_unique = col
 
+            if attr == 'composite_index':
+                composite_index = col
+
+            if attr == 'replicated' and not isinstance(col, Column):
+                if not isinstance(col, (bool, float) + six.integer_types) or col < 0:
+                    raise ORMError("replicated attribute must be a boolean or a non-negative refresh interval in seconds")
+                replicated = col
+
+            if attr == 'negative_cache' and not isinstance(col, Column):
+                if not isinstance(col, (bool, float) + six.integer_types) or col < 0:
+                    raise ORMError("negative_cache attribute must be a boolean or a non-negative time to live in seconds")
+                negative = col
+
             if attr == 'geo_index':
                 if not isinstance(col, list) or not all(isinstance(v, GeoIndex) for v in col):
                     raise ORMError("geo_index attribute must be a list of Geoindex() definitions if present")
@@ -147,10 +179,39 @@ class _ModelMetaclass(type):
             seen[key] = comp
             cunique.add(key)
 
+        # handle multi-column indexes
+        if composite_index and isinstance(composite_index[0], six.string_types):
+            composite_index = [composite_index]
+
+        dict['_composite'] = composite = []
+        for comp in composite_index:
+            comp = tuple(comp)
+            if len(comp) < 2 or len(set(comp)) != len(comp):
+                raise ColumnError("Composite index %r must have at least 2 different columns"%(comp,))
+            for col in comp:
+                if col not in columns or not columns[col]._index:
+                    raise ColumnError("Composite index %r references non-existant or non-indexed column %r"%(
+                        comp, col))
+            last = columns[comp[-1]]
+            if not (is_numeric(last._allowed) or isinstance(last, (ManyToOne, OneToOne))):
+                raise ColumnError("The last column of composite index %r must be numeric"%(comp,))
+            if comp in composite:
+                raise ColumnError("Composite index %r defined more than once"%(comp,))
+            composite.append(comp)
+
         dict['_pkey'] = pkey
-        dict['_gindex'] = GeneralIndex(dict['_namespace'])
+        dict['_gindex'] = GeneralIndex(dict['_namespace'], lex_order, composite, bitmap)
+
+        dict['_replica'] = None
+        dict['_negative'] = None
+        if negative is not False:
+            dict['_negative'] = NegativeCache(dict['_namespace'],
+                NEGATIVE_CACHE_TTL if negative is True else float(negative))
 
         MODELS[dict['_namespace']] = MODELS[name] = model = type.__new__(cls, name, bases, dict)
+        if replicated is not False:
+            model._replica = LocalIndex(model,
+                REPLICA_REFRESH if replicated is True else float(replicated))
         return model
 
 class AttrDict(dict):
@@ -217,6 +278,75 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
         unique constrant is None in Python, the unique constraint won't apply.
         This is the typical behavior of nulls in unique constraints inside both
         MySQL and Postgres.
+
+    **Composite/multi-column indexes**
+
+    Queries that filter on one column for equality and on another for a
+    range (``filter(tenant_id=42, created_at=(t0, t1))``) intersect both of
+    the indexes, which can be slow when both are large. The attribute
+    ``composite_index`` defines groups of indexed columns to keep an extra
+    index for, with one ZSET for each value of the leading columns, ordered
+    by the last (numeric) column. Queries with equality filters on all of the
+    leading columns and a range (or equality) filter on the last column then
+    only read the matching range of that one ZSET.
+
+    Usage::
+
+        class Event(Model):
+            tenant_id = Integer(index=True)
+            kind = Text(index=True, keygen=IDENTITY)
+            created_at = Float(index=True)
+
+            composite_index = [
+                ('tenant_id', 'created_at'),
+                ('tenant_id', 'kind', 'created_at'),
+            ]
+
+    .. note:: Composite indexes are written when entities are saved. On models
+        with existing entities, queries keep using the per-column indexes
+        until ``rom.util.refresh_indices()`` has added them to every entity.
+
+    **Replicated models**
+
+    Small models that are read on every request (feature flags, currencies,
+    tenants, ...) can be defined with ``replicated = True``. Each process will
+    load all entities of the model into memory once, then refresh only the
+    entities changed since the last refresh (checked at most once per
+    ``rom.index.REPLICA_REFRESH`` seconds, or pass a number of seconds
+    instead of ``True``). ``Model.get()``, ``Model.get_by()``, and simple
+    ``Model.query.filter(...)`` calls are then answered without talking to
+    Redis.
+
+    Usage::
+
+        class Currency(Model):
+            code = String(unique=True, index=True, keygen=IDENTITY)
+            rate = Float(index=True)
+
+            replicated = True
+
+    .. note:: Writes from the current process are visible immediately, writes
+        from other processes are visible after the refresh interval.
+
+    **Negative caching**
+
+    Models that are frequently probed for ids or unique values that don't
+    exist (signup checks for existing email addresses, crawlers, ...) can be
+    defined with ``negative_cache = True`` (or a time to live in seconds,
+    defaulting to ``rom.util.NEGATIVE_CACHE_TTL``). Misses from
+    ``Model.get()`` and unique ``Model.get_by()`` lookups are remembered in
+    the process for that long, and are forgotten as soon as any process saves
+    a new entity or unique value to the model.
+
+    Usage::
+
+        class User(Model):
+            email = String(unique=True, keygen=IDENTITY_CI)
+
+            negative_cache = 5
+
+    .. note:: Lookups still read the model's version counter from Redis,
+        which saves the reads of missing entities and unique values.
     '''
     def __init__(self, **kwargs):
         self._new = not kwargs.pop('_loading', False)
@@ -225,6 +355,7 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
         self._last = {}
         self._modified = False
         self._deleted = False
+        self._digest = None
         self._init = False
         for attr in self._columns:
             cval = kwargs.get(attr, None)
@@ -264,6 +395,12 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
         return _connect(cls)
 
     def refresh(self, force=False):
+        '''
+        Reloads the entity from Redis. Entities whose data hasn't changed in
+        Redis since they were loaded are not re-initialized. If the entity was
+        deleted from Redis, the entity will be marked as deleted and removed
+        from the session.
+        '''
         if self._deleted:
             return
         if self._modified and not force:
@@ -271,11 +408,7 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
         if self._new:
             raise InvalidOperation("Cannot refresh a new entity")
 
-        conn = _connect(self)
-        data = conn.hgetall(self._pk)
-        if six.PY3:
-            data = dict((k.decode(), v.decode()) for k, v in data.items())
-        self.__init__(_loading=True, **data)
+        _refresh_entities([self])
 
     @property
     def _pk(self):
@@ -300,7 +433,10 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
         prefix = []
         suffix = []
         geo = []
+        positions = []
+        bitmaps = set()
         redis_data = {}
+        changed_indexes = set()
 
         # update individual columns
         for attr in cls._columns:
@@ -318,6 +454,8 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
                 redis_data[attr] = rnval
 
             # Add/update standard index
+            words = len(prefix)
+            indexed = bitmaps if ca._bitmap else keys
             if ca._keygen and not delete and nval is not None and (ca._index or ca._prefix or ca._suffix):
                 generated = ca._keygen(attr, new)
                 if not generated:
@@ -327,7 +465,7 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
                 elif isinstance(generated, (list, tuple, set)):
                     if ca._index:
                         for k in generated:
-                            keys.add('%s:%s'%(attr, k))
+                            indexed.add('%s:%s'%(attr, k))
 
                     if ca._prefix:
                         for k in generated:
@@ -350,7 +488,7 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
                                 scores[attr] = v
                             elif v in (None, ''):
                                 # mixed index type support
-                                keys.add('%s:%s'%(attr, k))
+                                indexed.add('%s:%s'%(attr, k))
                             else:
                                 scores['%s:%s'%(attr, k)] = v
 
@@ -376,10 +514,25 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
                 else:
                     raise ColumnError("Don't know how to turn %r into a sequence of keys"%(generated,))
 
+                if ca._positions:
+                    at = {}
+                    for i, word in enumerate(_full_text_words(nval) or ()):
+                        at.setdefault(word, []).append(i)
+                    positions.append([attr, json.dumps(at, default=_fix_bytes, sort_keys=True)])
+
+                if ca._ngram:
+                    # trigram postings are plain key indexes, cleaned up with
+                    # the rest of the entity's key index data
+                    for _, word in prefix[words:]:
+                        for gram in _trigrams(word):
+                            keys.add('%s~3:%s'%(attr, gram))
+
             if nval == oval and not full:
                 continue
 
             changes += 1
+            if (ca._index or ca._prefix or ca._suffix) and (full or _str(roval) != _str(rnval)):
+                changed_indexes.add(attr)
 
             # Delete removed columns
             if nval is None and oval is not None:
@@ -415,6 +568,21 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
             if None not in ndata:
                 unique[attr] = _encode_unique_constraint(ndata)
 
+        # Add/update multi-column indexes, one ZSET per combination of the
+        # leading columns' index values, scored by the last column
+        for comp in cls._composite:
+            if comp[-1] not in scores:
+                continue
+            values = []
+            for attr in comp[:-1]:
+                if attr in scores:
+                    values.append([_composite_value(scores[attr])])
+                else:
+                    start = attr + ':'
+                    values.append([k[len(start):] for k in chain(keys, bitmaps) if k.startswith(start)])
+            for combination in product(*values):
+                scores[_composite_key(comp, combination)] = scores[comp[-1]]
+
         for name in cls._geo:
             idx = cls._geo[name]
             val = idx.callback(AttrDict(new))
@@ -426,11 +594,21 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
                 else:
                     raise ORMError("Lon/Lat pair for geo index is not a dictionary of {'lon': ..., 'lat': ...}")
 
+        if changes:
+            changed_indexes.update(cls._geo)
+
         id_only = str(pk)
         old_data = [] if is_new else ([(cls._pkey, str(pk))] + [(k, old.get(k)) for k in data if k in old])
         redis_writer_lua(conn, cls._pkey, model, id_only, unique, udeleted,
             deleted, data, list(keys), scores, prefix, suffix, geo, old_data,
-            delete)
+            delete, cls._replica is not None and cls._replica.changes, sorted(changed_indexes), positions,
+            sorted(bitmaps), sorted(cls._gindex.built_indexes),
+            cls._negative is not None and bool(is_new or unique))
+        if cls._replica is not None:
+            # make sure that we can read our own writes
+            cls._replica.stale()
+        if cls._negative is not None:
+            cls._negative.discard(['%s:%s'%(model, id_only)] + list(unique.items()))
 
         return changes, redis_data
 
@@ -464,6 +642,7 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
         self._new = False
         self._modified = False
         self._deleted = False
+        self._digest = None
         # handle the post-commit hooks
         if was_new:
             self._after_insert()
@@ -518,30 +697,75 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
         single = not isinstance(ids, (list, tuple, set, frozenset))
         if single:
             ids = [ids]
-        pks = ['%s:%s'%(cls._namespace, id) for id in map(int, ids)]
+        ids = list(map(int, ids))
+        pks = ['%s:%s'%(cls._namespace, id) for id in ids]
         # get from the session, if possible
         out = list(map(session.get, pks))
+        # if we couldn't get an instance from the session, load from the
+        # local replica
+        if None in out and cls._replica is not None:
+            idxs = [i for i, ent in enumerate(out) if ent is None]
+            for i, data in zip(idxs, cls._replica.get(conn, [ids[i] for i in idxs])):
+                if data:
+                    out[i] = cls(_loading=True, **data)
+            out = [x for x in out if x]
         # if we couldn't get an instance from the session, load from Redis
-        if None in out:
+        elif None in out:
+            negative = cls._negative
+            version = negative and negative.version(conn)
             pipe = conn.pipeline(True)
             idxs = []
             # Fetch missing data
             for i, data in enumerate(out):
-                if data is None:
+                if data is None and not (negative and negative.missing(pks[i], version)):
                     idxs.append(i)
                     pipe.hgetall(pks[i])
             # Update output list
-            for i, data in zip(idxs, pipe.execute()):
+            missing = []
+            for i, data in zip(idxs, pipe.execute() if idxs else ()):
                 if data:
-                    if six.PY3:
-                        data = dict((k.decode(), v.decode()) for k, v in data.items())
-                    out[i] = cls(_loading=True, **data)
+                    out[i] = cls._from_redis_data(data)
+                else:
+                    missing.append(pks[i])
+            if missing and negative:
+                negative.add(missing, version)
             # Get rid of missing models
             out = [x for x in out if x]
         if single:
             return out[0] if out else None
         return out
 
+    @classmethod
+    def _from_redis_data(cls, data):
+        # data is the result of HGETALL on the entity's hash
+        if six.PY3:
+            data = dict((k.decode(), v.decode()) for k, v in data.items())
+        return cls(_loading=True, **data)
+
+    @classmethod
+    def get_deferred(cls, id):
+        '''
+        Returns a ``rom.util.Deferred`` for the entity with the provided id.
+        Inside a ``rom.batch()`` block, all outstanding deferred entities are
+        fetched together (with one pipelined round trip) when the first
+        ``.result()`` is requested or when the block exits. Outside of a batch,
+        the entity is fetched immediately.
+
+        Used like::
+
+            with rom.batch():
+                a = MyModel.get_deferred(5)
+                b = OtherModel.get_deferred(7)
+                print(a.result(), b.result())
+        '''
+        batch = current_batch()
+        if batch is None:
+            batch = Batch()
+            deferred = batch.add(cls, id)
+            batch.resolve()
+            return deferred
+        return batch.add(cls, id)
+
     @classmethod
     def get_by(cls, **kwargs):
         '''
@@ -601,7 +825,17 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
                 if single:
                     value = [value]
                 qvalues = list(map(cls._columns[attr]._to_redis, value))
-                ids = [x for x in conn.hmget('%s:%s:uidx'%(model, attr), qvalues) if x]
+                negative = cls._negative
+                if cls._replica is not None:
+                    ids = cls._replica.get_unique(conn, attr, qvalues)
+                elif negative is not None:
+                    version = negative.version(conn)
+                    qvalues = [v for v in qvalues if not negative.missing((attr, v), version)]
+                    ids = conn.hmget('%s:%s:uidx'%(model, attr), qvalues) if qvalues else []
+                    negative.add([(attr, v) for v, x in zip(qvalues, ids) if not x], version)
+                    ids = [x for x in ids if x]
+                else:
+                    ids = [x for x in conn.hmget('%s:%s:uidx'%(model, attr), qvalues) if x]
                 if not ids:
                     return None if single else []
                 return cls.get(ids[0] if single else ids)
@@ -619,9 +853,12 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
                     # Handle the ranges where None is -inf on the left and inf
                     # on the right when used in the context of a range tuple.
                     args[i] = ('-inf', 'inf')[i] if a is None else cls._columns[attr]._to_redis(a)
-                if _limit:
-                    args.extend(_limit)
-                ids = conn.zrangebyscore('%s:%s:idx'%(model, attr), *args)
+                if cls._replica is not None:
+                    ids = cls._replica.search(conn, [(attr,) + tuple(args)], None, *_limit)
+                else:
+                    if _limit:
+                        args.extend(_limit)
+                    ids = conn.zrangebyscore('%s:%s:idx'%(model, attr), *args)
                 if not ids:
                     return []
                 return cls.get(ids)
@@ -632,6 +869,45 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
                 query = query.limit(*_limit)
             return query.all()
 
+    @classmethod
+    def complete(cls, column, prefix, limit=10, weight=None, select=None):
+        '''
+        Returns up to ``limit`` suggestions for entities with a word starting
+        with ``prefix`` in ``column`` (which must have been defined with
+        ``prefix=True``), stopping as soon as enough matches are found.
+
+        Suggestions are ordered by the matched word, or when ``weight`` names
+        a numeric column with ``index=True``, by that column's value (highest
+        first). Returns entity ids, or dictionaries of the columns named in
+        ``select``, without loading entities.
+
+        Usage::
+
+            User.complete('name', 'jos', limit=10, weight='popularity', select=['name'])
+
+        '''
+        query = cls.query
+        prefix = query._check(column, prefix, 'startswith')
+        wcol = cls._columns.get(weight)
+        if weight is not None and not (weight in cls._index and
+                (is_numeric(wcol._allowed) or isinstance(wcol, (ManyToOne, OneToOne)))):
+            raise QueryError("Can only weight suggestions by a numeric column with index=True, not %r"%(weight,))
+        columns = None
+        if select:
+            missing = [c for c in select if c not in cls._columns]
+            if missing:
+                raise QueryError("No such columns known: %r"%(missing,))
+            columns = tuple(select)
+            if cls._pkey not in columns:
+                columns += (cls._pkey,)
+        conn = _connect(cls)
+        if not columns:
+            return [int(id) for id in cls._gindex.complete(conn, column, prefix, limit, weight)]
+        ids, rows = cls._gindex.complete(conn, column, prefix, limit, weight, columns)
+        data = _select_generator(None, cls, columns, True, cls._pkey not in select, _dict_data_factory)
+        next(data)
+        return [data.send(row) for row in rows]
+
     @ClassProperty
     def query(cls):
         '''
@@ -640,6 +916,97 @@ class Model(six.with_metaclass(_ModelMetaclass, object)):
         '''
         return Query(cls)
 
+def _str(v):
+    # compare written and loaded column data the same way on Python 2 and 3
+    if isinstance(v, six.binary_type) and six.PY3:
+        return v.decode('utf-8', 'replace')
+    return v if v is None or isinstance(v, six.string_types) else str(v)
+
+def _data_digest(ent):
+    # Must match the digest calculated in _refresh_lua below, computed from
+    # the data the entity was last loaded from or written to Redis.
+    out = []
+    for attr in sorted(ent._columns):
+        value = ent._last.get(attr)
+        if value is not None:
+            if not isinstance(value, six.binary_type):
+                value = six.text_type(value).encode('utf-8')
+            attr = attr.encode('utf-8')
+            out.append(b''.join([str(len(attr)).encode('ascii'), b':', attr,
+                str(len(value)).encode('ascii'), b':', value]))
+    return sha1(b''.join(out)).hexdigest()
+
+def _refresh_entities(entities):
+    '''
+    Reloads all provided (already validated) entities with one Lua call per
+    Redis connection. Only entities whose data changed in Redis since they
+    were loaded (compared by a digest of their stored data) are transferred
+    and re-initialized.
+    '''
+    groups = {}
+    for ent in entities:
+        conn = _connect(ent)
+        if id(conn) not in groups:
+            groups[id(conn)] = (conn, {}, [])
+        groups[id(conn)][1][ent._namespace] = sorted(ent._columns)
+        groups[id(conn)][2].append(ent)
+
+    for conn, columns, ents in groups.values():
+        args = [json.dumps(columns)]
+        for ent in ents:
+            # modified entities are always reloaded, the digest of the others
+            # is only calculated when they're first refreshed
+            if not ent._modified and ent._digest is None:
+                ent._digest = _data_digest(ent)
+            args.extend([ent._namespace, '' if ent._modified else ent._digest])
+        results = _refresh_lua(conn, [ent._pk for ent in ents], args)
+        for ent, result in zip(ents, results):
+            if not result:
+                # unchanged
+                session.add(ent)
+                continue
+            digest, data = result
+            if not data:
+                ent._deleted = True
+                session.forget(ent)
+                continue
+            data = iter(data)
+            data = dict(zip(data, data))
+            if six.PY3:
+                digest = digest.decode()
+                data = dict((k.decode(), v.decode()) for k, v in data.items())
+            ent.__init__(_loading=True, **data)
+            ent._digest = digest
+
+_refresh_lua = _script_load('''
+-- KEYS - {entity_key, ...}
+-- ARGV - {json({namespace: sorted_columns}), namespace, digest, ...}
+local columns = cjson.decode(ARGV[1])
+local out = {}
+for i, key in ipairs(KEYS) do
+    local flat = redis.call('HGETALL', key)
+    local data = {}
+    for j = 1, #flat, 2 do
+        data[flat[j]] = flat[j+1]
+    end
+    -- must match _data_digest() above
+    local parts = {}
+    for _, attr in ipairs(columns[ARGV[2*i]]) do
+        local value = data[attr]
+        if value then
+            parts[#parts + 1] = #attr .. ':' .. attr .. #value .. ':' .. value
+        end
+    end
+    local digest = redis.sha1hex(table.concat(parts))
+    if #flat > 0 and digest == ARGV[2*i+1] then
+        out[i] = 0
+    else
+        out[i] = {digest, flat}
+    end
+end
+return out
+''')
+
 _redis_writer_lua = _script_load('''
 local namespace = ARGV[1]
 local id = ARGV[2]
@@ -704,7 +1071,7 @@ local idata = redis.call('HGET', namespace .. '::', id)
 local _changes = 0
 if idata then
     idata = cjson.decode(idata)
-    while #idata < 5 do
+    while #idata < 7 do
         idata[#idata + 1] = {}
     end
     for i, key in ipairs(idata[1]) do
@@ -727,6 +1094,7 @@ if idata then
         local key = namespace .. ':' .. data[1] .. ':pre'
         local mem = data[2] .. '\0' .. id
         redis.call('ZREM', key, mem)
+        redis.call('ZREM', key .. ':lex', mem)
         _changes = _changes + 1
     end
     for i, data in ipairs(idata[4]) do
@@ -738,6 +1106,7 @@ if idata then
             local key = namespace .. ':' .. data[1] .. ':suf'
             local mem = data[2] .. '\0' .. id
             redis.call('ZREM', key, mem)
+            redis.call('ZREM', key .. ':lex', mem)
             _changes = _changes + 1
         end
     end
@@ -746,6 +1115,31 @@ if idata then
         redis.call('ZREM', key, id)
         _changes = _changes + 1
     end
+    for i, attr in ipairs(idata[6]) do
+        redis.call('HDEL', namespace .. ':' .. attr .. ':pos', id)
+        _changes = _changes + 1
+    end
+    for i, key in ipairs(idata[7]) do
+        redis.call('SETBIT', namespace .. ':' .. key .. ':bm', id, 0)
+        _changes = _changes + 1
+    end
+end
+
+-- record the change for in-process replicas, keeping the last ARGV[14]
+-- versions of changes (replicas that are further behind reload everything)
+local retain = cjson.decode(ARGV[14])
+if retain then
+    local version = redis.call('INCR', namespace .. '::version')
+    redis.call('ZADD', namespace .. '::changes', version, id)
+    if type(retain) == 'number' and retain >= 1 and version > retain and version % math.min(retain, 100) == 0 then
+        redis.call('ZREMRANGEBYSCORE', namespace .. '::changes', '-inf', version - retain)
+        redis.call('SET', namespace .. '::changes:min', version - retain)
+    end
+end
+
+-- bump the versions of changed indexes, invalidating cached query results
+for i, attr in ipairs(cjson.decode(ARGV[15])) do
+    redis.call('HINCRBY', namespace .. '::iver', attr, 1)
 end
 
 if is_delete then
@@ -754,8 +1148,31 @@ if is_delete then
     return cjson.encode({changes=_changes})
 end
 
--- add new key index data
+-- Composite and bitmap indexes are only queried once they were written for
+-- every entity (see util.refresh_indices()), which indexes declared before
+-- the first entity was written always are.
+local declared = cjson.decode(ARGV[18])
+if #declared > 0 and redis.call('HLEN', namespace .. '::') == 0 then
+    for i, name in ipairs(declared) do
+        redis.call('HSET', namespace .. '::built', name, 1)
+    end
+end
+
+-- misses in the negative caches of all processes are invalidated by new
+-- entities and unique values
+if cjson.decode(ARGV[19]) then
+    redis.call('INCR', namespace .. '::nver')
+end
+
+-- add new key index data, until a bitmap index is built its column is also
+-- indexed with SETs, which queries use instead
 local nkeys = cjson.decode(ARGV[7])
+local nbitmaps = cjson.decode(ARGV[17])
+for i, key in ipairs(nbitmaps) do
+    if redis.call('HEXISTS', namespace .. '::built', string.match(key, '^[^:]*')) == 0 then
+        table.insert(nkeys, key)
+    end
+end
 for i, key in ipairs(nkeys) do
     redis.call('SADD', namespace .. ':' .. key .. ':idx', id)
 end
@@ -767,21 +1184,40 @@ for key, score in pairs(cjson.decode(ARGV[8])) do
     nscored[#nscored + 1] = key
 end
 
+-- Prefix and suffix data is kept in score 0 ZSETs for ZRANGEBYLEX, with the
+-- older score-based indexes also kept until util.migrate_prefix_index() has
+-- copied them over (namespaces without indexed entities start out migrated).
+local prefix_data = cjson.decode(ARGV[9])
+local suffix_data = cjson.decode(ARGV[10])
+local lex = true
+if #prefix_data + #suffix_data > 0 and redis.call('EXISTS', namespace .. '::lex') == 0 then
+    lex = redis.call('HLEN', namespace .. '::') == 0
+    if lex then
+        redis.call('SET', namespace .. '::lex', 1)
+    end
+end
+
 -- add new prefix data
 local nprefix = {}
-for i, data in ipairs(cjson.decode(ARGV[9])) do
+for i, data in ipairs(prefix_data) do
     local key = namespace .. ':' .. data[1] .. ':pre'
     local mem = data[2] .. '\0' .. id
-    redis.call('ZADD', key, data[3], mem)
+    redis.call('ZADD', key .. ':lex', 0, mem)
+    if not lex then
+        redis.call('ZADD', key, data[3], mem)
+    end
     nprefix[#nprefix + 1] = {data[1], data[2]}
 end
 
 -- add new suffix data
 local nsuffix = {}
-for i, data in ipairs(cjson.decode(ARGV[10])) do
+for i, data in ipairs(suffix_data) do
     local key = namespace .. ':' .. data[1] .. ':suf'
     local mem = data[2] .. '\0' .. id
-    redis.call('ZADD', key, data[3], mem)
+    redis.call('ZADD', key .. ':lex', 0, mem)
+    if not lex then
+        redis.call('ZADD', key, data[3], mem)
+    end
     nsuffix[#nsuffix + 1] = {data[1], data[2]}
 end
 
@@ -793,12 +1229,24 @@ for i, data in ipairs(cjson.decode(ARGV[11])) do
     nsuffix[#nsuffix + 1] = data[1]
 end
 
+-- add new word positions
+local npositions = {}
+for i, data in ipairs(cjson.decode(ARGV[16])) do
+    redis.call('HSET', namespace .. ':' .. data[1] .. ':pos', id, data[2])
+    npositions[#npositions + 1] = data[1]
+end
+
+-- add new bitmap index data, ids are bit offsets
+for i, key in ipairs(nbitmaps) do
+    redis.call('SETBIT', namespace .. ':' .. key .. ':bm', id, 1)
+end
+
 if not is_delete then
     -- update known index data
-    local encoded = cjson.encode({nkeys, nscored, nprefix, nsuffix, ngeo})
+    local encoded = cjson.encode({nkeys, nscored, nprefix, nsuffix, ngeo, npositions, nbitmaps})
     redis.call('HSET', namespace .. '::', id, encoded)
 end
-return cjson.encode({changes=#nkeys + #nscored + #nprefix + #nsuffix + #ngeo + _changes})
+return cjson.encode({changes=#nkeys + #nscored + #nprefix + #nsuffix + #ngeo + #npositions + #nbitmaps + _changes})
 ''')
 
 def _fix_bytes(d):
@@ -809,7 +1257,8 @@ def _fix_bytes(d):
     raise TypeError
 
 def redis_writer_lua(conn, pkey, namespace, id, unique, udelete, delete,
-                     data, keys, scored, prefix, suffix, geo, old_data, is_delete):
+                     data, keys, scored, prefix, suffix, geo, old_data, is_delete,
+                     replicated=False, changed_indexes=(), positions=(), bitmaps=(), built=(), negative=False):
     '''
     ... Actually write data to Redis. This is an internal detail. Please don't
     call me directly.
@@ -824,7 +1273,8 @@ def redis_writer_lua(conn, pkey, namespace, id, unique, udelete, delete,
         item.append(_prefix_score(item[-1]))
 
     data = [json.dumps(x, default=_fix_bytes) for x in
-            (unique, udelete, delete, ldata, keys, scored, prefix, suffix, geo, is_delete, old_data)]
+            (unique, udelete, delete, ldata, keys, scored, prefix, suffix, geo, is_delete, old_data,
+             replicated, list(changed_indexes), list(positions), list(bitmaps), list(built), negative)]
     result = _redis_writer_lua(conn, [], [namespace, id] + data)
 
     if isinstance(result, client.BasePipeline):
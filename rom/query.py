@@ -8,6 +8,7 @@ Released under the LGPL license version 2.1 and version 3 (you can choose
 which you'd like to be bound under).
 '''
 
+import base64
 from collections import namedtuple
 from datetime import datetime, date, time as dtime
 from decimal import Decimal as _Decimal
@@ -18,8 +19,9 @@ import uuid
 import six
 
 from .exceptions import QueryError
-from .index import Geofilter, Pattern, Prefix, Suffix
-from .util import (_connect, session, dt2ts, t2ts, _script_load,
+from .index import (Expression, Geofilter, InList, Ngram, Pattern, Phrase,
+    Prefix, Search, Suffix, _literal_prefix, _pattern_trigrams)
+from .util import (_connect, session, dt2ts, t2ts, _script_load, _full_text_words, _redis_version,
     STRING_SORT_KEYGENS, STRING_SORT_KEYGENS_STR)
 
 _skip = None
@@ -31,6 +33,22 @@ NOT_NULL = (None, None)
 _STRING_SORT_KEYGENS = [ss.__name__ for ss in STRING_SORT_KEYGENS]
 ALLOWED_DIST = ('m', 'km', 'mi', 'ft')
 
+def _encode_cursor(score, id):
+    if isinstance(id, six.binary_type):
+        id = id.decode('latin-1')
+    data = json.dumps([score, id]).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('latin-1').rstrip('=')
+
+def _decode_cursor(cursor):
+    try:
+        if isinstance(cursor, six.text_type):
+            cursor = cursor.encode('latin-1')
+        data = base64.urlsafe_b64decode(cursor + b'=' * (-len(cursor) % 4))
+        score, id = json.loads(data.decode('utf-8'))
+        return float(score), str(id)
+    except Exception:
+        raise QueryError("Invalid cursor: %r"%(cursor,))
+
 def _dict_data_factory(columns):
     _dict = dict
     _zip = zip
@@ -57,19 +75,75 @@ def _list_data_factory(columns):
         return data
     return make
 
+class Q(object):
+    '''
+    A filter expression, for combining filters on different columns with
+    ``|`` (or), ``&`` (and), and ``~`` (not), to be passed to
+    ``Query.filter()``. Keyword arguments are the same as for
+    ``Query.filter()``, and are and-ed together::
+
+        # open or urgent tickets that aren't assigned to alice
+        Ticket.query.filter(
+            (Q(status='open') | Q(priority=(8, None))) & ~Q(assignee='alice')
+        ).order_by('-created_at').all()
+
+    The whole expression is evaluated in Redis in one call, with the smallest
+    filters applied first in each part of the expression.
+
+    .. note:: Negated expressions must be and-ed with some other filter, as
+      rom doesn't keep an index of all entities to subtract from.
+    '''
+    __slots__ = '_op _kwargs _children'.split()
+    def __init__(self, **kwargs):
+        self._op = 'and'
+        self._kwargs = kwargs
+        self._children = ()
+
+    @classmethod
+    def _combine(cls, op, children):
+        q = cls()
+        q._op = op
+        q._children = tuple(children)
+        return q
+
+    def __or__(self, other):
+        if not isinstance(other, Q):
+            return NotImplemented
+        return Q._combine('or', (self, other))
+
+    def __and__(self, other):
+        if not isinstance(other, Q):
+            return NotImplemented
+        return Q._combine('and', (self, other))
+
+    def __invert__(self):
+        return Q._combine('not', (self,))
+
+    def __repr__(self):
+        if self._op == 'not':
+            return '~%r'%(self._children[0],)
+        elif self._kwargs:
+            return 'Q(%s)'%(', '.join('%s=%r'%kv for kv in sorted(self._kwargs.items())),)
+        return '(%s)'%((' %s '%('|' if self._op == 'or' else '&')).join(map(repr, self._children)),)
+
 class Query(object):
     '''
     This is a query object. It behaves a lot like other query objects. Every
     operation performed on Query objects returns a new Query object. The old
     Query object *does not* have any updated filters.
     '''
-    __slots__ = '_model _filters _order_by _limit _select'.split()
-    def __init__(self, model, filters=(), order_by=None, limit=None, select=None):
+    __slots__ = '_model _filters _order_by _limit _select _hints _cache _flight _cursor'.split()
+    def __init__(self, model, filters=(), order_by=None, limit=None, select=None, hints=None, cache=None,
+                 flight=None, cursor=None):
         self._model = model
         self._filters = filters
         self._order_by = order_by
         self._limit = limit
         self._select = select
+        self._hints = hints
+        self._cache = cache
+        self._flight = flight
+        self._cursor = cursor
 
     def _check(self, column, value=None, which='order_by'):
         column = column.strip('-').partition(':')[0]
@@ -181,11 +255,15 @@ class Query(object):
             'order_by': self._order_by,
             'limit': self._limit,
             'select': self._select,
+            'hints': self._hints,
+            'cache': self._cache,
+            'flight': self._flight,
+            'cursor': self._cursor,
         }
         data.update(**kwargs)
         return Query(**data)
 
-    def filter(self, **kwargs):
+    def filter(self, *expressions, **kwargs):
         '''
         Only columns/attributes that have been specified as having an index with
         the ``index=True`` option on the column definition can be filtered with
@@ -209,6 +287,10 @@ class Query(object):
             # strings
             attribute=[string1, string2]
 
+            # to match any of several values of a numeric or ManyToOne /
+            # OneToOne column, pass a list of values (or entities)
+            attribute__in=[value1, value2, ...]
+
         As an example, the following will return entities that have both
         ``hello`` and ``world`` in the ``String`` column ``scol`` and has a
         ``Numeric`` column ``ncol`` with value between 2 and 10 (including the
@@ -228,6 +310,13 @@ class Query(object):
                 .filter(ncol=5) \\
                 .execute()
 
+        Filters across columns can be combined with ``or`` and ``not`` by
+        passing ``Q`` expressions, see ``Q`` for details::
+
+            results = MyModel.query \\
+                .filter(Q(scol='hello') | Q(ncol=(2, 10)), ~Q(scol='world')) \\
+                .all()
+
         .. note:: Trying to use a range query `attribute=(min, max)` on indexed
             string columns won't return any results.
         .. note:: This method only filters columns that have been defined with
@@ -235,7 +324,64 @@ class Query(object):
 
         '''
         cur_filters = list(self._filters)
+        for expr in expressions:
+            if not isinstance(expr, Q):
+                raise QueryError("Positional filters must be Q expressions, you provided %r"%(expr,))
+            expr = self._expression(expr)
+            if isinstance(expr, Expression) and expr.op == 'and':
+                # filters are already and-ed together
+                cur_filters.extend(expr.filters)
+            else:
+                cur_filters.append(expr)
+        cur_filters.extend(self._filter_list(kwargs))
+        return self.replace(filters=tuple(cur_filters))
+
+    def _expression(self, q):
+        # Turns a Q object into the filters (or Expression) it represents
+        if q._op == 'not':
+            return Expression('not', (self._expression(q._children[0]),))
+        filters = self._filter_list(q._kwargs)
+        for child in q._children:
+            child = self._expression(child)
+            if isinstance(child, Expression) and child.op == q._op:
+                filters.extend(child.filters)
+            else:
+                filters.append(child)
+        if not filters:
+            raise QueryError("Cannot filter with an empty Q() expression")
+        elif len(filters) == 1:
+            return filters[0]
+        if q._op == 'and' and all(isinstance(f, Expression) and f.op == 'not' for f in filters):
+            raise QueryError("Negated filters need another filter to be subtracted from")
+        return Expression(q._op, tuple(filters))
+
+    def _in_list(self, attr, values):
+        # Turns a list of numbers, dates, or entities into an in-list filter
+        from .columns import MODELS, OneToOne, ManyToOne, is_numeric
+        col = self._check(attr, which='filter')
+        if not (is_numeric(col._allowed) or isinstance(col, (OneToOne, ManyToOne))):
+            raise QueryError("Can only use '__in' filters on numeric and ManyToOne/OneToOne columns, not %r"%(attr,))
+        if not isinstance(values, (list, tuple, set, frozenset)):
+            raise QueryError("'__in' filters require a list of values, you provided %r"%(values,))
+        scores = {}
+        for v in values:
+            if isinstance(v, MODELS['Model']):
+                v = getattr(v, v._pkey)
+            elif isinstance(v, date):
+                v = dt2ts(v)
+            elif isinstance(v, dtime):
+                v = t2ts(v)
+            if isinstance(v, bool) or not isinstance(v, NUMERIC_TYPES):
+                raise QueryError("Can't filter %r by the non-numeric value %r"%(attr, v))
+            scores[float(v)] = repr(v) if isinstance(v, float) else str(v)
+        return InList(attr, tuple(scores[k] for k in sorted(scores)))
+
+    def _filter_list(self, kwargs):
+        cur_filters = []
         for attr, value in kwargs.items():
+            if attr.endswith('__in'):
+                cur_filters.append(self._in_list(attr[:-4], value))
+                continue
             self._check(attr, which='filter')
             if isinstance(value, bool):
                 value = str(bool(value))
@@ -279,7 +425,7 @@ class Query(object):
 
             else:
                 raise QueryError("Sorry, we don't know how to filter %r by %r"%(attr, value))
-        return self.replace(filters=tuple(cur_filters))
+        return cur_filters
 
     def startswith(self, **kwargs):
         '''
@@ -345,22 +491,160 @@ class Query(object):
           checked, so if you want to match a pattern that doesn't start at
           the beginning of a string, you should prefix it with one of the
           wildcard characters (like ``*`` as we did with the 'frank' pattern).
+
+        .. note:: On columns defined with ``ngram=True``, patterns without a
+          literal prefix of at least 3 characters only check the entities that
+          have all of the trigrams of the pattern's literal parts, instead of
+          scanning the whole prefix index.
         '''
         new = []
         for k, v in kwargs.items():
             v = self._check(k, v, 'like')
-            new.append(Pattern(k, v))
+            grams = k in self._model._ngram and len(_literal_prefix(v)) < 3 and _pattern_trigrams(v)
+            new.append(Ngram(k, v, sorted(grams)) if grams else Pattern(k, v))
         return self.replace(filters=self._filters+tuple(new))
 
+    def contains(self, **kwargs):
+        '''
+        When provided with keyword arguments of the form ``col=substring``,
+        this will limit the entities returned to those that have a word
+        containing the provided substring in the specified column(s). This
+        requires that the ``prefix=True`` option was provided during column
+        definition, and is much faster with ``ngram=True``.
+
+        Usage::
+
+            User.query.contains(email='smith').execute()
+
+        '''
+        patterns = {}
+        for k, v in kwargs.items():
+            if isinstance(v, six.binary_type):
+                v = v.decode('utf-8')
+            if any(c in v for c in '?*+!'):
+                raise QueryError("Cannot use wildcards in 'contains' clause on %r, use 'like' instead"%(k,))
+            patterns[k] = '*' + v
+        return self.like(**patterns)
+
+    def search(self, column, text, mode='all'):
+        '''
+        Limits the entities returned to those with all (``mode='all'``) or
+        any (``mode='any'``) of the words in ``text`` in the provided column,
+        which must have been defined with ``index=True`` and
+        ``keygen=FULL_TEXT_SCORED``. Unless an explicit ``order_by()`` is
+        used, results are ordered by their BM25 relevance score, best first,
+        which is calculated in Redis, so a limit only returns the best
+        matches.
+
+        Usage::
+
+            Post.query.search('body', 'redis python', mode='any').limit(0, 20).all()
+
+        '''
+        col = self._check(column, which='filter')
+        if col._keygen.__name__ != 'FULL_TEXT_SCORED':
+            raise QueryError("Cannot use 'search' clause on a column without keygen=FULL_TEXT_SCORED")
+        if mode not in ('all', 'any'):
+            raise QueryError("Text search mode must be one of 'all' or 'any', not %r"%(mode,))
+        terms = col._keygen(column, {column: text}) or {}
+        terms = sorted(k for k in terms if k)
+        if not terms:
+            raise QueryError("No words to search for in %r"%(text,))
+        return self.replace(filters=self._filters + (Search(column, tuple(terms), mode),))
+
+    def _words(self, column, text, which):
+        if column not in self._model._positions:
+            raise QueryError("Cannot use '%s' clause on a column defined with 'positions=False'"%(which,))
+        words = _full_text_words(text)
+        if not words:
+            raise QueryError("No words to search for in %r"%(text,))
+        return words
+
+    def phrase(self, column, text):
+        '''
+        Limits the entities returned to those with the words of ``text``
+        appearing in order in the provided column, which must have been
+        defined with ``positions=True``. Candidates are checked in Redis, so
+        only matching entities are returned.
+
+        Usage::
+
+            Post.query.phrase('body', 'object mapper').all()
+
+        '''
+        words = self._words(column, text, 'phrase')
+        return self.replace(filters=self._filters + (Phrase(column, tuple(words), None),))
+
+    def near_words(self, column, first, second, within=1):
+        '''
+        Limits the entities returned to those with the words ``first`` and
+        ``second`` at most ``within`` words apart (in either order) in the
+        provided column, which must have been defined with ``positions=True``.
+
+        Usage::
+
+            # "redis" and "python" at most 3 words apart
+            Post.query.near_words('body', 'redis', 'python', within=3).all()
+
+        '''
+        words = self._words(column, first, 'near_words') + self._words(column, second, 'near_words')
+        if len(words) != 2:
+            raise QueryError("Can only use 'near_words' clause with 2 words, not %r"%(words,))
+        if int(within) < 1:
+            raise QueryError("Words must be at least 1 word apart, not %r"%(within,))
+        return self.replace(filters=self._filters + (Phrase(column, tuple(words), int(within)),))
+
     def near(self, name, lon, lat, distance, measure, count=None):
+        '''
+        Filters to entities within ``distance`` (in ``measure`` units, one of
+        ``m``, ``km``, ``mi``, or ``ft``) of the provided longitude and
+        latitude in the named geo index, optionally limited to the ``count``
+        nearest entities::
+
+            # restaurants within 2 km
+            Shop.query.filter(tags='restaurant') \
+                .near('location', lon, lat, 2, 'km').execute()
+        '''
+        self._check_geo(name, measure)
+        return self.replace(filters=self._filters + (Geofilter(name, lon, lat, distance, measure.lower(), count),))
+
+    def near_box(self, name, lon, lat, width, height, measure, count=None):
+        '''
+        Like ``.near()``, but filters to entities inside of a ``width`` by
+        ``height`` box centered on the provided longitude and latitude.
+        Requires Redis 6.2+.
+        '''
+        self._check_geo(name, measure)
+        return self.replace(filters=self._filters + (
+            Geofilter(name, lon, lat, None, measure.lower(), count, width, height),))
+
+    def _check_geo(self, name, measure):
         if name not in self._model._geo:
             raise ValueError("provided index name must be defined as a geo index")
-
-        measure = measure.lower()
-        if measure not in ALLOWED_DIST:
+        if measure.lower() not in ALLOWED_DIST:
             raise ValueError("distance measure must be one of %r"%(ALLOWED_DIST,))
 
-        return self.replace(filters=self._filters + (Geofilter(name, lon, lat, distance, measure, count),))
+    def order_by_distance(self, name=None, descending=False):
+        '''
+        Orders the results by their distance from the center of the
+        ``.near()`` or ``.near_box()`` filter on the named geo index (which
+        can be omitted if there is only one), replacing any ``order_by()``
+        clause. The distances calculated by Redis during the geo search are
+        kept through the other filters, and can be returned with
+        ``.distances()``::
+
+            # the 10 nearest restaurants within 5 km
+            Shop.query.filter(tags='restaurant') \
+                .near('location', lon, lat, 5, 'km') \
+                .order_by_distance().limit(0, 10).execute()
+        '''
+        geo = [i for i, f in enumerate(self._filters)
+            if isinstance(f, Geofilter) and name in (None, f.name)]
+        if len(geo) != 1:
+            raise QueryError("You must order by the distance from exactly 1 geo filter, %i matched"%(len(geo),))
+        filters = [f._replace(order=0) if isinstance(f, Geofilter) else f for f in self._filters]
+        filters[geo[0]] = filters[geo[0]]._replace(order=-1 if descending else 1)
+        return self.replace(filters=tuple(filters), order_by=None)
 
     def order_by(self, column):
         '''
@@ -369,6 +653,11 @@ class Query(object):
             # returns all users, ordered by the created_at column in
             # descending order
             User.query.order_by('-created_at').execute()
+
+        String columns using the sortable keygens are ordered by the first 7
+        bytes of their values, unless they were defined with
+        ``lex_order=True``, in which case they are ordered by their full
+        values (but can't be paged through with ``.page()`` cursors).
         '''
         cname = column.lstrip('-')
         col = self._check(cname)
@@ -408,14 +697,66 @@ class Query(object):
             size = max(size - max(limit[0], 0), 0)
             return min(size, limit[1])
 
-        return self._model._gindex.count(_connect(self._model), filters)
+        conn = _connect(self._model)
+        if self._model._replica is not None:
+            count = self._model._replica.count(conn, filters)
+            if count is not None:
+                return count
+        return self._model._gindex.count(conn, filters, self._hints, self._cache, self._flight)
 
-    def _search(self):
+    def _search(self, data=False, page=False):
         if not (self._filters or self._order_by):
             raise QueryError("You are missing filter or order criteria")
         limit = () if not self._limit else self._limit
-        return self._model._gindex.search(
-            _connect(self._model), self._filters, self._order_by, *limit)
+        conn = _connect(self._model)
+        if self._cursor or page:
+            return self._page(conn, data, page)
+        if self._model._replica is not None:
+            ids = self._model._replica.search(conn, self._filters, self._order_by, *limit)
+            if ids is not None:
+                return self._model.get(ids) if data else ids
+        if not data:
+            return self._model._gindex.search(conn, self._filters, self._order_by,
+                *limit, hints=self._hints, cache=self._cache, single_flight=self._flight)
+
+        # ids and entity data come back together, only build entities that
+        # aren't already in the session
+        results = self._model._gindex.search(
+            conn, self._filters, self._order_by, *(limit or (None, None)),
+            data=True, hints=self._hints, cache=self._cache, single_flight=self._flight)
+        return self._entities(results)
+
+    def _entities(self, results):
+        model = self._model
+        ns = model._namespace
+        out = []
+        for id, data in results:
+            ent = session.get('%s:%s'%(ns, int(id)))
+            if ent is None and data:
+                data = iter(data)
+                ent = model._from_redis_data(dict(zip(data, data)))
+            if ent is not None:
+                out.append(ent)
+        return out
+
+    def _page(self, conn, data, page):
+        if not self._order_by:
+            raise QueryError("You must specify an order_by clause to use a cursor")
+        results, scores = self._model._gindex.search(
+            conn, self._filters, self._order_by, *(self._limit or (None, None)),
+            data=data, hints=self._hints, cache=self._cache, single_flight=self._flight,
+            cursor=self._cursor, page=True)
+        ids = [r[0] for r in results] if data else results
+        cursor = None
+        if self._cursor and not self._cursor[0]:
+            # going backwards, continue from the first result
+            if ids:
+                cursor = _encode_cursor(scores[0], ids[0])
+        elif ids:
+            cursor = _encode_cursor(scores[-1], ids[-1])
+        if data:
+            results = self._entities(results)
+        return (results, cursor) if page else results
 
     def iter_result(self, timeout=30, pagesize=100, no_hscan=False):
         '''
@@ -436,8 +777,7 @@ class Query(object):
             if self._model._columns[self._model._pkey]._index:
                 return self._iter_all_pkey()
             conn = _connect(self._model)
-            version = list(map(int, conn.info()['redis_version'].split('.')[:2]))
-            if version >= [2,8] and not no_hscan:
+            if _redis_version(conn) >= (2, 8) and not no_hscan:
                 return self._iter_all_hscan()
             return self._iter_all()
         return self._iter_results(timeout, pagesize)
@@ -651,7 +991,173 @@ class Query(object):
         if timeout < 1:
             raise QueryError("You must specify a timeout >= 1, you gave %r"%timeout)
         return self._model._gindex.search(
-            _connect(self._model), self._filters, self._order_by, timeout=timeout)
+            _connect(self._model), self._filters, self._order_by, timeout=timeout,
+            hints=self._hints, single_flight=self._flight)
+
+    def after(self, cursor):
+        '''
+        Only returns results ordered after the result that the provided
+        cursor (from ``.page()``) was created for. Unlike offsets from
+        ``.limit()``, each page costs about the same to fetch no matter how
+        far into the results it is, and entities added or deleted before the
+        cursor won't shift the page. Requires an ``order_by()`` clause, and
+        can't be used with geo filters.
+
+        Usage::
+
+            users, cursor = User.query.order_by('created_at').page(25)
+            while cursor:
+                more, cursor = User.query.order_by('created_at') \\
+                    .after(cursor).page(25)
+        '''
+        score, id = _decode_cursor(cursor)
+        return self.replace(cursor=(True, score, id))
+
+    def before(self, cursor):
+        '''
+        Only returns results ordered before the result that the provided
+        cursor (from ``.page()``) was created for, still in the query's
+        order. Use to page backwards, see ``.after()``.
+        '''
+        score, id = _decode_cursor(cursor)
+        return self.replace(cursor=(False, score, id))
+
+    def page(self, count):
+        '''
+        Returns a ``(entities, cursor)`` tuple with up to ``count`` entities,
+        and a cursor to pass to ``.after()`` to get the next page (or to
+        ``.before()`` to get the previous page, when this query used
+        ``.before()``). The cursor is ``None`` when there were no results.
+        '''
+        if count <= 0:
+            raise QueryError("You must specify a count > 0, you gave %r"%(count,))
+        offset = self._limit[0] if self._limit else 0
+        return self.limit(offset, count)._search(data=True, page=True)
+
+    def single_flight(self, wait=1):
+        '''
+        When many callers run the same query at the same time (say, when a
+        popular page's cached results expire), only the first will calculate
+        the results, which are then shared with the others for ``wait``
+        seconds instead of being recalculated by each caller.
+
+        Shared results are discarded as soon as a relevant write happens (the
+        same as with ``.cache()``), except for queries with geo filters, whose
+        shared results may be up to ``wait`` seconds old. Concurrent callers
+        of ``.cached_result()`` each receive their own copy of the shared
+        results.
+
+        Usage::
+
+            Post.query.filter(published=True).order_by('-score') \\
+                .single_flight().limit(0, 25).all()
+        '''
+        if wait <= 0:
+            raise QueryError("You must specify a wait > 0, you gave %r"%(wait,))
+        return self.replace(flight=wait)
+
+    def cache(self, ttl, stale=0):
+        '''
+        Caches the results of this query in Redis for up to ``ttl`` seconds.
+        Cached results are automatically invalidated when an entity is
+        written with changes to any column used by the query's filters or
+        order (rom keeps a version counter per index for this). Limits are
+        applied when reading cached results, so all pages of a query share
+        one cached result.
+
+        If ``stale`` is provided, results that were invalidated (or are older
+        than ``ttl``) will continue to be returned for up to ``stale`` more
+        seconds, while being recalculated in a background thread.
+
+        Usage::
+
+            # cache the 25 most recent posts for 60 seconds
+            Post.query.filter(published=True).order_by('-created_at') \\
+                .limit(0, 25).cache(60).all()
+
+            # an expensive report that may be up to 5 minutes out of date
+            Order.query.filter(status='open', total=(1000, None)) \\
+                .cache(60, stale=300).count()
+
+        .. note:: The result cache is used by ``.all()``, ``.first()``,
+          ``.count()``, and ``.execute()``, but not for queries with geo
+          filters, or by ``.iter_result()`` and ``.cached_result()``.
+        '''
+        ttl = int(ttl)
+        if ttl < 1:
+            raise QueryError("You must specify a ttl >= 1, you gave %r"%ttl)
+        return self.replace(cache={'ttl': ttl, 'stale': max(int(stale), 0)})
+
+    def hint(self, order=None, subrange=None, walk=None, probe=None):
+        '''
+        Overrides the query planner for this query. Filters on the columns
+        named in ``order`` are applied first, in the provided order (the rest
+        are applied smallest first). Passing ``subrange=False`` prevents the
+        planner from pulling a sub-range out of a numeric index for the first
+        filter (``True`` forces it when the first filter is a numeric range).
+
+        Ordered queries with a small limit may walk the ``order_by`` index
+        from the front, checking each entity against the filters, and stop
+        once enough results are found instead of intersecting every filter.
+        The planner only does this when it expects the walk to be cheaper;
+        pass ``walk=False`` to never walk, or ``walk=True`` to always walk
+        when possible.
+
+        When the results so far are much smaller than a later list or ``Q``
+        expression filter, each result is checked against the filter instead
+        of copying the filter's ids into a temporary key. Pass
+        ``probe=False`` to never check results this way, or ``probe=True``
+        to always do so when possible.
+
+        Usage::
+
+            # apply the 'status' filter before the 'created_at' range
+            Order.query \\
+                .filter(status='open', created_at=(start, end)) \\
+                .hint(order=['status'], subrange=False) \\
+                .all()
+
+        .. note:: Hints only change the order in which filters are applied,
+          not the results. Use ``.explain()`` to see the effect.
+        '''
+        for name in order or ():
+            self._check(name, which='hint')
+        return self.replace(hints={'order': list(order or ()), 'subrange': subrange, 'walk': walk,
+            'probe': probe})
+
+    def explain(self, analyze=False):
+        '''
+        Returns a dictionary describing how this query will be executed,
+        without executing it::
+
+            {
+                'script': True,     # single-script execution (False for geo queries)
+                'steps': [{
+                    'filter': 'col:value',  # the filter, in the order applied
+                    'estimate': 12,         # estimated number of matches
+                    'stats': False,         # estimate from index statistics
+                    'subrange': False,      # sub-range pulled from the index
+                    'commands': 2,          # roughly how many Redis commands
+                    'probe': False,         # results checked against the filter
+                    ...
+                }, ...],
+                'commands': 7,      # roughly how many Redis commands total
+                'temp_keys': 1,     # temporary keys used
+                'empty': False,     # known to match nothing before running
+                'walk': False,      # walks the order index (see .hint())
+                'order_by': None,
+            }
+
+        If ``analyze=True`` is passed, the query will be run (without fetching
+        results) and each step will include the ``size`` of the result after
+        the step and the server time taken in microseconds (``usec``), along
+        with the total ``time`` in seconds, measured by the client.
+        '''
+        if not (self._filters or self._order_by):
+            raise QueryError("You are missing filter or order criteria")
+        offset, count = self._limit or (None, None)
+        return self._model._gindex.explain(_connect(self._model),
+            self._filters, self._order_by, self._hints, analyze, offset, count)
 
     def execute(self):
         '''
@@ -661,7 +1167,7 @@ class Query(object):
         '''
         if not self._filters and not self._order_by:
             return list(self)
-        return self._model.get(self._search())
+        return self._search(data=True)
 
     def all(self):
         '''
@@ -669,6 +1175,25 @@ class Query(object):
         '''
         return self.execute()
 
+    def distances(self):
+        '''
+        Returns a list of ``(entity, distance)`` tuples for a query ordered
+        with ``.order_by_distance()``, with each distance (in the units of
+        the geo filter) as calculated by Redis during the search::
+
+            for shop, km in Shop.query.near('location', lon, lat, 5, 'km') \
+                    .order_by_distance().limit(0, 10).distances():
+                print(shop.name, km)
+        '''
+        if self._order_by or not any(isinstance(f, Geofilter) and f.order for f in self._filters):
+            raise QueryError("You must use order_by_distance() to get distances")
+        results, scores = self._model._gindex.search(
+            _connect(self._model), self._filters, None, *(self._limit or (None, None)),
+            data=True, hints=self._hints, single_flight=self._flight, page=True)
+        # descending distances were negated to order them
+        return [(ent, abs(score)) for result, score in zip(results, scores)
+            for ent in self._entities([result])]
+
     def first(self):
         '''
         Returns only the first result from the query, if any.
@@ -680,10 +1205,8 @@ class Query(object):
             for ent in self:
                 return ent
             return None
-        ids = self.limit(*lim)._search()
-        if ids:
-            return self._model.get(ids[0])
-        return None
+        ents = self.limit(*lim)._search(data=True)
+        return ents[0] if ents else None
 
 def _select_generator(lst, model, cols, decode, remove_last, factory):
     final = factory(cols[:-1]) if remove_last else factory(cols)
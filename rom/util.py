@@ -139,6 +139,7 @@ from collections import deque
 from datetime import datetime, date, time as dtime
 from hashlib import sha1
 from itertools import chain
+import json
 import math
 import os
 import string
@@ -150,7 +151,7 @@ import warnings
 import redis
 import six
 
-from .exceptions import DataRaceError, ORMError
+from .exceptions import DataRaceError, InvalidOperation, ORMError
 
 if six.PY3:
     import binascii
@@ -192,6 +193,19 @@ def _connect(obj):
         return obj.CONN
     return get_connection()
 
+_server_versions = weakref.WeakKeyDictionary()
+def _redis_version(conn):
+    '''
+    Returns the ``(major, minor)`` version of the Redis server behind the
+    connection (or pipeline), cached per connection pool.
+    '''
+    pool = conn.connection_pool
+    version = _server_versions.get(pool)
+    if version is None:
+        version = tuple(map(int, conn.info()['redis_version'].split('.')[:2]))
+        _server_versions[pool] = version
+    return version
+
 class ClassProperty(object):
     '''
     Borrowed from: https://gist.github.com/josiahcarlson/1561563
@@ -251,12 +265,8 @@ def _numeric_keygen(val):
 def _boolean_keygen(val):
     return [str(bool(val))]
 
-def FULL_TEXT(val):
-    '''
-    This is a basic full-text index keygen function. Words are lowercased, split
-    by whitespace, and stripped of punctuation from both ends before an inverted
-    index is created for term searching.
-    '''
+def _full_text_words(val):
+    # The words of a value for full-text indexes, in order, with repeats
     if isinstance(val, float):
         val = repr(val)
     elif val in (None, ''):
@@ -266,11 +276,40 @@ def FULL_TEXT(val):
             val = val.decode('latin-1')
         else:
             val = str(val)
-    r = sorted(set([x for x in [s.lower().strip(string.punctuation) for s in val.split()] if x]))
+    r = [x for x in [s.lower().strip(string.punctuation) for s in val.split()] if x]
     if not isinstance(val, str):  # unicode on py2k
         return [s.encode('utf-8') for s in r]
     return r
 
+def FULL_TEXT(val):
+    '''
+    This is a basic full-text index keygen function. Words are lowercased, split
+    by whitespace, and stripped of punctuation from both ends before an inverted
+    index is created for term searching.
+    '''
+    words = _full_text_words(val)
+    if words is None:
+        return None
+    return sorted(set(words))
+
+def FULL_TEXT_SCORED(val):
+    '''
+    The same as ``FULL_TEXT``, only each word is indexed with the number of
+    times it occurs, and the number of words is kept as the column's score.
+    Columns using this keygen can be filtered on like ``FULL_TEXT`` columns,
+    and also support relevance-ranked searches with ``Query.search()``.
+
+    .. note:: Prefix, suffix, and pattern matching are not supported with
+      this keygen.
+    '''
+    words = _full_text_words(val)
+    if not words:
+        return None
+    out = {'': len(words)}
+    for word in words:
+        out[word] = out.get(word, 0) + 1
+    return out
+
 # For compatability with the rest of the package, as well as those who are
 # explicitly using this keygen as part of query calculation.
 _string_keygen = FULL_TEXT
@@ -334,7 +373,7 @@ def IDENTITY_CI(val):
     '''
     return IDENTITY(val.lower())
 
-STRING_INDEX_KEYGENS = (FULL_TEXT, SIMPLE, SIMPLE_CI, IDENTITY, IDENTITY_CI, CASE_INSENSITIVE)
+STRING_INDEX_KEYGENS = (FULL_TEXT, FULL_TEXT_SCORED, SIMPLE, SIMPLE_CI, IDENTITY, IDENTITY_CI, CASE_INSENSITIVE)
 STRING_INDEX_KEYGENS_STR = ', '.join(x.__name__ for x in STRING_INDEX_KEYGENS)
 STRING_SORT_KEYGENS = (SIMPLE, SIMPLE_CI, CASE_INSENSITIVE)
 STRING_SORT_KEYGENS_STR = ', '.join(x.__name__ for x in STRING_SORT_KEYGENS)
@@ -559,16 +598,28 @@ class Session(threading.local):
         And all provided entities will be reloaded from Redis.
 
         To force reloading for modified entities, you can pass ``force=True``.
+
+        All entities are refreshed with one round trip per Redis connection,
+        and entities whose data hasn't changed in Redis are not transferred or
+        re-initialized.
         '''
         self._init()
         from rom import Model
+        from rom.model import _refresh_entities
         force = kwargs.get('force')
-        for o in objects:
+        items = deque(objects)
+        to_refresh = []
+        while items:
+            o = items.popleft()
             if isinstance(o, (list, tuple)):
-                self.refresh(*o, force=force)
+                items.extendleft(reversed(o))
             elif isinstance(o, Model):
-                if not o._new:
-                    o.refresh(force=force)
+                if o._deleted:
+                    continue
+                elif not o._new:
+                    if o._modified and not force:
+                        raise InvalidOperation("Cannot refresh a modified entity without passing force=True to override modified data")
+                    to_refresh.append(o)
                 else:
                     # all objects are re-added to the session after refresh,
                     # except for deleted entities...
@@ -577,6 +628,8 @@ class Session(threading.local):
                 raise ORMError(
                     "Cannot refresh an object that is not an instance of a Model (you provided %r)"%(
                         o,))
+        if to_refresh:
+            _refresh_entities(to_refresh)
 
     def refresh_all(self, *objects, **kwargs):
         '''
@@ -590,7 +643,7 @@ class Session(threading.local):
 
         To force reloading for modified entities, you can pass ``force=True``.
         '''
-        self.refresh(*self.known.values(), force=kwargs.get('force'))
+        self.refresh(*list(self.known.values()), force=kwargs.get('force'))
 
 def use_null_session():
     '''
@@ -616,6 +669,207 @@ def use_rom_session():
 
 session = Session()
 
+class Deferred(object):
+    '''
+    A future-like placeholder for an entity requested with
+    ``Model.get_deferred()``. Call ``.result()`` to get the entity (or
+    ``None`` if it doesn't exist), which will load every outstanding deferred
+    entity in the current ``batch()`` at the same time.
+    '''
+    __slots__ = 'model', 'id', '_batch', '_result', '_done'
+    def __init__(self, model, id, batch):
+        self.model = model
+        self.id = id
+        self._batch = batch
+        self._result = None
+        self._done = False
+
+    def _set(self, result):
+        self._result = result
+        self._done = True
+        self._batch = None
+
+    def done(self):
+        '''
+        Returns whether the entity has already been loaded.
+        '''
+        return self._done
+
+    def result(self):
+        '''
+        Returns the entity, loading it (and all other outstanding entities in
+        the same batch) if necessary.
+        '''
+        if not self._done:
+            self._batch.resolve()
+        return self._result
+
+class Batch(object):
+    '''
+    Collects calls to ``Model.get_deferred()`` so that all outstanding
+    entities, across all models, are fetched from Redis with one pipelined
+    round trip (per connection) when the first result is needed, or when the
+    ``with`` block exits. You should use ``rom.batch()`` to create these.
+    '''
+    def __init__(self):
+        self.pending = []
+        self.known = {}
+
+    def add(self, model, id):
+        pk = '%s:%s'%(model._namespace, int(id))
+        deferred = self.known.get(pk)
+        if deferred is None:
+            deferred = self.known[pk] = Deferred(model, int(id), self)
+            self.pending.append(deferred)
+        return deferred
+
+    def resolve(self):
+        '''
+        Loads all outstanding deferred entities.
+        '''
+        pending, self.pending = self.pending, []
+        pipes = {}
+        versions = {}
+        for deferred in pending:
+            model = deferred.model
+            pk = '%s:%s'%(model._namespace, deferred.id)
+            ent = session.get(pk)
+            if ent is not None or model._replica is not None:
+                deferred._set(ent or model.get(deferred.id))
+                continue
+            conn = _connect(model)
+            if model._negative is not None:
+                if model not in versions:
+                    versions[model] = model._negative.version(conn)
+                if model._negative.missing(pk, versions[model]):
+                    deferred._set(None)
+                    continue
+            if id(conn) not in pipes:
+                pipes[id(conn)] = (conn.pipeline(True), [])
+            pipe, waiting = pipes[id(conn)]
+            pipe.hgetall('%s:%s'%(model._namespace, deferred.id))
+            waiting.append(deferred)
+
+        for pipe, waiting in pipes.values():
+            for deferred, data in zip(waiting, pipe.execute()):
+                # another deferred load may have put it in the session
+                ent = session.get('%s:%s'%(deferred.model._namespace, deferred.id))
+                if ent is None and data:
+                    ent = deferred.model._from_redis_data(data)
+                elif ent is None and deferred.model._negative is not None:
+                    deferred.model._negative.add(['%s:%s'%(deferred.model._namespace, deferred.id)],
+                        versions[deferred.model])
+                deferred._set(ent)
+
+    def __enter__(self):
+        _batches.stack.append(self)
+        return self
+
+    def __exit__(self, *args):
+        _batches.stack.remove(self)
+        self.resolve()
+
+class _BatchStack(threading.local):
+    def __init__(self):
+        self.stack = []
+
+_batches = _BatchStack()
+
+def batch():
+    '''
+    Returns a context manager inside of which ``Model.get_deferred(id)``
+    returns a ``Deferred`` entity instead of fetching the entity immediately.
+    All outstanding deferred entities (across all models) are fetched together
+    the first time any of their results are needed, or when the block exits.
+    Entities already known by the session are not re-fetched.
+
+    Usage::
+
+        with rom.batch():
+            user = User.get_deferred(user_id)
+            post = Post.get_deferred(post_id)
+            ...
+            # fetches both in one round trip
+            print(user.result().email)
+    '''
+    return Batch()
+
+def current_batch():
+    '''
+    Returns the innermost active ``batch()``, if any.
+    '''
+    return _batches.stack[-1] if _batches.stack else None
+
+NEGATIVE_CACHE_TTL = 1.0
+NEGATIVE_CACHE_SIZE = 10000
+
+class NegativeCache(object):
+    '''
+    A process-local cache of recent misses (entity ids and unique column
+    values that didn't exist in Redis) for models defined with
+    ``negative_cache = True`` (or a TTL in seconds). Entries expire after the
+    TTL, and are ignored as soon as any process writes a new entity or unique
+    value to the model, which increments the ``<namespace>::nver`` counter
+    that each entry was recorded with.
+    '''
+    def __init__(self, namespace, ttl=NEGATIVE_CACHE_TTL, size=NEGATIVE_CACHE_SIZE):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.size = size
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def version(self, conn):
+        '''
+        Returns the current version of the model's entities and unique values,
+        read before looking keys up (see ``.missing()`` and ``.add()``).
+        '''
+        return int(conn.get('%s::nver'%self.namespace) or 0)
+
+    def missing(self, key, version):
+        '''
+        Returns whether the key was recently found to be missing, and nothing
+        was written to the model since.
+        '''
+        entry = self.entries.get(key)
+        if entry is None:
+            return False
+        if entry[0] < time.time() or entry[1] != version:
+            self.entries.pop(key, None)
+            return False
+        return True
+
+    def add(self, keys, version):
+        '''
+        Records the provided keys as missing as of the provided version.
+        '''
+        expires = (time.time() + self.ttl, version)
+        with self.lock:
+            if len(self.entries) + len(keys) > self.size:
+                now = time.time()
+                for k, v in list(self.entries.items()):
+                    if v[0] < now:
+                        del self.entries[k]
+                if len(self.entries) + len(keys) > self.size:
+                    self.entries.clear()
+            for k in keys:
+                self.entries[k] = expires
+
+    def discard(self, keys):
+        '''
+        Removes the provided keys from the cache.
+        '''
+        with self.lock:
+            for k in keys:
+                self.entries.pop(k, None)
+
+    def clear(self):
+        '''
+        Removes all entries from the cache.
+        '''
+        with self.lock:
+            self.entries.clear()
+
 def refresh_indices(model, block_size=100):
     '''
     This utility function will iterate over all entities of a provided model,
@@ -636,6 +890,9 @@ def refresh_indices(model, block_size=100):
         for progress, total in refresh_indices(MyModel, block_size=200):
             print "%s of %s"%(progress, total)
 
+    Composite and bitmap indexes added to a model with existing entities
+    aren't used by queries until this has finished.
+
     .. note:: This uses the session object to handle index refresh via calls to
       ``.commit()``. If you have any outstanding entities known in the
       session, they will be committed.
@@ -650,6 +907,9 @@ def refresh_indices(model, block_size=100):
         # re-save un-modified data, resulting in index-only updates
         session.commit(all=True)
         yield min(i+block_size, max_id), max_id
+    # every entity has now been written with the composite and bitmap indexes
+    for name in model._gindex.built_indexes:
+        conn.hset('%s::built'%model._namespace, name, 1)
 
 def clean_old_index(model, block_size=100, **kwargs):
     '''
@@ -673,8 +933,7 @@ def clean_old_index(model, block_size=100, **kwargs):
     '''
 
     conn = _connect(model)
-    version = list(map(int, conn.info()['redis_version'].split('.')[:2]))
-    has_hscan = version >= [2, 8]
+    has_hscan = _redis_version(conn) >= (2, 8)
     pipe = conn.pipeline(True)
     prefix = '%s:'%model._namespace
     index = prefix + ':'
@@ -734,6 +993,130 @@ def clean_old_index(model, block_size=100, **kwargs):
     yield max_id, max_id
 
 
+def update_index_stats(model, buckets=16, terms=100, block_size=1000):
+    '''
+    This utility function will sample the indexes of a provided model and
+    store statistics used by the query planner in the ``<namespace>::stats``
+    hash. For numeric indexes, the statistics are the index cardinality and
+    an equi-depth histogram of the index scores. For string indexes, they are
+    the number of distinct indexed terms, the counts of the most common terms,
+    and an upper bound on the count of the remaining terms.
+
+    Once statistics exist, queries estimate filter sizes from them instead of
+    asking Redis. Run this periodically (from a cron job or background
+    thread) to keep the statistics up to date.
+
+    Arguments:
+
+        * *model* - the model whose indexes you want statistics for
+        * *buckets* - the number of histogram buckets for numeric indexes
+        * *terms* - the number of most common terms to keep for string
+          indexes
+        * *block_size* - the number of keys to check at a time
+
+    This function will yield its progression through the indexed columns.
+
+    Example use::
+
+        show_progress(update_index_stats(MyModel))
+    '''
+    conn = _connect(model)
+    ns = model._namespace
+    buckets = max(int(buckets), 1)
+    columns = sorted(model._index)
+    for i, attr in enumerate(columns):
+        stats = {'updated': time.time()}
+        idx = '%s:%s:idx'%(ns, attr)
+        card = conn.zcard(idx) if conn.type(idx) in (b'zset', 'zset') else 0
+        if card:
+            pipe = conn.pipeline(False)
+            for b in range(buckets + 1):
+                rank = int(round(b * (card - 1) / float(buckets)))
+                pipe.zrange(idx, rank, rank, withscores=True)
+            stats['card'] = card
+            stats['bounds'] = [r[0][1] for r in pipe.execute() if r]
+
+        prefix = '%s:%s:'%(ns, attr)
+        counts = []
+        keys = 0
+        for block in _scan_blocks(conn, prefix + '*:idx', block_size):
+            keys += len(block)
+            for key, count in zip(block, _key_sizes_lua(conn, block)):
+                term = key[len(prefix):-4]
+                if six.PY3 and isinstance(term, bytes):
+                    term = term.decode('utf-8', 'replace')
+                counts.append((count, term))
+                if len(counts) > 2 * terms:
+                    counts.sort(reverse=True)
+                    del counts[terms:]
+        if keys:
+            counts.sort(reverse=True)
+            stats['keys'] = keys
+            stats['terms'] = dict((t, c) for c, t in counts[:terms])
+            stats['other'] = counts[terms][0] if len(counts) > terms else 0
+
+        if len(stats) > 1:
+            conn.hset('%s::stats'%ns, attr, json.dumps(stats))
+        else:
+            conn.hdel('%s::stats'%ns, attr)
+        yield i + 1, len(columns)
+
+def migrate_prefix_index(model, block_size=1000, delete=True):
+    '''
+    This utility function will copy the prefix and suffix indexes of a
+    provided model from the score-based layout used by rom versions before
+    0.40.0 (``<namespace>:<column>:pre`` and ``:suf``) to the layout used by
+    later versions (``<namespace>:<column>:pre:lex`` and ``:suf:lex``), which
+    supports prefixes of any length and doesn't write to Redis during
+    queries. Entities written during the migration are indexed in both
+    layouts, and queries use the older layout until the migration is done.
+    Models whose first entity was written by rom 0.40.0 or later don't need
+    to be migrated.
+
+    Arguments:
+
+        * *model* - the model whose indexes you want to migrate
+        * *block_size* - the maximum number of index entries to copy at a
+          time, defaulting to 1000
+        * *delete* - whether to delete the older indexes when done
+
+    This function will yield its progression through the indexes.
+
+    Example use::
+
+        show_progress(migrate_prefix_index(MyModel))
+    '''
+    conn = _connect(model)
+    ns = model._namespace
+    keys = ['%s:%s:pre'%(ns, attr) for attr in sorted(model._prefix)]
+    keys += ['%s:%s:suf'%(ns, attr) for attr in sorted(model._suffix)]
+    block_size = max(block_size, 10)
+    if conn.exists(ns + '::lex'):
+        yield 1, 1
+        return
+    total = sum(conn.zcard(key) for key in keys)
+    done = 0
+    for key in keys:
+        last = ''
+        while True:
+            copied, last = _copy_lex_lua(conn, [key, key + ':lex'], [last, block_size])
+            done += copied
+            yield done, max(total, done)
+            if not copied:
+                break
+    conn.set(ns + '::lex', 1)
+    if delete and keys:
+        conn.delete(*keys)
+    yield max(total, done), max(total, done)
+
+def _scan_blocks(conn, match, block_size):
+    cursor = None
+    while cursor not in (0, b'0', '0'):
+        cursor, keys = conn.scan(cursor or 0, match=match, count=block_size)
+        if keys:
+            yield keys
+
+
 def show_progress(job):
     '''
     This utility function will print the progress of a passed iterator job as
@@ -803,6 +1186,50 @@ def _script_load(script):
 
     return call
 
+_copy_lex_lua = _script_load('''
+-- copies the next block of entries after the last one copied
+local start = 0
+local last = ARGV[1]
+if #last > 0 then
+    -- the last entry could have been deleted, so put it back to find our place
+    local score = string.sub(last, 1, string.find(last, ':', 1, true) - 1)
+    local member = string.sub(last, #score + 2)
+    local added = redis.call('ZADD', KEYS[1], score, member)
+    start = tonumber(redis.call('ZRANK', KEYS[1], member)) + 1
+    if added == 1 then
+        redis.call('ZREM', KEYS[1], member)
+        start = start - 1
+    end
+end
+
+local items = redis.call('ZRANGE', KEYS[1], start, start + tonumber(ARGV[2]) - 1, 'WITHSCORES')
+local add = {}
+for i = 1, #items, 2 do
+    table.insert(add, 0)
+    table.insert(add, items[i])
+end
+if #add > 0 then
+    redis.call('ZADD', KEYS[2], unpack(add))
+    last = items[#items] .. ':' .. items[#items - 1]
+end
+return {#add / 2, last}
+''')
+
+_key_sizes_lua = _script_load('''
+local sizes = {}
+for i, key in ipairs(KEYS) do
+    local typ = redis.pcall('TYPE', key).ok
+    if typ == 'set' then
+        sizes[i] = redis.call('SCARD', key)
+    elseif typ == 'zset' then
+        sizes[i] = redis.call('ZCARD', key)
+    else
+        sizes[i] = 0
+    end
+end
+return sizes
+''')
+
 _scan_index_lua = _script_load('''
 local page = redis.call('HSCAN', KEYS[1], ARGV[1], 'COUNT', ARGV[2] or 100)
 local clear = {}
@@ -829,7 +1256,7 @@ for _, id in ipairs(ARGV) do
     if idata then
         cleaned = cleaned + 1
         idata = cjson.decode(idata)
-        while #idata < 4 do
+        while #idata < 7 do
             idata[#idata + 1] = {}
         end
         for i, key in ipairs(idata[1]) do
@@ -850,6 +1277,7 @@ for _, id in ipairs(ARGV) do
             local key = namespace .. ':' .. data[1] .. ':pre'
             local mem = data[2] .. '\0' .. id
             redis.call('ZREM', key, mem)
+            redis.call('ZREM', key .. ':lex', mem)
         end
         for i, data in ipairs(idata[4]) do
             local key = string.format('%s:%s:suf', namespace, data[1])
@@ -859,6 +1287,13 @@ for _, id in ipairs(ARGV) do
             local key = namespace .. ':' .. data[1] .. ':suf'
             local mem = data[2] .. '\0' .. id
             redis.call('ZREM', key, mem)
+            redis.call('ZREM', key .. ':lex', mem)
+        end
+        for i, attr in ipairs(idata[6]) do
+            redis.call('HDEL', namespace .. ':' .. attr .. ':pos', id)
+        end
+        for i, key in ipairs(idata[7]) do
+            redis.call('SETBIT', namespace .. ':' .. key .. ':bm', id, 0)
         end
         redis.call('HDEL', namespace .. '::', id)
     end
@@ -891,7 +1326,7 @@ class Lock(object):
     def _acquire(self):
         self.identifier = self.identifier or str(_random_hex(16))
         return _acquire_refresh_lock_with_timeout_lua(
-            self.conn, [self.lockname], [self.lock_timeout, self.identifier]) in ('OK', 1)
+            self.conn, [self.lockname], [self.lock_timeout, self.identifier]) in ('OK', b'OK', 1)
 
     def acquire(self):
         acquired = False
@@ -0,0 +1,79 @@
+'''
+Rom - the Redis object mapper for Python
+
+Copyright 2013-2016 Josiah Carlson
+
+Released under the LGPL license version 2.1 and version 3 (you can choose
+which you'd like to be bound under).
+
+Compares the range filter paths of the query script: ZRANGESTORE (Redis
+6.2+), copying the sub-range in Lua, and intersecting the whole index, for
+ranges covering from 0.1% to 90% of the index. Uses (and flushes) db 15::
+
+    PYTHONPATH=`pwd` python test/bench_range.py [entities]
+'''
+
+from __future__ import print_function
+import sys
+import time
+
+import redis
+
+from rom import index, util
+from rom import *
+
+util.CONNECTION = redis.Redis(db=15)
+
+WIDTHS = [.001, .01, .1, .25, .5, .9]
+PASSES = 5
+
+class RomBenchRange(Model):
+    num = Integer(index=True)
+    tag = String(index=True, keygen=IDENTITY)
+
+def setup(conn, count):
+    conn.flushdb()
+    # Only the indexes are read, so they are written directly instead of
+    # saving entities.
+    pipe = conn.pipeline(False)
+    for start in range(0, count, 10000):
+        ids = range(start, min(start + 10000, count))
+        pipe.execute_command('ZADD', 'RomBenchRange:num:idx',
+            *[x for id in ids for x in (id, id)])
+        pipe.sadd('RomBenchRange:tag:all:idx', *ids)
+        pipe.execute()
+
+def timed(query):
+    best = None
+    for _ in range(PASSES):
+        t = time.time()
+        result = query.count()
+        best = min(best, time.time() - t) if best is not None else time.time() - t
+    return best, result
+
+def main(count):
+    conn = util.CONNECTION
+    setup(conn, count)
+    has = util._redis_version(conn) >= (6, 2)
+    paths = [('intersect', False, False), ('lua copy', False, True)]
+    if has:
+        paths.append(('zrangestore', True, True))
+    print("%i entities, Redis %s.%s"%((count,) + util._redis_version(conn)))
+    print("%8s %8s "%('width', 'matches') + ' '.join('%12s'%p[0] for p in paths))
+    store = index.RANGE_STORE
+    try:
+        for width in WIDTHS:
+            # the range goes first, then is intersected with the tag index
+            query = RomBenchRange.query.filter(num=(0, int(count * width) - 1), tag='all')
+            times = []
+            for _, rangestore, subrange in paths:
+                index.RANGE_STORE = rangestore
+                took, matches = timed(query.hint(order=['num'], subrange=subrange, walk=False, probe=False))
+                times.append(took)
+            print("%7.1f%% %8i "%(width * 100, matches) + ' '.join('%10.2fms'%(t * 1000) for t in times))
+    finally:
+        index.RANGE_STORE = store
+        conn.flushdb()
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
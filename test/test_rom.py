@@ -21,7 +21,7 @@ import warnings
 import redis
 import six
 
-from rom import util
+from rom import index, util
 
 util.CONNECTION = redis.Redis(db=15)
 connect = util._connect
@@ -1478,6 +1478,58 @@ class TestORM(unittest.TestCase):
         self.assertEqual(a.query.filter(tags='restaurant').near('basic', 1, 0, 60, 'km').count(), 0)
         self.assertEqual(a.query.filter(tags='restaurant').near('basic', 0, 1, 60, 'km').count(), 0)
 
+    def test_geo_distance(self):
+        conn = connect(None)
+        if util._redis_version(conn) < (3, 2):
+            print("Skipping geo tests")
+            return
+
+        class RomTestGeoDistance(Model):
+            tags = String(index=True, keygen=FULL_TEXT)
+            num = Integer(index=True)
+            lat = Float()
+            lon = Float()
+            geo_index = [
+                GeoIndex('basic', lambda x: {'lat':x.lat, 'lon':x.lon})
+            ]
+
+        for i, tags in enumerate(['a b', 'a', 'b', 'a b', 'a']):
+            RomTestGeoDistance(lat=0, lon=.1 * (i + 1), tags=tags, num=-i).save()
+        session.commit()
+        session.rollback()
+
+        ids = lambda ents: [e.id for e in ents]
+        near = RomTestGeoDistance.query.near('basic', 0, 0, 100, 'km')
+        # the tag filter is applied after the geo search, but the distances
+        # are kept for ordering
+        q = near.filter(tags='a').order_by_distance()
+        self.assertEqual(ids(q.execute()), [1, 2, 4, 5])
+        self.assertEqual(ids(q.limit(0, 2).execute()), [1, 2])
+        self.assertEqual(q.count(), 4)
+        self.assertEqual(ids(near.filter(tags='b').order_by_distance(descending=True).execute()), [4, 3, 1])
+        self.assertEqual(ids(near.filter(tags='a').order_by_distance().order_by('num').execute()), [5, 4, 2, 1])
+
+        dists = q.limit(1, 2).distances()
+        self.assertEqual(ids(d[0] for d in dists), [2, 4])
+        self.assertAlmostEqual(dists[0][1], 22.245, 2)
+        self.assertAlmostEqual(dists[1][1], 44.490, 2)
+        dists = near.filter(tags='b').order_by_distance(descending=True).distances()
+        self.assertEqual([round(d) for e, d in dists], [44, 33, 11])
+        self.assertRaises(QueryError, lambda: near.distances())
+        self.assertRaises(QueryError, lambda: RomTestGeoDistance.query.filter(tags='a').order_by_distance())
+        self.assertRaises(ValueError, lambda: near.near_box('basic', 0, 0, 1, 1, 'lightyears'))
+
+        # nothing is left behind
+        self.assertFalse([k for k in conn.keys('RomTestGeoDistance:*') if k.endswith(b':dist')])
+
+        if util._redis_version(conn) < (6, 2):
+            self.assertRaises(QueryError, lambda: near.near_box('basic', 0, 0, 50, 50, 'km').count())
+            return
+        box = RomTestGeoDistance.query.near_box('basic', .2, 0, 25, 10, 'km')
+        self.assertEqual(ids(box.order_by_distance().execute()), [2, 1, 3])
+        self.assertEqual(ids(box.filter(tags='b').order_by_distance().execute()), [1, 3])
+        self.assertEqual([round(d) for e, d in box.order_by_distance().distances()], [0, 11, 11])
+
     def _test_filter_performance(self):
         import time
         class RomTestFilterPerformance(Model):
@@ -1557,6 +1609,1307 @@ class TestORM(unittest.TestCase):
         self.assertRaises(InvalidColumnValue, lambda: RomTestCheckedColumns(c=86400))
         self.assertRaises(InvalidColumnValue, lambda: RomTestCheckedColumns(c='86400'))
 
+    def test_replicated(self):
+        class RomTestReplicated(Model):
+            code = Text(unique=True, index=True, keygen=IDENTITY, prefix=True)
+            rate = Float(index=True)
+            tags = Text(index=True, keygen=FULL_TEXT)
+
+            replicated = True
+
+        conn = connect(RomTestReplicated)
+        a = RomTestReplicated(code='usd', rate=1.0, tags='dollar us')
+        b = RomTestReplicated(code='eur', rate=1.1, tags='euro eu')
+        c = RomTestReplicated(code='cad', rate=0.7, tags='dollar canada')
+        session.commit()
+        session.rollback()
+
+        self.assertEqual(RomTestReplicated.get(a.id).code, 'usd')
+        self.assertEqual(RomTestReplicated.get_by(code='eur').id, b.id)
+        self.assertEqual([x.id for x in RomTestReplicated.get_by(rate=(None, 1.0))], [c.id, a.id])
+        self.assertEqual(RomTestReplicated.query.filter(tags='dollar').count(), 2)
+        self.assertEqual([x.id for x in RomTestReplicated.query.filter(tags='dollar').order_by('-rate').all()], [a.id, c.id])
+        self.assertEqual([x.id for x in RomTestReplicated.query.filter(tags=['eu', 'canada']).order_by('rate').all()], [c.id, b.id])
+        self.assertEqual(RomTestReplicated.query.filter(rate=(1.05, None)).first().id, b.id)
+        self.assertEqual(RomTestReplicated.query.filter(rate=('(1.0', None)).count(), 1)
+        version = RomTestReplicated._replica.version
+
+        # writes from "another process" are picked up by the change counter
+        replica = RomTestReplicated._replica
+        session.rollback()
+        x, y = RomTestReplicated.get([b.id, c.id])
+        x.rate = 0.5
+        x.save()
+        y.delete()
+        # pretend that this process hasn't seen those writes
+        replica.checked = time.time()
+        session.rollback()
+
+        self.assertEqual(RomTestReplicated.get(b.id).rate, 1.1)
+        replica.refresh(conn, force=True)
+        self.assertTrue(replica.version > version)
+        session.rollback()
+        self.assertEqual(RomTestReplicated.get(b.id).rate, 0.5)
+        self.assertEqual(RomTestReplicated.get(c.id), None)
+        self.assertEqual(RomTestReplicated.get_by(code='cad'), None)
+        self.assertEqual(RomTestReplicated.query.filter(tags='dollar').count(), 1)
+        self.assertEqual(len(replica.rows), 2)
+
+        # counts with an order include the entities with a value to order by
+        RomTestReplicated(code='xxx', tags='dollar').save()
+        session.rollback()
+        gindex = RomTestReplicated._gindex
+        for q in [RomTestReplicated.query.order_by('rate'),
+                  RomTestReplicated.query.filter(tags='dollar').order_by('-rate')]:
+            filters = q._filters + (q._order_by.lstrip('-'),)
+            self.assertEqual(replica.count(conn, filters), gindex.count(conn, filters))
+            self.assertEqual(q.count(), len(q.all()))
+        self.assertEqual(RomTestReplicated.query.order_by('rate').count(), 2)
+        self.assertEqual(RomTestReplicated.query.filter(tags='dollar').order_by('rate').count(), 1)
+        RomTestReplicated.get_by(code='xxx').delete()
+
+        # unsupported filters go to Redis
+        q = RomTestReplicated.query.startswith(code='u')
+        self.assertEqual(replica.search(conn, q._filters, None), None)
+        self.assertEqual(replica.count(conn, q._filters), None)
+        self.assertEqual([x.code for x in q.all()], ['usd'])
+        self.assertEqual(q.count(), 1)
+
+        # changes for deleted entities are trimmed, and replicas that are too
+        # far behind reload everything
+        replica.changes = 3
+        replica.refresh(conn, force=True)
+        version = replica.version
+        for i in range(20):
+            e = RomTestReplicated(code='x%i'%i, rate=i, tags='temp')
+            e.save()
+            e.delete()
+        session.rollback()
+        self.assertTrue(conn.zcard('RomTestReplicated::changes') <= 6)
+        self.assertTrue(int(conn.get('RomTestReplicated::changes:min')) > version)
+        # only a reload would pick up data written without a change
+        conn.hset('RomTestReplicated:%s'%b.id, 'rate', '0.25')
+        replica.refresh(conn, force=True)
+        self.assertEqual(replica.version, int(conn.get('RomTestReplicated::version')))
+        self.assertEqual(sorted(replica.rows), sorted([a.id, b.id]))
+        self.assertEqual(replica.rows[b.id]['rate'], '0.25')
+        self.assertEqual(RomTestReplicated.query.filter(tags='temp').count(), 0)
+
+    def test_unordered_results(self):
+        class RomTestUnordered(Model):
+            a = Integer(index=True)
+            b = Integer(index=True)
+            tag = Text(index=True, keygen=IDENTITY)
+
+            replicated = True
+
+        for i in range(60):
+            RomTestUnordered(a=(i * 7) % 10, b=(i * 13) % 40, tag='xy'[i % 2])
+        session.commit()
+        session.rollback()
+
+        conn = connect(RomTestUnordered)
+        gindex = RomTestUnordered._gindex
+        replica = RomTestUnordered._replica
+        queries = [
+            [('a', 0, 8), ('b', 10, 30)],
+            [('b', 10, 30), ('a', 0, 8)],
+            [('a', 0, 8), ('b', 10, 30), ('a', 2, 6)],
+            [('b', 10, 30), 'tag:x'],
+            ['tag:x', ('b', 10, 30)],
+            [('a', 0, 2)],
+            ['tag:y'],
+        ]
+        for filters in queries:
+            ids = [int(id) for id in gindex.search(conn, filters, None)]
+            self.assertEqual(replica.search(conn, filters, None), ids)
+            gindex._compile = lambda *args: None
+            try:
+                self.assertEqual([int(id) for id in gindex.search(conn, filters, None)], ids)
+            finally:
+                del gindex._compile
+            last = filters[-1]
+            if isinstance(last, tuple):
+                # ordered by the last range, ties by id (as strings)
+                values = dict((e.id, getattr(e, last[0])) for e in RomTestUnordered.get(ids))
+                self.assertEqual(ids, sorted(ids, key=lambda id: (values[id], str(id))))
+            else:
+                self.assertEqual(ids, sorted(ids, key=str))
+
+        q = RomTestUnordered.query.filter(a=(0, 8)).filter(b=(10, 30))
+        self.assertEqual([e.id for e in q.all()], replica.search(conn, q._filters, None))
+
+    def test_batch_deferred(self):
+        class RomTestDeferredA(Model):
+            val = Integer()
+        class RomTestDeferredB(Model):
+            val = Text()
+
+        a1 = RomTestDeferredA(val=1)
+        a2 = RomTestDeferredA(val=2)
+        b1 = RomTestDeferredB(val='b')
+        session.commit()
+        session.rollback()
+        known = RomTestDeferredA.get(a2.id)
+
+        with batch() as b:
+            da1 = RomTestDeferredA.get_deferred(a1.id)
+            da2 = RomTestDeferredA.get_deferred(a2.id)
+            db1 = RomTestDeferredB.get_deferred(b1.id)
+            dm = RomTestDeferredB.get_deferred(b1.id + 100)
+            self.assertIs(RomTestDeferredA.get_deferred(a1.id), da1)
+            self.assertFalse(da1.done())
+            self.assertEqual(len(b.pending), 4)
+            self.assertEqual(db1.result().val, 'b')
+            self.assertTrue(da1.done() and da2.done() and dm.done())
+            self.assertEqual(b.pending, [])
+            late = RomTestDeferredA.get_deferred(a1.id)
+            self.assertIs(late, da1)
+            later = RomTestDeferredB.get_deferred(b1.id + 200)
+
+        self.assertTrue(later.done())
+        self.assertIsNone(later.result())
+        self.assertIsNone(dm.result())
+        self.assertEqual(da1.result().val, 1)
+        # deduplicated against the session
+        self.assertIs(da2.result(), known)
+        self.assertIs(RomTestDeferredA.get(a1.id), da1.result())
+
+        # outside of a batch, entities are loaded immediately
+        d = RomTestDeferredA.get_deferred(a1.id)
+        self.assertTrue(d.done())
+        self.assertIs(d.result(), da1.result())
+
+    def test_batched_refresh(self):
+        class RomTestBatchRefresh(Model):
+            col = Text()
+            num = Integer()
+
+        conn = connect(RomTestBatchRefresh)
+        ents = [RomTestBatchRefresh(col='x%i'%i, num=i) for i in range(5)]
+        session.commit()
+        session.rollback()
+        ents = RomTestBatchRefresh.get([e.id for e in ents])
+        data = [e._data for e in ents]
+        # digests are only calculated by refreshes
+        self.assertEqual([e._digest for e in ents], [None] * 5)
+
+        # nothing changed, nothing re-initialized
+        session.refresh_all()
+        self.assertEqual([e._data for e in ents], data)
+        self.assertTrue(all(a is b for a, b in zip(data, [e._data for e in ents])))
+
+        conn.hset(ents[1]._pk, 'num', '100')
+        conn.delete(ents[3]._pk)
+        session.refresh(ents)
+        self.assertEqual(ents[1].num, 100)
+        self.assertIsNot(ents[1]._data, data[1])
+        self.assertTrue(ents[3]._deleted)
+        self.assertFalse(ents[3]._pk in session.known)
+        for i in (0, 2, 4):
+            self.assertIs(ents[i]._data, data[i])
+
+        # refreshed entities are cheap to refresh again
+        data = ents[1]._data
+        ents[1].refresh()
+        self.assertIs(ents[1]._data, data)
+
+        ents[2].col = 'changed'
+        self.assertRaises(InvalidOperation, lambda: session.refresh(ents))
+        session.refresh(ents, force=True)
+        self.assertEqual(ents[2].col, 'x2')
+        self.assertFalse(ents[2]._modified)
+
+    def test_negative_cache(self):
+        class RomTestNegative(Model):
+            email = String(unique=True)
+            negative_cache = 60
+
+        conn = connect(RomTestNegative)
+        self.assertEqual(RomTestNegative.get(5), None)
+        self.assertEqual(RomTestNegative.get_by(email=b'a@b.c'), None)
+        negative = RomTestNegative._negative
+        self.assertTrue(negative.missing('RomTestNegative:5', negative.version(conn)))
+
+        # entities written without the model are hidden until the entry expires
+        conn.hset('RomTestNegative:5', 'id', '5')
+        conn.hset('RomTestNegative:email:uidx', 'a@b.c', '5')
+        self.assertEqual(RomTestNegative.get(5), None)
+        self.assertEqual(RomTestNegative.get_by(email=b'a@b.c'), None)
+        with batch():
+            self.assertEqual(RomTestNegative.get_deferred(5).result(), None)
+        RomTestNegative._negative.clear()
+        self.assertEqual(RomTestNegative.get(5).id, 5)
+        session.rollback()
+
+        # writes through this process invalidate
+        self.assertEqual(RomTestNegative.get_by(email=b'x@y.z'), None)
+        self.assertEqual(RomTestNegative.get([1, 2, 5])[0].id, 5)
+        x = RomTestNegative(email=b'x@y.z')
+        x.save()
+        session.rollback()
+        self.assertEqual(RomTestNegative.get_by(email=b'x@y.z').id, x.id)
+        session.rollback()
+        self.assertEqual(RomTestNegative.get(x.id).id, x.id)
+
+        # another process (with its own cache) sees writes from this one
+        other = util.NegativeCache('RomTestNegative', 60)
+        version = other.version(conn)
+        other.add([('email', b'o@p.q')], version)
+        self.assertTrue(other.missing(('email', b'o@p.q'), other.version(conn)))
+        RomTestNegative(email=b'o@p.q').save()
+        session.rollback()
+        self.assertTrue(other.version(conn) > version)
+        self.assertFalse(other.missing(('email', b'o@p.q'), other.version(conn)))
+        # ... and this process sees writes from the other one
+        self.assertEqual(RomTestNegative.get_by(email=b'r@s.t'), None)
+        mine, RomTestNegative._negative = RomTestNegative._negative, other
+        y = RomTestNegative(email=b'r@s.t')
+        y.save()
+        RomTestNegative._negative = mine
+        session.rollback()
+        self.assertEqual(RomTestNegative.get_by(email=b'r@s.t').id, y.id)
+
+        def define():
+            class RomTestNegativeBad(Model):
+                negative_cache = 'x'
+        self.assertRaises(ORMError, define)
+
+    def test_single_script_query(self):
+        class RomTestScriptQuery(Model):
+            tag = String(index=True, keygen=FULL_TEXT)
+            num = Integer(index=True)
+            name = String(prefix=True, suffix=True, keygen=SIMPLE)
+
+        conn = connect(RomTestScriptQuery)
+        tags = ['red', 'green', 'blue']
+        for i in range(200):
+            RomTestScriptQuery(tag=tags[i%3] + ' ' + tags[i%7%3], num=i%37,
+                name=b'name%03i'%i).save()
+        session.rollback()
+
+        queries = [
+            RomTestScriptQuery.query.filter(tag='red'),
+            RomTestScriptQuery.query.filter(tag='red', num=(5, 20)),
+            RomTestScriptQuery.query.filter(tag=['red', 'blue'], num=(6, None)),
+            RomTestScriptQuery.query.filter(num=(None, 3)).order_by('-num'),
+            RomTestScriptQuery.query.filter(num=(10, 11), tag='green').order_by('num'),
+            RomTestScriptQuery.query.startswith(name='name1').filter(tag='blue'),
+            RomTestScriptQuery.query.endswith(name='7').filter(num=(0, 30)),
+            RomTestScriptQuery.query.like(name='*e1?5').order_by('num'),
+            RomTestScriptQuery.query.filter(tag='missing', num=(0, 5)),
+            RomTestScriptQuery.query.order_by('-num').limit(10, 20),
+        ]
+        expected = []
+        gindex = RomTestScriptQuery._gindex
+        gindex._compile = lambda *args: None
+        try:
+            for q in queries:
+                expected.append((q._search(), q.count(), q.limit(3, 5)._search()))
+        finally:
+            del gindex._compile
+
+        for q, (ids, count, page) in zip(queries, expected):
+            # without ordering, both order results by the last filter
+            self.assertEqual(q._search(), ids)
+            self.assertEqual(q.limit(3, 5)._search(), page)
+            self.assertEqual(q.count(), count)
+            conn.config_resetstat()
+            ents = q.all()
+            stats = conn.info('commandstats')
+            calls = sum(stats.get('cmdstat_' + c, {}).get('calls', 0)
+                for c in ('eval', 'evalsha', 'multi', 'hgetall'))
+            # one script call, with the HGETALLs inside
+            self.assertEqual(calls, 1 + len(ents))
+            self.assertEqual([e.id for e in ents], list(map(int, q._search())))
+
+        # ordered by the last numeric filter
+        q = RomTestScriptQuery.query.filter(num=(None, 20), tag='red')
+        self.assertEqual(q._search(), sorted(q._search()))
+        q = q.filter(num=(5, None))
+        nums = [e.num for e in q.all()]
+        self.assertEqual(nums, sorted(nums))
+        self.assertEqual(min(nums), 5)
+        session.rollback()
+
+    def test_index_stats(self):
+        class RomTestIndexStats(Model):
+            tag = String(index=True, keygen=FULL_TEXT)
+            num = Integer(index=True)
+
+        conn = connect(RomTestIndexStats)
+        for i in range(100):
+            RomTestIndexStats(tag='common' if i % 10 else 'rare common', num=i).save()
+        session.rollback()
+
+        self.assertEqual(list(util.update_index_stats(RomTestIndexStats, buckets=10, terms=1)),
+            [(1, 2), (2, 2)])
+        stats = RomTestIndexStats._gindex.stats(conn)
+        self.assertEqual(stats['num']['card'], 100)
+        self.assertEqual(stats['num']['bounds'][0], 0)
+        self.assertEqual(stats['num']['bounds'][-1], 99)
+        self.assertEqual(stats['tag'], dict(stats['tag'], keys=2, terms={'common': 100}, other=10))
+
+        compiled, estimates, sources = RomTestIndexStats._gindex._compile(
+            ['tag:common', 'tag:rare', 'tag:missing', ('num', 10, 29), ('num', '(89', None), ['tag:rare', 'tag:common']],
+            stats)
+        self.assertEqual(estimates[:3], [100, 10, 10])
+        self.assertTrue(18 <= estimates[3] <= 22, estimates[3])
+        self.assertTrue(8 <= estimates[4] <= 12, estimates[4])
+        self.assertEqual(estimates[5], 110)
+
+        # estimates don't change results, even when they're wrong
+        q = RomTestIndexStats.query.filter(tag='rare', num=(None, 50))
+        self.assertEqual(q.count(), 6)
+        self.assertEqual(RomTestIndexStats.query.filter(tag='missing').count(), 0)
+        RomTestIndexStats(tag='missing', num=5).save()
+        self.assertEqual(RomTestIndexStats.query.filter(tag='missing', num=5).count(), 1)
+        self.assertEqual([e.num for e in q.order_by('-num').all()], [50, 40, 30, 20, 10, 0])
+
+    def test_explain_hints(self):
+        class RomTestExplain(Model):
+            tag = String(index=True, keygen=FULL_TEXT)
+            num = Integer(index=True)
+
+        for i in range(100):
+            RomTestExplain(tag='common' if i % 10 else 'rare common', num=i).save()
+        session.rollback()
+
+        q = RomTestExplain.query.filter(tag='common').filter(num=(0, 9)).filter(tag='rare')
+        plan = q.explain()
+        self.assertTrue(plan['script'])
+        self.assertFalse(plan['empty'])
+        self.assertEqual([s['filter'] for s in plan['steps']], [('num', 0, 9), 'tag:rare', 'tag:common'])
+        self.assertEqual([s['estimate'] for s in plan['steps']], [10, 10, 100])
+        self.assertTrue(plan['steps'][0]['subrange'])
+        self.assertEqual(plan['temp_keys'], 1)
+
+        hinted = q.hint(order=['tag'], subrange=False)
+        plan = hinted.explain(analyze=True)
+        self.assertEqual([s['filter'] for s in plan['steps']], ['tag:common', 'tag:rare', ('num', 0, 9)])
+        self.assertEqual([s['size'] for s in plan['steps']], [100, 10, 1])
+        self.assertFalse(any(s['subrange'] for s in plan['steps']))
+        self.assertTrue(all(s['usec'] >= 0 for s in plan['steps']))
+        self.assertTrue(plan['time'] > 0)
+        self.assertEqual(hinted.count(), 1)
+        self.assertEqual(hinted.all()[0].num, 0)
+
+        plan = RomTestExplain.query.filter(tag='missing', num=(0, 5)).explain()
+        self.assertTrue(plan['empty'])
+        self.assertRaises(QueryError, lambda: q.hint(order=['missing']))
+
+        # pipelined (geo-style) queries are explained the same way
+        gindex = RomTestExplain._gindex
+        gindex._compile = lambda *args: None
+        try:
+            plan = hinted.explain()
+            self.assertFalse(plan['script'])
+            self.assertEqual([s['filter'] for s in plan['steps']], ['tag:common', 'tag:rare', ('num', 0, 9)])
+            self.assertEqual(hinted.count(), 1)
+        finally:
+            del gindex._compile
+
+    def test_query_cache(self):
+        class RomTestQueryCache(Model):
+            tag = String(index=True, keygen=FULL_TEXT)
+            num = Integer(index=True)
+            other = Integer()
+
+        conn = connect(RomTestQueryCache)
+        for i in range(20):
+            RomTestQueryCache(tag='a b' if i % 2 else 'a', num=i).save()
+        session.rollback()
+
+        def calls():
+            stats = conn.info('commandstats')
+            return sum(stats.get('cmdstat_' + c, {}).get('calls', 0)
+                for c in ('zinterstore', 'zunionstore', 'zadd'))
+
+        q = RomTestQueryCache.query.filter(tag='b', num=(5, None)).order_by('-num').cache(30)
+        self.assertEqual([e.num for e in q.limit(0, 3).all()], [19, 17, 15])
+        conn.config_resetstat()
+        self.assertEqual([e.num for e in q.limit(3, 3).all()], [13, 11, 9])
+        self.assertEqual(q.first().num, 19)
+        self.assertEqual(calls(), 0)
+        self.assertEqual(q.count(), 8)
+        self.assertEqual(q.count(), 8)
+
+        # writes to unrelated columns don't invalidate
+        ent = q.first()
+        ent.other = 5
+        ent.save()
+        conn.config_resetstat()
+        self.assertEqual(q.first().num, 19)
+        self.assertEqual(calls(), 0)
+
+        # writes to indexed columns do
+        ent.num = 100
+        ent.save()
+        self.assertEqual(q.first().num, 100)
+        RomTestQueryCache(tag='b', num=200).save()
+        self.assertEqual(q.count(), 9)
+        ent.delete()
+        self.assertEqual([e.num for e in q.limit(0, 2).all()], [200, 17])
+        session.rollback()
+
+        # stale results are returned while being recalculated
+        q = RomTestQueryCache.query.filter(tag='b').cache(30, stale=30)
+        self.assertEqual(q.count(), 10)
+        conn.hset('RomTestQueryCache::iver', 'tag', 1000)
+        conn.sadd('RomTestQueryCache:tag:b:idx', 1000)
+        self.assertEqual(q.count(), 10)
+        for i in range(100):
+            if q.count() == 11:
+                break
+            time.sleep(.01)
+        self.assertEqual(q.count(), 11)
+        self.assertRaises(QueryError, lambda: q.cache(0))
+
+    def test_single_flight(self):
+        import threading
+        class RomTestSingleFlight(Model):
+            tag = String(index=True, keygen=FULL_TEXT)
+            num = Integer(index=True)
+            lat = Float()
+            lon = Float()
+            geo_index = [
+                GeoIndex('basic', lambda x: {'lat': x.lat, 'lon': x.lon})
+            ]
+
+        conn = connect(RomTestSingleFlight)
+        for i in range(50):
+            RomTestSingleFlight(tag='a b' if i % 2 else 'a', num=i, lat=0, lon=i / 100.).save()
+        session.rollback()
+
+        def run(query, out):
+            def target():
+                out.append([e.num for e in query.all()])
+            threads = [threading.Thread(target=target) for i in range(10)]
+            conn.config_resetstat()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            return conn.info('commandstats')
+
+        q = RomTestSingleFlight.query.filter(tag='b', num=(10, 30)).order_by('-num')
+        out = []
+        stats = run(q.single_flight(), out)
+        self.assertEqual(stats['cmdstat_zinterstore']['calls'], 2)
+        self.assertEqual(out, 10 * [list(range(29, 9, -2))])
+
+        # callers get their own copies of shared results
+        key = q.single_flight(5).cached_result(30)
+        key2 = q.single_flight(5).cached_result(30)
+        self.assertNotEqual(key, key2)
+        self.assertTrue(conn.ttl(key) > 5)
+        self.assertEqual(conn.zrange(key, 0, -1), conn.zrange(key2, 0, -1))
+        conn.delete(key)
+        self.assertEqual(len(conn.zrange(q.single_flight(5).cached_result(30), 0, -1)), 10)
+        self.assertNotEqual(q.cached_result(30), q.cached_result(30))
+
+        # geo queries use a lock instead
+        q = RomTestSingleFlight.query.filter(tag='b').near('basic', 0, 0, 20, 'km').order_by('num')
+        out = []
+        stats = run(q.single_flight(), out)
+        geo = 'geosearchstore' if util._redis_version(conn) >= (6, 2) else 'georadius'
+        self.assertEqual(stats['cmdstat_' + geo]['calls'], 1)
+        self.assertEqual(out, 10 * [list(range(1, 18, 2))])
+        self.assertEqual(q.single_flight().count(), 9)
+        self.assertRaises(QueryError, lambda: q.single_flight(0))
+
+        conn.delete(*conn.keys('RomTestSingleFlight::sf:*'))
+        key = q.single_flight(5).cached_result(30)
+        shared = [k for k in conn.keys('RomTestSingleFlight::sf:*') if not k.endswith(b':done')]
+        self.assertEqual(len(shared), 1)
+        self.assertNotEqual(key, shared[0].decode())
+        self.assertEqual(conn.zrange(key, 0, -1), conn.zrange(shared[0], 0, -1))
+        self.assertTrue(conn.ttl(key) > 5)
+        # the results outlive the marker, and aren't used without it
+        self.assertTrue(conn.ttl(shared[0]) > conn.ttl(shared[0] + b':done'))
+        gindex = RomTestSingleFlight._gindex
+        self.assertEqual(gindex._read_shared(conn, shared[0].decode(), lambda pipe: pipe.zcard(shared[0])), [9])
+        conn.delete(shared[0] + b':done')
+        self.assertEqual(gindex._read_shared(conn, shared[0].decode(), lambda pipe: pipe.zcard(shared[0])), None)
+
+    def test_single_index_fast_paths(self):
+        class RomTestFastPath(Model):
+            tag = String(index=True, keygen=FULL_TEXT)
+            num = Integer(index=True)
+
+        conn = connect(RomTestFastPath)
+        for i in range(30):
+            RomTestFastPath(tag='a b' if i % 3 else 'a', num=i % 7).save()
+        session.rollback()
+
+        queries = [
+            RomTestFastPath.query.filter(tag='b'),
+            RomTestFastPath.query.filter(tag='b').limit(3, 4),
+            RomTestFastPath.query.filter(tag='missing'),
+            RomTestFastPath.query.filter(num=(2, 4)),
+            RomTestFastPath.query.filter(num=('(2', 4)).limit(2, 5),
+            RomTestFastPath.query.filter(num=(2, None)).order_by('num'),
+            RomTestFastPath.query.order_by('num').limit(5, 10),
+        ]
+        gindex = RomTestFastPath._gindex
+        gindex._compile = lambda *args: None
+        try:
+            expected = [(q._search(), q.count()) for q in queries[:4]]
+        finally:
+            del gindex._compile
+
+        conn.config_resetstat()
+        for q, (ids, count) in zip(queries, expected):
+            self.assertEqual(q._search(), ids)
+            self.assertEqual(q.count(), count)
+        self.assertEqual([e.num for e in queries[4].all()], [3, 3, 4, 4, 4])
+        self.assertEqual([e.num for e in queries[5].all()], sorted(e.num for e in queries[5].all()))
+        self.assertEqual(len(queries[6].all()), 10)
+        self.assertEqual(RomTestFastPath.get_by(num=(3, 3), _limit=(0, 2))[0].num, 3)
+        stats = conn.info('commandstats')
+        for cmd in ('zunionstore', 'zinterstore', 'multi', 'zadd', 'del'):
+            self.assertFalse('cmdstat_' + cmd in stats, cmd)
+
+        # large sets aren't sorted in the script
+        limit = index.FAST_SET_LIMIT
+        index.FAST_SET_LIMIT = 5
+        try:
+            conn.config_resetstat()
+            self.assertEqual(queries[1]._search(), expected[1][0])
+            self.assertEqual(queries[0].count(), expected[0][1])
+            stats = conn.info('commandstats')
+            self.assertFalse('cmdstat_smembers' in stats)
+            self.assertTrue('cmdstat_zunionstore' in stats)
+        finally:
+            index.FAST_SET_LIMIT = limit
+
+    def test_top_k_walk(self):
+        class RomTestTopK(Model):
+            tag = String(index=True, keygen=FULL_TEXT)
+            num = Integer(index=True)
+            score = Integer(index=True)
+
+        conn = connect(RomTestTopK)
+        for i in range(300):
+            RomTestTopK(tag='a b' if i % 3 else 'a', num=i % 7, score=i % 10).save()
+        session.rollback()
+
+        def check(q):
+            expected = q.hint(walk=False)._search()
+            self.assertTrue(q.explain()['walk'])
+            self.assertEqual(q._search(), expected)
+            self.assertEqual(q.hint(walk=True)._search(), expected)
+            return expected
+
+        check(RomTestTopK.query.filter(tag='b').order_by('score').limit(0, 5))
+        check(RomTestTopK.query.filter(tag='b').order_by('-score').limit(3, 20))
+        check(RomTestTopK.query.filter(tag='b', num=(2, '(5')).order_by('score').limit(0, 10))
+        check(RomTestTopK.query.filter(tag=['a', 'b']).order_by('-num').limit(40, 5))
+        # no matches at all falls back to intersecting
+        q = RomTestTopK.query.filter(tag='b', num=(10, 20)).order_by('score').limit(0, 5)
+        self.assertEqual(q._search(), [])
+        self.assertEqual(q.hint(walk=True)._search(), [])
+        self.assertFalse(RomTestTopK.query.filter(tag='b').order_by('score').explain()['walk'])
+        self.assertFalse(RomTestTopK.query.filter(tag='b').order_by('score').limit(0, 5).hint(walk=False).explain()['walk'])
+
+        conn.config_resetstat()
+        ids = RomTestTopK.query.filter(tag='b').order_by('score').limit(0, 5)._search()
+        self.assertEqual(len(ids), 5)
+        stats = conn.info('commandstats')
+        self.assertFalse('cmdstat_zinterstore' in stats)
+        self.assertEqual([e.score for e in RomTestTopK.query.filter(tag='b').order_by('score').limit(0, 5)], [0] * 5)
+
+    def test_cursor_pagination(self):
+        class RomTestCursor(Model):
+            tag = String(index=True, keygen=FULL_TEXT)
+            score = Integer(index=True)
+
+        for i in range(50):
+            RomTestCursor(tag='a b' if i % 3 else 'a', score=i % 7).save()
+        session.rollback()
+
+        for query in [RomTestCursor.query.order_by('score'),
+                      RomTestCursor.query.order_by('-score'),
+                      RomTestCursor.query.filter(tag='b').order_by('score'),
+                      RomTestCursor.query.filter(tag='b').order_by('-score'),
+                      RomTestCursor.query.filter(tag='b').order_by('-score').hint(walk=False),
+                      RomTestCursor.query.filter(tag='b').order_by('score').cache(5)]:
+            expected = [e.id for e in query.all()]
+            seen = []
+            ents, cursor = query.page(6)
+            while ents:
+                seen.extend(e.id for e in ents)
+                ents, cursor = query.after(cursor).page(6)
+            self.assertEqual(seen, expected)
+            self.assertEqual(cursor, None)
+
+            # and backwards from the end
+            ents, cursor = query.after(query.page(len(expected) - 1)[1]).page(10)
+            self.assertEqual([e.id for e in ents], expected[-1:])
+            seen = [e.id for e in ents]
+            ents, cursor = query.before(cursor).page(5)
+            while ents:
+                seen[:0] = [e.id for e in ents]
+                ents, cursor = query.before(cursor).page(5)
+            self.assertEqual(seen, expected)
+            self.assertEqual(cursor, None)
+
+        # entities deleted before the cursor don't shift the next page
+        query = RomTestCursor.query.order_by('score')
+        ents, cursor = query.page(10)
+        expected = query.after(cursor).limit(0, 5)._search()
+        ents[3].delete()
+        ents[-1].delete()
+        self.assertEqual(query.after(cursor).limit(0, 5)._search(), expected)
+        self.assertEqual(query.after(cursor).limit(2, 3)._search(), expected[2:])
+        self.assertRaises(QueryError, lambda: RomTestCursor.query.filter(tag='b').page(5))
+        self.assertRaises(QueryError, lambda: query.after('not a cursor'))
+
+    def test_filter_expressions(self):
+        class RomTestExpr(Model):
+            tag = Text(index=True, keygen=FULL_TEXT)
+            status = Text(index=True, keygen=IDENTITY)
+            num = Integer(index=True)
+
+        for i in range(60):
+            RomTestExpr(tag=['a', 'a b', 'b c'][i % 3], status=['x', 'y'][i % 2], num=i % 10).save()
+        session.rollback()
+        ents = RomTestExpr.query.order_by('num').all()
+        def ids(pred):
+            return sorted(e.id for e in ents if pred(e))
+
+        tests = [
+            (Q(tag='a') | Q(status='x'),
+                lambda e: 'a' in e.tag.split() or e.status == 'x'),
+            ((Q(tag='a') | Q(status='x')) & ~Q(num=(2, 5)),
+                lambda e: ('a' in e.tag.split() or e.status == 'x') and not 2 <= e.num <= 5),
+            (Q(tag='c') | (Q(num=(0, 1)) & Q(status='y')) | Q(tag=['b'], num=9),
+                lambda e: 'c' in e.tag.split() or (e.num <= 1 and e.status == 'y') or ('b' in e.tag.split() and e.num == 9)),
+            (Q(status='x') & ~(Q(tag='b') | Q(num=(None, 3))),
+                lambda e: e.status == 'x' and not ('b' in e.tag.split() or e.num <= 3)),
+        ]
+        for q, pred in tests:
+            expected = ids(pred)
+            query = RomTestExpr.query.filter(q)
+            self.assertEqual(sorted(map(int, query._search())), expected)
+            self.assertEqual(query.count(), len(expected))
+            ordered = [e.id for e in query.order_by('-num').all()]
+            self.assertEqual(sorted(ordered), expected)
+            self.assertEqual([RomTestExpr.get(i).num for i in ordered],
+                sorted((RomTestExpr.get(i).num for i in ordered), reverse=True))
+            for walk in (True, False):
+                page = query.order_by('-num').limit(2, 5).hint(walk=walk)._search()
+                self.assertEqual(list(map(int, page)), ordered[2:7])
+
+        # negations and keyword filters mix at the top level
+        self.assertEqual(sorted(map(int, RomTestExpr.query.filter(~Q(tag='a'), status='y')._search())),
+            ids(lambda e: e.status == 'y' and 'a' not in e.tag.split()))
+        self.assertEqual(RomTestExpr.query.filter(~Q(tag='a'), tag='a').count(), 0)
+        self.assertRaises(QueryError, lambda: RomTestExpr.query.filter(~Q(tag='a')).count())
+        self.assertRaises(QueryError, lambda: RomTestExpr.query.filter(Q(tag='a') | ~Q(tag='b')).count())
+        self.assertRaises(QueryError, lambda: RomTestExpr.query.filter(Q()))
+        self.assertRaises(QueryError, lambda: RomTestExpr.query.filter('tag:a'))
+
+    def test_probe_filters(self):
+        class RomTestProbe(Model):
+            tag = Text(index=True, keygen=FULL_TEXT)
+            num = Integer(index=True)
+
+        conn = connect(RomTestProbe)
+        for i in range(300):
+            RomTestProbe(tag='rare common' if i % 50 == 0 else ['common', 'other'][i % 2], num=i % 10).save()
+        session.rollback()
+
+        queries = [
+            RomTestProbe.query.filter(tag='rare').filter(tag=['common', 'other']),
+            RomTestProbe.query.filter(Q(tag='common') | Q(num=(5, None)), tag='rare'),
+            RomTestProbe.query.filter(~(Q(tag='other') | Q(num=(0, 3))), tag='rare'),
+            RomTestProbe.query.filter(Q(tag='rare') & ~Q(num=0), tag=['other', 'common']).order_by('-num'),
+        ]
+        for query in queries:
+            expected = query.hint(probe=False)._search()
+            self.assertEqual(query.hint(probe=True)._search(), expected)
+            self.assertEqual(query._search(), expected)
+            self.assertEqual(query.count(), len(expected))
+            plan = query.explain(analyze=True)
+            self.assertEqual([s['probe'] for s in plan['steps']][:2], [False, True])
+            self.assertFalse(any(s['probe'] for s in query.hint(probe=False).explain()['steps']))
+        self.assertEqual(len(queries[0]._search()), 6)
+
+        conn.config_resetstat()
+        queries[0]._search()
+        self.assertEqual(conn.info('commandstats')['cmdstat_zunionstore']['calls'], 1)
+        queries[0].hint(probe=False)._search()
+        self.assertEqual(conn.info('commandstats')['cmdstat_zunionstore']['calls'], 3)
+
+    def test_lex_prefix_index(self):
+        class RomTestLexPrefix(Model):
+            col = Text(prefix=True, suffix=True, keygen=FULL_TEXT)
+
+        conn = connect(RomTestLexPrefix)
+        words = ['internationalization', 'internationalize', 'internal', 'intern', 'other']
+        for word in words:
+            RomTestLexPrefix(col=word).save()
+        self.assertTrue(conn.exists('RomTestLexPrefix::lex'))
+        self.assertFalse(conn.exists('RomTestLexPrefix:col:pre'))
+
+        def check():
+            sw = lambda p: RomTestLexPrefix.query.startswith(col=p)
+            self.assertEqual(sw('international').count(), 2)
+            self.assertEqual(sw('internationalization').count(), 1)
+            self.assertEqual(sw('internationalizationx').count(), 0)
+            self.assertEqual(sw('intern').count(), 4)
+            self.assertEqual(RomTestLexPrefix.query.endswith(col='nalize').count(), 1)
+            self.assertEqual(RomTestLexPrefix.query.like(col='internationali?e').count(), 1)
+            self.assertEqual(RomTestLexPrefix.query.like(col='*nal').count(), 3)
+            self.assertEqual(RomTestLexPrefix.query.like(col='inter*').count(), 4)
+
+        conn.config_resetstat()
+        check()
+        stats = conn.info('commandstats')
+        self.assertFalse('cmdstat_zrem' in stats or 'cmdstat_zrank' in stats)
+
+        # recreate the index layout written by older versions
+        for suffix in ('pre', 'suf'):
+            key = 'RomTestLexPrefix:col:' + suffix
+            for member in conn.zrange(key + ':lex', 0, -1):
+                conn.execute_command('ZADD', key, util._prefix_score(member.partition(b'\0')[0]), member)
+            conn.delete(key + ':lex')
+        conn.delete('RomTestLexPrefix::lex')
+        check()
+
+        # entities written before and during the migration are both indexed
+        x = RomTestLexPrefix(col='interned')
+        x.save()
+        RomTestLexPrefix.get(1).delete()
+        self.assertTrue(conn.exists('RomTestLexPrefix:col:pre:lex'))
+        for i, progress in enumerate(util.migrate_prefix_index(RomTestLexPrefix)):
+            if not i:
+                RomTestLexPrefix(col='other').save()
+                x.delete()
+        self.assertTrue(conn.exists('RomTestLexPrefix::lex'))
+        self.assertFalse(conn.exists('RomTestLexPrefix:col:pre'))
+        self.assertEqual(conn.zcard('RomTestLexPrefix:col:pre:lex'), 5)
+        RomTestLexPrefix(col='internationalization').save()
+        check()
+
+    def test_ngram_like(self):
+        class RomTestNgram(Model):
+            col = Text(ngram=True, keygen=FULL_TEXT)
+            num = Integer(index=True)
+
+        conn = connect(RomTestNgram)
+        words = ['blacksmith', 'smithy', 'goldsmiths', 'smite', 'Smith Jones', 'other']
+        for i, word in enumerate(words):
+            RomTestNgram(col=word, num=i).save()
+        self.assertTrue('col' in RomTestNgram._prefix)
+        self.assertEqual(conn.scard('RomTestNgram:col~3:mit:idx'), 5)
+
+        q = RomTestNgram.query
+        self.assertEqual(sorted(x.num for x in q.contains(col='smith')), [0, 1, 2, 4])
+        self.assertEqual(q.contains(col='mith').count(), 4)
+        self.assertEqual(q.contains(col='th').count(), 5)
+        self.assertEqual(q.like(col='*smi?h').count(), 4)
+        self.assertEqual(q.like(col='*ldsmi*s').count(), 1)
+        self.assertEqual(q.like(col='smit*').count(), 3)
+        self.assertEqual(q.contains(col='smithx').count(), 0)
+        self.assertEqual([x.num for x in q.contains(col='smith').order_by('-num').limit(0, 2)], [4, 2])
+        self.assertEqual(q.contains(col='smith').filter(num=(1, 3)).count(), 2)
+        self.assertEqual(q.filter(Q(num=(None, 1)) | Q(num=5)).contains(col='smith').count(), 2)
+        self.assertRaises(QueryError, lambda: q.contains(col='a*b'))
+
+        # the trigram index only sends candidates to the pattern check
+        plan = q.contains(col='smith').explain()
+        self.assertEqual(plan['steps'][0]['kind'], 'ngram')
+        self.assertEqual(plan['steps'][0]['estimate'], 4)
+
+        # trigrams are cleaned up with the other index data
+        x, = RomTestNgram.get_by(num=0)
+        x.col = 'tinsmith'
+        x.save()
+        RomTestNgram.get_by(num=2)[0].delete()
+        self.assertEqual(conn.scard('RomTestNgram:col~3:mit:idx'), 4)
+        self.assertFalse(conn.exists('RomTestNgram:col~3:bla:idx'))
+        self.assertFalse(conn.exists('RomTestNgram:col~3:lds:idx'))
+        self.assertEqual(q.contains(col='insmi').count(), 1)
+        self.assertEqual(q.contains(col='smith').count(), 3)
+
+    def test_text_search(self):
+        class RomTestTextSearch(Model):
+            body = Text(index=True, keygen=FULL_TEXT_SCORED)
+            num = Integer(index=True)
+            plain = Text(index=True, keygen=FULL_TEXT)
+
+        conn = connect(RomTestTextSearch)
+        docs = ['Redis, python and redis', 'Python tutorial for beginners learning python basics',
+            'Redis cluster', 'Java']
+        for i, doc in enumerate(docs):
+            RomTestTextSearch(body=doc, num=i).save()
+        self.assertEqual(conn.zscore('RomTestTextSearch:body:redis:idx', 1), 2)
+        self.assertEqual(conn.zscore('RomTestTextSearch:body:idx', 1), 4)
+
+        q = RomTestTextSearch.query
+        nums = lambda q: [x.num for x in q]
+        self.assertEqual(nums(q.search('body', 'Redis python')), [0])
+        self.assertEqual(nums(q.search('body', 'redis python', mode='any')), [0, 2, 1])
+        self.assertEqual(nums(q.search('body', 'redis python', mode='any').limit(1, 1)), [2])
+        self.assertEqual(q.search('body', 'python redis golang', mode='any').count(), 3)
+        self.assertEqual(q.search('body', 'python redis golang').count(), 0)
+        self.assertEqual(nums(q.search('body', 'python redis', mode='any').order_by('-num')), [2, 1, 0])
+        self.assertEqual(nums(q.search('body', 'python redis', mode='any').filter(num=(1, 3))), [2, 1])
+        self.assertEqual(nums(q.search('body', 'python', mode='any').search('body', 'redis', mode='any')), [0])
+        self.assertEqual(q.filter(body='redis').count(), 2)
+        self.assertEqual(q.search('body', 'redis').explain()['steps'][0]['kind'], 'text')
+        self.assertRaises(QueryError, lambda: q.search('plain', 'redis'))
+        self.assertRaises(QueryError, lambda: q.search('body', 'redis', mode='most'))
+        self.assertRaises(QueryError, lambda: q.search('body', '...'))
+
+        # updates replace the term frequencies and lengths
+        x, = RomTestTextSearch.get_by(num=3)
+        x.body = 'python python python'
+        x.save()
+        self.assertEqual(nums(q.search('body', 'python', mode='any')), [3, 1, 0])
+
+    def test_phrase_queries(self):
+        class RomTestPhrase(Model):
+            body = Text(index=True, keygen=FULL_TEXT, positions=True)
+            num = Integer(index=True)
+
+        conn = connect(RomTestPhrase)
+        docs = ['The Redis object mapper', 'mapper of Redis objects', 'object, redis: mapper!',
+            'redis is an in-memory data store, not an object mapper']
+        for i, doc in enumerate(docs):
+            RomTestPhrase(body=doc, num=i).save()
+        self.assertRaises(ColumnError, lambda: Text(index=True, keygen=SIMPLE, positions=True))
+
+        q = RomTestPhrase.query
+        nums = lambda q: sorted(x.num for x in q)
+        self.assertEqual(nums(q.phrase('body', 'redis object')), [0])
+        self.assertEqual(nums(q.phrase('body', 'Object Mapper')), [0, 3])
+        self.assertEqual(nums(q.phrase('body', 'object redis mapper')), [2])
+        self.assertEqual(nums(q.phrase('body', 'mapper redis')), [])
+        self.assertEqual(nums(q.near_words('body', 'redis', 'mapper')), [2])
+        self.assertEqual(nums(q.near_words('body', 'mapper', 'redis', within=2)), [0, 1, 2])
+        self.assertEqual(nums(q.near_words('body', 'redis', 'mapper', within=20)), [0, 1, 2, 3])
+        self.assertEqual(nums(q.phrase('body', 'object mapper').filter(num=(1, 5))), [3])
+        self.assertEqual([x.num for x in q.phrase('body', 'object mapper').order_by('-num').limit(0, 1)], [3])
+        self.assertEqual(q.phrase('body', 'object mapper').explain()['steps'][0]['kind'], 'phrase')
+        self.assertRaises(QueryError, lambda: q.near_words('body', 'redis', 'object mapper'))
+        self.assertRaises(QueryError, lambda: RomTestPhrase.query.phrase('num', 'redis'))
+
+        # positions are replaced on update and removed on delete
+        x, = RomTestPhrase.get_by(num=1)
+        x.body = 'an object mapper for redis'
+        x.save()
+        self.assertEqual(nums(q.phrase('body', 'object mapper')), [0, 1, 3])
+        RomTestPhrase.get_by(num=0)[0].delete()
+        self.assertEqual(conn.hlen('RomTestPhrase:body:pos'), 3)
+        self.assertEqual(nums(q.phrase('body', 'object mapper')), [1, 3])
+
+    def test_complete(self):
+        class RomTestComplete(Model):
+            name = Text(prefix=True, keygen=FULL_TEXT)
+            pop = Integer(index=True)
+            tag = String(index=True, keygen=IDENTITY)
+            old = Integer()
+
+        conn = connect(RomTestComplete)
+        names = ['josiah carlson', 'joseph', 'josie jones', 'john', 'jo', 'mary jost']
+        pops = [5, 50, 20, None, 1, 30]
+        for name, pop in zip(names, pops):
+            RomTestComplete(name=name, pop=pop).save()
+
+        def check():
+            c = RomTestComplete.complete
+            self.assertEqual(c('name', 'jos'), [2, 1, 3, 6])
+            self.assertEqual(c('name', 'Jos', limit=2), [2, 1])
+            self.assertEqual(c('name', 'jo', weight='pop'), [2, 6, 3, 1, 5, 4])
+            self.assertEqual(c('name', 'jo', limit=3, weight='pop'), [2, 6, 3])
+            self.assertEqual(c('name', 'xyz', weight='pop'), [])
+            self.assertEqual(c('name', 'jos', limit=2, weight='pop', select=['name']),
+                [{'name': 'joseph'}, {'name': 'mary jost'}])
+            self.assertEqual(c('name', 'john', select=['pop', 'id']), [{'pop': None, 'id': 4}])
+
+        check()
+        # too many matches to rank, walk the weights instead
+        budget = index.COMPLETE_BUDGET
+        index.COMPLETE_BUDGET = 3
+        try:
+            check()
+        finally:
+            index.COMPLETE_BUDGET = budget
+        self.assertRaises(QueryError, lambda: RomTestComplete.complete('pop', '1'))
+        self.assertRaises(QueryError, lambda: RomTestComplete.complete('name', 'jo', weight='name'))
+        # weights need a score, which unindexed and string columns don't have
+        for col in ('tag', 'old', 'missing'):
+            self.assertRaises(QueryError, lambda: RomTestComplete.complete('name', 'jo', weight=col))
+
+        # indexes written by older versions
+        key = 'RomTestComplete:name:pre'
+        for member in conn.zrange(key + ':lex', 0, -1):
+            conn.execute_command('ZADD', key, util._prefix_score(member.partition(b'\0')[0]), member)
+        conn.delete(key + ':lex', 'RomTestComplete::lex')
+        check()
+
+        # words continuing with non-ascii bytes after the prefix
+        class RomTestCompleteUnicode(Model):
+            name = Text(prefix=True, keygen=FULL_TEXT)
+
+        for name in [u'cafe', u'caf\xe9 noir', u'cafz', u'caff\xe8', u'cab']:
+            RomTestCompleteUnicode(name=name).save()
+        c = RomTestCompleteUnicode.complete
+        self.assertEqual(sorted(c('name', 'caf')), [1, 2, 3, 4])
+        self.assertEqual(sorted(c('name', u'caf\xe9')), [2])
+        self.assertEqual(sorted(c('name', 'caf')),
+            sorted(e.id for e in RomTestCompleteUnicode.query.startswith(name='caf').all()))
+
+    def test_lex_order(self):
+        class RomTestLexOrder(Model):
+            name = Text(index=True, keygen=SIMPLE_CI, lex_order=True)
+            num = Integer(index=True)
+            tag = Text(index=True, keygen=IDENTITY)
+
+        self.assertRaises(ColumnError, lambda: Text(index=True, keygen=FULL_TEXT, lex_order=True))
+        self.assertRaises(ColumnError, lambda: Text(lex_order=True))
+
+        conn = connect(RomTestLexOrder)
+        names = ['Sheffield United', 'sheffield wednesday', 'Sheffield Athletic',
+            'Sheffield', 'arsenal', 'Sheffield united', 'sheffield rovers']
+        for i, name in enumerate(names):
+            RomTestLexOrder(name=name, num=i, tag='odd' if i % 2 else 'even').save()
+        ordered = [5, 4, 3, 7, 1, 6, 2]
+
+        def check(q, expected):
+            for walk in (None, True, False):
+                self.assertEqual([e.id for e in q.hint(walk=walk).all()], expected)
+                self.assertEqual([e.id for e in q.hint(walk=walk).limit(0, 3).all()], expected[:3])
+                self.assertEqual([e.id for e in q.hint(walk=walk).limit(2, 2).all()], expected[2:4])
+                self.assertEqual([e.id for e in q.hint(walk=walk).limit(4, 10).all()], expected[4:])
+
+        q = RomTestLexOrder.query
+        check(q.order_by('name'), ordered)
+        check(q.order_by('-name'), [2, 1, 6, 7, 3, 4, 5])
+        check(q.filter(num=(1, None)).order_by('name'), [5, 4, 3, 7, 6, 2])
+        check(q.filter(tag='odd').order_by('-name'), [2, 6, 4])
+        check(q.filter(tag='even').order_by('name'), [5, 3, 7, 1])
+        self.assertEqual(q.filter(tag='odd').order_by('name').count(), 3)
+
+        key = q.filter(num=(0, 5)).order_by('name').cached_result(30)
+        self.assertEqual([int(id) for id in conn.zrange(key, 0, -1)], [5, 4, 3, 1, 6, 2])
+        ids = [e.id for e in q.filter(num=(0, 5)).order_by('name').cache(30).all()]
+        self.assertEqual(ids, [5, 4, 3, 1, 6, 2])
+        self.assertRaises(QueryError, lambda: q.order_by('name').page(2))
+
+        # entities that change or go away are reordered
+        e = RomTestLexOrder.get(6)
+        e.name = 'Sheffield Utd'
+        e.save()
+        RomTestLexOrder.get(1).delete()
+        check(q.order_by('name'), [5, 4, 3, 7, 6, 2])
+
+        # without the lexicographic prefix index, use the 7-byte order
+        conn.delete('RomTestLexOrder::lex')
+        self.assertEqual([e.id for e in q.order_by('name').limit(0, 1).all()], [5])
+        self.assertEqual(set(e.id for e in q.order_by('name').all()[1:]), set([2, 3, 4, 6, 7]))
+
+    def test_range_store(self):
+        class RomTestRangeStore(Model):
+            num = Integer(index=True)
+            val = Float(index=True)
+            tag = String(index=True, keygen=FULL_TEXT)
+
+        conn = connect(RomTestRangeStore)
+        self.assertEqual(util._redis_version(conn), util._redis_version(conn.pipeline()))
+        for i in range(300):
+            RomTestRangeStore(num=i%101, val=i/7.0, tag=b'even' if i % 2 else b'odd').save()
+        session.rollback()
+
+        q = RomTestRangeStore.query
+        queries = [
+            q.filter(num=(10, 20)),
+            q.filter(num=(None, 3)).order_by('-val'),
+            q.filter(num=(50, None), tag='even'),
+            q.filter(val=(1.5, 2.5), num=(0, 100)),
+            q.filter(num=(200, 300)),
+            q.filter(val=(0, 40)).order_by('num').limit(5, 10),
+        ]
+        gindex = RomTestRangeStore._gindex
+        store = index.RANGE_STORE
+        try:
+            results = []
+            for use in (False, True):
+                index.RANGE_STORE = use
+                for subrange in (None, True, False):
+                    out = []
+                    for query in queries:
+                        query = query.hint(subrange=subrange)
+                        out.append((query._search(), query.count()))
+                        if use and subrange is None:
+                            step = query.explain()['steps'][0]
+                            self.assertTrue(step['kind'] != 'range' or step['subrange'])
+                    # the pipelined (geo filter) path
+                    gindex._compile = lambda *args: None
+                    try:
+                        out.append([query.hint(subrange=subrange)._search() for query in queries])
+                    finally:
+                        del gindex._compile
+                    results.append(out)
+        finally:
+            index.RANGE_STORE = store
+        for out in results[1:]:
+            self.assertEqual(out, results[0])
+        self.assertEqual(len(results[0][0][0]), 33)
+        self.assertEqual(results[0][4], ([], 0))
+
+    def test_composite_index(self):
+        class RomTestComposite(Model):
+            tenant = Integer(index=True)
+            kind = Text(index=True, keygen=IDENTITY)
+            created = Float(index=True)
+            tags = Text(index=True, keygen=FULL_TEXT)
+
+            composite_index = [
+                ('tenant', 'created'),
+                ('tags', 'kind', 'created'),
+            ]
+
+        for bad in [('tenant',), ('tenant', 'tenant'), ('tenant', 'missing'), ('created', 'kind')]:
+            def define():
+                class RomTestCompositeBad(Model):
+                    tenant = Integer(index=True)
+                    kind = Text(index=True, keygen=IDENTITY)
+                    created = Float(index=True)
+                    composite_index = [bad]
+            self.assertRaises(ColumnError, define)
+
+        conn = connect(RomTestComposite)
+        kinds = ['click', 'view', 'buy']
+        for i in range(120):
+            RomTestComposite(tenant=i % 4, kind=kinds[i % 3], created=i / 2.0,
+                tags='red blue' if i % 5 else 'green').save()
+        session.rollback()
+
+        q = RomTestComposite.query
+        queries = [
+            q.filter(tenant=2, created=(10, 30)),
+            q.filter(created=(None, 20), tenant=1).order_by('-created'),
+            q.filter(tenant=3, created=(40, 45), kind='view'),
+            q.filter(tags='blue', kind='buy', created=(5, 50)).limit(2, 5),
+            q.filter(tenant=2, created=11.0),
+            q.filter(tenant=9, created=(0, 100)),
+            q.filter(Q(tenant=1) | Q(created=(0, 2))),
+            q.filter(Q(tenant=1, created=(0, 10)) | Q(tenant=2, created=(50, 55))),
+        ]
+        composite = RomTestComposite._gindex.composite
+        RomTestComposite._gindex.composite = []
+        try:
+            expected = [(query.all(), query.count()) for query in queries]
+        finally:
+            RomTestComposite._gindex.composite = composite
+        for query, (ents, count) in zip(queries, expected):
+            self.assertEqual([e.id for e in query.all()], [e.id for e in ents])
+            self.assertEqual(query.count(), count)
+        self.assertEqual(expected[0][1], 10)
+        self.assertEqual(expected[4][1], 1)
+
+        def indexes(query):
+            return [step['index'] for step in query.explain()['steps']]
+        self.assertEqual(indexes(queries[0]), ['RomTestComposite:tenant+created:2.0:idx'])
+        self.assertEqual(indexes(queries[3]), ['RomTestComposite:tags+kind+created:blue:buy:idx'])
+        # only filters that are and-ed together use composite indexes
+        self.assertEqual([c[1] for c in indexes(queries[6])[0]],
+            ['RomTestComposite:tenant:idx', 'RomTestComposite:created:idx'])
+        self.assertEqual([c[1][0][1] for c in indexes(queries[7])[0]],
+            ['RomTestComposite:tenant+created:1.0:idx', 'RomTestComposite:tenant+created:2.0:idx'])
+
+        # changes move entities between composite indexes
+        e = RomTestComposite.get(3)
+        e.tenant = 3
+        e.created = 1000
+        e.save()
+        self.assertEqual(conn.zscore('RomTestComposite:tenant+created:3.0:idx', '3'), 1000)
+        self.assertEqual(conn.zscore('RomTestComposite:tenant+created:2.0:idx', '3'), None)
+        self.assertEqual([x.id for x in q.filter(tenant=3, created=(500, None)).all()], [3])
+        e.created = None
+        e.save()
+        self.assertEqual(conn.zscore('RomTestComposite:tenant+created:3.0:idx', '3'), None)
+        for e in RomTestComposite.query.all():
+            e.delete()
+        self.assertEqual(conn.keys('RomTestComposite:*+*'), [])
+
+    def test_in_list(self):
+        class RomTestInOwner(Model):
+            name = Text()
+
+        class RomTestInList(Model):
+            status = Integer(index=True)
+            owner = ManyToOne('RomTestInOwner', 'no action')
+            score = Float(index=True)
+            tag = Text(index=True, keygen=FULL_TEXT)
+            name = Text()
+
+        owners = [RomTestInOwner(name='o%i'%i) for i in range(5)]
+        for o in owners:
+            o.save()
+        for i in range(60):
+            RomTestInList(status=i % 7, owner=owners[i % 5], score=i / 4.0,
+                tag='red' if i % 2 else 'blue').save()
+        session.rollback()
+
+        q = RomTestInList.query
+        def ids(query):
+            return sorted(e.id for e in query.all())
+        def expected(test):
+            return sorted(e.id for e in q.all() if test(e))
+
+        self.assertEqual(ids(q.filter(status__in=[1, 5, 5, 6])), expected(lambda e: e.status in (1, 5, 6)))
+        self.assertEqual(q.filter(status__in=(1, 5, 6)).count(), len(expected(lambda e: e.status in (1, 5, 6))))
+        self.assertEqual(ids(q.filter(owner__in=[owners[1], 3])), expected(lambda e: e.owner.id in (2, 3)))
+        self.assertEqual(ids(q.filter(score__in=[.25, 2.5, 100])), [2, 11])
+        self.assertEqual(ids(q.filter(status__in=[])), [])
+        self.assertEqual(ids(q.filter(status__in=[2, 4], tag='red')),
+            expected(lambda e: e.status in (2, 4) and e.tag == 'red'))
+        self.assertEqual(ids(q.filter(Q(status__in=[0]) | Q(score=(0, 1)))),
+            expected(lambda e: e.status == 0 or e.score <= 1))
+        self.assertEqual(ids(q.filter(~Q(status__in=[0, 1]), tag='blue')),
+            expected(lambda e: e.status not in (0, 1) and e.tag == 'blue'))
+
+        # large lists of values are probed against the score index
+        query = q.filter(score=(0, .25), status__in=list(range(100)))
+        self.assertEqual(ids(query), [1, 2])
+        self.assertTrue(query.explain()['steps'][1]['probe'])
+        ordered = q.filter(status__in=[3, 4]).order_by('-score')
+        self.assertEqual([e.id for e in ordered.limit(0, 3).all()], [60, 54, 53])
+        self.assertEqual([e.id for e in ordered.hint(walk=False).limit(0, 3).all()], [60, 54, 53])
+
+        self.assertRaises(QueryError, lambda: q.filter(tag__in=['red']))
+        self.assertRaises(QueryError, lambda: q.filter(name__in=[1]))
+        self.assertRaises(QueryError, lambda: q.filter(status__in=['1']))
+        self.assertRaises(QueryError, lambda: q.filter(status__in=5))
+
+    def test_composite_index_backfill(self):
+        from rom.columns import MODELS
+        class RomTestCompositeLate(Model):
+            tenant = Integer(index=True)
+            created = Float(index=True)
+
+        for i in range(20):
+            RomTestCompositeLate(tenant=i % 2, created=i).save()
+        session.rollback()
+
+        # the index is declared after entities were written
+        del MODELS['RomTestCompositeLate']
+        class RomTestCompositeLate(Model):
+            tenant = Integer(index=True)
+            created = Float(index=True)
+            composite_index = [('tenant', 'created')]
+
+        conn = connect(RomTestCompositeLate)
+        RomTestCompositeLate(tenant=1, created=5.5).save()
+        session.rollback()
+        q = RomTestCompositeLate.query.filter(tenant=1, created=(4, 10))
+        uses = lambda q: any('tenant+created' in str(step['index']) for step in q.explain()['steps'])
+        self.assertFalse(uses(q))
+        self.assertEqual(sorted(e.created for e in q.all()), [5, 5.5, 7, 9])
+        self.assertEqual(q.count(), 4)
+
+        for _ in util.refresh_indices(RomTestCompositeLate):
+            pass
+        self.assertTrue(uses(q))
+        self.assertEqual(sorted(e.created for e in q.all()), [5, 5.5, 7, 9])
+        self.assertEqual(conn.hkeys('RomTestCompositeLate::built'), [b'tenant+created'])
+
+    def test_bitmap_index(self):
+        class RomTestBitmap(Model):
+            flag = Boolean(index=True, bitmap=True)
+            color = Text(index=True, keygen=IDENTITY, bitmap=True)
+            num = Integer(index=True)
+
+        self.assertRaises(ColumnError, lambda: Integer(index=True, bitmap=True))
+        self.assertRaises(ColumnError, lambda: Boolean(bitmap=True))
+
+        conn = connect(RomTestBitmap)
+        colors = ['red', 'green', 'blue']
+        for i in range(300):
+            RomTestBitmap(flag=bool(i % 3), color=colors[i % 7 % 3], num=i % 11).save()
+        session.rollback()
+        self.assertEqual(conn.keys('RomTestBitmap:flag:*:idx'), [])
+        self.assertEqual(conn.getbit('RomTestBitmap:flag:True:bm', 2), 1)
+        self.assertEqual(conn.getbit('RomTestBitmap:flag:True:bm', 4), 0)
+
+        q = RomTestBitmap.query
+        everything = q.all()
+        def check(query, test):
+            expected = sorted(e.id for e in everything if test(e))
+            self.assertEqual(sorted(e.id for e in query.all()), expected)
+            self.assertEqual(query.count(), len(expected))
+            self.assertEqual(len(query.limit(0, 5).all()), min(len(expected), 5))
+
+        check(q.filter(flag=True), lambda e: e.flag)
+        check(q.filter(flag=False, color='red'), lambda e: not e.flag and e.color == 'red')
+        check(q.filter(color=['red', 'blue'], flag=True), lambda e: e.flag and e.color != 'green')
+        check(q.filter(color=['red', 'blue'], flag=True, num=(2, 4)),
+            lambda e: e.flag and e.color != 'green' and 2 <= e.num <= 4)
+        check(q.filter(Q(color='green') | Q(num=1), flag=True),
+            lambda e: e.flag and (e.color == 'green' or e.num == 1))
+        check(q.filter(~Q(color='green'), num=5), lambda e: e.color != 'green' and e.num == 5)
+        check(q.filter(num=0).filter(flag=True).order_by('-num'), lambda e: e.flag and e.num == 0)
+
+        # and-ed bitmap filters are combined into one step
+        plan = q.filter(color=['red', 'blue'], flag=True, num=(0, 9)).explain()
+        bits = [step for step in plan['steps'] if step['kind'] == 'bits']
+        self.assertEqual(len(bits), 1)
+        self.assertEqual(bits[0]['index'], [['RomTestBitmap:color:red:bm', 'RomTestBitmap:color:blue:bm'],
+            ['RomTestBitmap:flag:True:bm']])
+
+        # changes and deletes clear bits
+        e = RomTestBitmap.get(2)
+        e.flag = False
+        e.save()
+        self.assertEqual(conn.getbit('RomTestBitmap:flag:True:bm', 2), 0)
+        self.assertEqual(conn.getbit('RomTestBitmap:flag:False:bm', 2), 1)
+        e.delete()
+        self.assertEqual(conn.getbit('RomTestBitmap:flag:False:bm', 2), 0)
+        self.assertEqual(q.filter(flag=False).count(), 100)
+
+    def test_bitmap_index_backfill(self):
+        from rom.columns import MODELS
+        class RomTestBitmapLate(Model):
+            flag = Boolean(index=True)
+            num = Integer(index=True)
+
+        for i in range(20):
+            RomTestBitmapLate(flag=bool(i % 3), num=i).save()
+        session.rollback()
+
+        # the bitmap is enabled after entities were written
+        del MODELS['RomTestBitmapLate']
+        class RomTestBitmapLate(Model):
+            flag = Boolean(index=True, bitmap=True)
+            num = Integer(index=True)
+
+        conn = connect(RomTestBitmapLate)
+        RomTestBitmapLate(flag=True, num=20).save()
+        session.rollback()
+        self.assertEqual(conn.getbit('RomTestBitmapLate:flag:True:bm', 21), 1)
+        q = RomTestBitmapLate.query.filter(flag=True, num=(0, 10))
+        uses = lambda q: any(step['kind'] == 'bits' for step in q.explain()['steps'])
+        expected = [1, 2, 4, 5, 7, 8, 10]
+        self.assertFalse(uses(q))
+        self.assertEqual(sorted(e.num for e in q.all()), expected)
+        self.assertEqual(RomTestBitmapLate.query.filter(flag=True).count(), 14)
+
+        for _ in util.refresh_indices(RomTestBitmapLate):
+            pass
+        self.assertTrue(uses(q))
+        self.assertEqual(sorted(e.num for e in q.all()), expected)
+        self.assertEqual(RomTestBitmapLate.query.filter(flag=True).count(), 14)
+        # once built, new entities are only written to the bitmaps
+        e = RomTestBitmapLate(flag=False, num=21)
+        e.save()
+        self.assertFalse(conn.sismember('RomTestBitmapLate:flag:False:idx', e.id))
+        self.assertEqual(RomTestBitmapLate.query.filter(flag=False).count(), 8)
+
 
 def main():
     global_setup()